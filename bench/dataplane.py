@@ -0,0 +1,200 @@
+"""
+Data plane benchmarks for the console relay and the TCP proxy.
+
+- `console`: a client writes to a `ConsoleSession`'s Unix socket, which relays to a
+  console websocket on the fake LXD (`bench.fake_lxd`, run as a separate process), which
+  echoes everything back
+- `proxy`: a client connects to a port forwarded by `webspace-tcp-proxy` (with a stand-in
+  webspaced answering `boot_and_ip`) to a local TCP sink
+
+Both report throughput (MB/s), single byte round-trip latency (i.e. a keystroke) and the
+CPU time used by the relay itself per GB transferred. Run from the root of the repo:
+
+    python -m bench.dataplane console proxy --proxy-bin tcp-proxy/target/release/webspace-tcp-proxy
+"""
+import argparse
+import getpass
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib import parse
+
+from pylxd import Client
+from pylxd.models import Operation
+
+from webspace_ng.unixrpc import ThreadedUnixRPCServer
+from webspace_ng.daemon.console import ConsoleSession
+from webspace_ng.daemon.tcp_proxy import TcpProxy
+
+CHUNK = 4096
+WINDOW = 64 * 1024
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+def cpu_seconds(pid, tid=None):
+    """User + system CPU time of a process (or one of its threads)."""
+    stat_path = '/proc/{}/stat'.format(pid) if tid is None else '/proc/{}/task/{}/stat'.format(pid, tid)
+    with open(stat_path) as f:
+        # The command name may contain spaces, fields start after the closing bracket
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+def wait_for(path, timeout=10):
+    end = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > end:
+            raise Exception('timed out waiting for {}'.format(path))
+        time.sleep(0.05)
+
+def echo_throughput(sock, size, window=WINDOW):
+    """
+    Writes `size` bytes and reads them back (the peer echoes), returns the elapsed time.
+    At most `window` bytes are in flight: the console relay is a single thread, so flooding
+    it in both directions at once would deadlock it (and the fake LXD's echo).
+    """
+    payload = b'x' * CHUNK
+    received = 0
+    cond = threading.Condition()
+    def write():
+        sent = 0
+        while sent < size:
+            with cond:
+                cond.wait_for(lambda: sent - received < window)
+            sock.sendall(payload)
+            sent += len(payload)
+    writer = threading.Thread(target=write)
+
+    start = time.perf_counter()
+    writer.start()
+    while received < size:
+        data = sock.recv(65536)
+        if not data:
+            raise Exception('connection closed after {} bytes'.format(received))
+        with cond:
+            received += len(data)
+            cond.notify()
+    elapsed = time.perf_counter() - start
+    writer.join()
+    return elapsed
+
+def round_trips(sock, count):
+    rtts = []
+    for _ in range(count):
+        start = time.perf_counter()
+        sock.sendall(b'k')
+        if not sock.recv(1):
+            raise Exception('connection closed')
+        rtts.append(time.perf_counter() - start)
+    rtts.sort()
+    return rtts[len(rtts) // 2], rtts[int(len(rtts) * 0.99)]
+
+def report(label, size, elapsed, cpu, rtt):
+    print('{:<8} {:>10.1f} MB/s  {:>8.2f} CPU s/GB  rtt p50 {:>8.1f} us  p99 {:>8.1f} us'.format(
+        label, size / elapsed / 1e6, cpu / (size / 1e9), rtt[0] * 1e6, rtt[1] * 1e6))
+
+def bench_console(args, tmp):
+    lxd_sock = os.path.join(tmp, 'lxd.socket')
+    lxd_proc = subprocess.Popen([sys.executable, '-m', 'bench.fake_lxd', '--socket', lxd_sock],
+                                stdout=subprocess.DEVNULL)
+    try:
+        wait_for(lxd_sock)
+        client = Client(endpoint='http+unix://{}'.format(parse.quote(lxd_sock, safe='')))
+        fingerprint = client.images.all()[0].fingerprint
+        container = client.containers.create({
+            'name': 'bench-ws',
+            'source': {'type': 'image', 'fingerprint': fingerprint},
+        }, wait=True)
+        container.start(wait=True)
+
+        # Same as `Manager.console`
+        response = container.api['console'].post(json={'width': 80, 'height': 24}).json()
+        operation_id = Operation.extract_operation_id(response['operation'])
+        ws_path = parse.urlparse(client.api.operations[operation_id].websocket._api_endpoint).path
+        fds = response['metadata']['metadata']['fds']
+        session = ConsoleSession(getpass.getuser(), client.websocket_url,
+                                 '{}?secret={}'.format(ws_path, fds['0']),
+                                 '{}?secret={}'.format(ws_path, fds['control']),
+                                 socket_suffix='bench-{}'.format(os.getpid()))
+        session.start()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(session.socket_path)
+        rtt = round_trips(sock, args.pings)
+
+        size = args.size * 1024 * 1024
+        cpu = cpu_seconds(os.getpid(), session.run_thread.native_id)
+        elapsed = echo_throughput(sock, size)
+        # Each byte is relayed in both directions
+        cpu = cpu_seconds(os.getpid(), session.run_thread.native_id) - cpu
+        report('console', size * 2, elapsed, cpu, rtt)
+
+        sock.close()
+        session.stop(join=True)
+    finally:
+        lxd_proc.terminate()
+        lxd_proc.wait()
+
+def bench_proxy(args, tmp):
+    sink_proc = subprocess.Popen([sys.executable, '-m', 'bench.netns_forwarding', 'sink', '--port', str(args.sink_port)])
+    sock_path = os.path.join(tmp, 'webspaced.socket')
+    server = ThreadedUnixRPCServer(sock_path, logRequests=False)
+    server.register_function(lambda _user: '127.0.0.1', 'boot_and_ip')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    proxy = TcpProxy(args.proxy_bin, sock_path)
+    try:
+        proxy.add_forwarding(args.port, 'bench', args.sink_port)
+        time.sleep(0.5)
+
+        sock = socket.create_connection(('127.0.0.1', args.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(b'p')
+        rtt = round_trips(sock, args.pings)
+        sock.close()
+
+        size = args.size * 1024 * 1024
+        payload = b'x' * 65536
+        sock = socket.create_connection(('127.0.0.1', args.port))
+        cpu = cpu_seconds(proxy.proc.pid)
+        start = time.perf_counter()
+        sock.sendall(b't')
+        sent = 0
+        while sent < size:
+            sock.sendall(payload)
+            sent += len(payload)
+        sock.shutdown(socket.SHUT_WR)
+        received = int(sock.makefile().readline().split()[0])
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds(proxy.proc.pid) - cpu
+        sock.close()
+        if received != sent:
+            raise Exception('sink received {} bytes, expected {}'.format(received, sent))
+
+        report('proxy', size, elapsed, cpu, rtt)
+    finally:
+        proxy.stop()
+        server.shutdown()
+        sink_proc.terminate()
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('paths', nargs='+', choices=('console', 'proxy'), help='Data paths to benchmark')
+    parser.add_argument('--size', type=int, default=64, help='MiB to transfer')
+    parser.add_argument('--pings', type=int, default=1000, help='Number of single byte round trips to time')
+    parser.add_argument('--proxy-bin', default='tcp-proxy/target/release/webspace-tcp-proxy',
+                        help='Path to the TCP proxy binary')
+    parser.add_argument('--port', type=int, default=50002, help='External port for the TCP proxy')
+    parser.add_argument('--sink-port', type=int, default=50003, help='Port for the TCP sink')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='webspace-bench-')
+    if 'console' in args.paths:
+        bench_console(args, tmp)
+    if 'proxy' in args.paths:
+        bench_proxy(args, tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Stand-in DNS server for testing custom domain verification.
+
+Answers TXT queries over UDP for the configured records (NXDOMAIN for anything else),
+optionally after a delay or not at all (to exercise timeouts). Point the daemon at it
+with `dns.nameservers: [127.0.0.1]` and `dns.port`:
+
+    python -m bench.fake_dns --port 5353 --txt example.com=webspace:root --txt slow.com=webspace:root
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+import dns.message
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+class FakeDNSHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        query = dns.message.from_wire(data)
+        question = query.question[0]
+        name = question.name.to_text(omit_final_dot=True).lower()
+
+        if name in self.server.drop:
+            return
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        response = dns.message.make_response(query)
+        if name not in self.server.records:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        elif question.rdtype == dns.rdatatype.TXT:
+            response.answer.append(dns.rrset.from_text_list(
+                question.name, self.server.ttl, dns.rdataclass.IN, dns.rdatatype.TXT,
+                ['"{}"'.format(v) for v in self.server.records[name]]))
+        sock.sendto(response.to_wire(), self.client_address)
+
+class FakeDNS(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, records=None, drop=(), delay=0, ttl=60):
+        # domain -> list of TXT values
+        self.records = records if records is not None else {}
+        self.drop = set(drop)
+        self.delay = delay
+        self.ttl = ttl
+        socketserver.UDPServer.__init__(self, ('127.0.0.1', port), FakeDNSHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-p', '--port', type=int, default=5353, help='UDP port to listen on (127.0.0.1)')
+    parser.add_argument('--txt', action='append', default=[], help='TXT record (domain=value)')
+    parser.add_argument('--drop', action='append', default=[], help='Never answer queries for this domain')
+    parser.add_argument('--delay', type=float, default=0, help='Seconds to wait before answering')
+    parser.add_argument('--ttl', type=int, default=60, help='TTL of answers')
+    args = parser.parse_args()
+
+    records = {}
+    for record in args.txt:
+        domain, value = record.split('=', 1)
+        records.setdefault(domain.lower(), []).append(value)
+    server = FakeDNS(args.port, records, args.drop, args.delay, args.ttl)
+    print('serving DNS on 127.0.0.1:{}'.format(server.port))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,676 @@
+"""
+A stand-in for LXD's REST API, served over a Unix socket.
+
+Implements the parts of the API used by pylxd and webspaced: host info, containers
+(list / get / create / delete / rename / config / state), operations (including `wait`
+and websockets), console and exec sessions (the data websocket echoes back whatever it
+receives, like a tty), non-interactive exec with recorded output, files, console logs and images. All state is kept in memory.
+
+Boot, stop and create latencies can be simulated, as well as a fixed latency for every
+API call. Run standalone with:
+
+    python -m bench.fake_lxd --socket /tmp/fake-lxd.socket --boot-delay 1
+"""
+import argparse
+import base64
+import hashlib
+import ipaddress
+import json
+import os
+import socketserver
+import struct
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler
+from urllib import parse
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+STATUS_RUNNING = ('Running', 103)
+STATUS_STOPPED = ('Stopped', 102)
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+class WebSocket:
+    """Minimal server side of a websocket connection (RFC 6455)."""
+    def __init__(self, rfile, sock):
+        self.rfile = rfile
+        self.sock = sock
+        self.send_lock = threading.Lock()
+
+    def _read_exact(self, n):
+        data = self.rfile.read(n)
+        if len(data) != n:
+            raise EOFError()
+        return data
+    def recv(self):
+        """Returns (opcode, payload), reassembling fragmented messages. Control frames are handled."""
+        message = b''
+        message_op = None
+        while True:
+            b0, b1 = self._read_exact(2)
+            fin, op = b0 & 0x80, b0 & 0x0f
+            length = b1 & 0x7f
+            if length == 126:
+                length, = struct.unpack('!H', self._read_exact(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', self._read_exact(8))
+            mask = self._read_exact(4) if b1 & 0x80 else None
+            payload = self._read_exact(length)
+            if mask is not None:
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload)) if length < 64 else \
+                    (int.from_bytes(payload, 'big') ^ int.from_bytes((mask * (length // 4 + 1))[:length], 'big')) \
+                    .to_bytes(length, 'big')
+
+            if op == OP_PING:
+                self.send(payload, OP_PONG)
+                continue
+            if op == OP_PONG:
+                continue
+            if op == OP_CLOSE:
+                return OP_CLOSE, payload
+
+            if op != 0:
+                message_op = op
+            message += payload
+            if fin:
+                return message_op, message
+    def send(self, payload, op=OP_BINARY):
+        header = bytes([0x80 | op])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 2**16:
+            header += bytes([126]) + struct.pack('!H', len(payload))
+        else:
+            header += bytes([127]) + struct.pack('!Q', len(payload))
+        with self.send_lock:
+            self.sock.sendall(header + payload)
+    def close(self):
+        try:
+            self.send(struct.pack('!H', 1000), OP_CLOSE)
+        except OSError:
+            pass
+
+class Operation:
+    def __init__(self, lxd, description, resources, metadata=None, websockets=None):
+        self.id = str(uuid.uuid4())
+        self.description = description
+        self.resources = resources
+        self.metadata = metadata
+        self.created_at = now()
+        self.status = 'Running'
+        self.status_code = 103
+        self.err = ''
+        self.done = threading.Event()
+        # secret -> name of the websocket (for websocket operations)
+        self.websockets = websockets or {}
+        self.connected = {}
+
+        lxd.operations[self.id] = self
+
+    def finish(self, err=None):
+        if err:
+            self.status, self.status_code, self.err = 'Failure', 400, err
+        else:
+            self.status, self.status_code = 'Success', 200
+        self.done.set()
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'class': 'websocket' if self.websockets else 'task',
+            'description': self.description,
+            'created_at': self.created_at,
+            'updated_at': now(),
+            'status': self.status,
+            'status_code': self.status_code,
+            'resources': self.resources,
+            'metadata': self.metadata,
+            'may_cancel': False,
+            'err': self.err,
+            'location': 'none',
+        }
+
+class FakeLXD(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, boot_delay=0, stop_delay=0, create_delay=0, api_latency=0,
+                 cidr='10.233.0.0/24', iface='eth0', bridge='lxdbr0'):
+        self.socket_path = socket_path
+        self.boot_delay = boot_delay
+        self.stop_delay = stop_delay
+        self.create_delay = create_delay
+        self.api_latency = api_latency
+        self.iface = iface
+        self.bridge = bridge
+        self.network = ipaddress.IPv4Network(cidr)
+
+        self.lock = threading.RLock()
+        self.containers = {}
+        self.images = {}
+        self.operations = {}
+        # Connected /1.0/events websockets
+        self.event_listeners = set()
+        self.hosts = self.network.hosts()
+        # Skip the gateway
+        self.gateway = next(self.hosts)
+        self.requests = 0
+
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+        super().__init__(socket_path, FakeLXDHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        os.unlink(self.socket_path)
+
+    def event(self, action, source):
+        """Send a lifecycle event to everyone listening on /1.0/events."""
+        message = json.dumps({
+            'type': 'lifecycle',
+            'timestamp': now(),
+            'metadata': {'action': action, 'source': source, 'context': {}},
+        }).encode('utf-8')
+        for ws in list(self.event_listeners):
+            try:
+                ws.send(message, OP_TEXT)
+            except OSError:
+                self.event_listeners.discard(ws)
+
+    def add_image(self, alias=None, fingerprint=None, description='', size=100*1024*1024):
+        fingerprint = fingerprint or hashlib.sha256(os.urandom(16)).hexdigest()
+        self.images[fingerprint] = {
+            'fingerprint': fingerprint,
+            'aliases': [{'name': alias, 'description': ''}] if alias else [],
+            'properties': {'description': description} if description else {},
+            'size': size,
+            'architecture': 'x86_64',
+            'public': False,
+            'auto_update': False,
+            'filename': fingerprint + '.tar.xz',
+            'created_at': now(),
+            'expires_at': now(),
+            'last_used_at': now(),
+            'uploaded_at': now(),
+            'cached': False,
+            'type': 'container',
+            'update_source': None,
+            'profiles': ['default'],
+        }
+        self.event('image-created', '/1.0/images/{}'.format(fingerprint))
+        return fingerprint
+    def add_container(self, name, config=None, running=False, memory=64*1024*1024, devices=None):
+        status, status_code = STATUS_RUNNING if running else STATUS_STOPPED
+        c = {
+            'name': name,
+            'architecture': 'x86_64',
+            'config': dict(config or {}),
+            'devices': dict(devices or {}),
+            'ephemeral': False,
+            'profiles': ['default'],
+            'stateful': False,
+            'description': '',
+            'created_at': now(),
+            'last_used_at': now(),
+            'location': 'none',
+            'type': 'container',
+            'project': 'default',
+            'status': status,
+            'status_code': status_code,
+            # Not part of LXD's representation
+            '_ip': str(next(self.hosts)),
+            '_memory': memory,
+            '_log': 'fake console log for {}\n'.format(name),
+            '_logs': {},
+            # path -> {'type': ..., 'mode': ..., 'data': ...}
+            '_files': {'/': {'type': 'directory', 'mode': 0o755}, '/root': {'type': 'directory', 'mode': 0o700}},
+        }
+        with self.lock:
+            self.containers[name] = c
+        return c
+    def set_memory(self, name, usage):
+        self.containers[name]['_memory'] = usage
+
+    def container_json(self, c, recursion=1):
+        data = {k: v for k, v in c.items() if not k.startswith('_')}
+        data['expanded_config'] = dict(c['config'])
+        data['expanded_devices'] = dict(c['devices'])
+        if recursion >= 2:
+            data['state'] = self.container_state(c)
+        return data
+    def container_state(self, c):
+        running = c['status_code'] == 103
+        network = {
+            'lo': {
+                'addresses': [{'family': 'inet', 'address': '127.0.0.1', 'netmask': '8', 'scope': 'local'}],
+                'counters': {'bytes_received': 0, 'bytes_sent': 0, 'packets_received': 0, 'packets_sent': 0},
+                'hwaddr': '', 'host_name': '', 'mtu': 65536, 'state': 'up', 'type': 'loopback',
+            },
+        }
+        if running:
+            network[self.iface] = {
+                'addresses': [{'family': 'inet', 'address': c['_ip'], 'netmask': '24', 'scope': 'global'}],
+                'counters': {'bytes_received': 1024, 'bytes_sent': 2048, 'packets_received': 10, 'packets_sent': 20},
+                'hwaddr': '00:16:3e:00:00:01', 'host_name': 'veth0', 'mtu': 1500, 'state': 'up', 'type': 'broadcast',
+            }
+        return {
+            'status': c['status'],
+            'status_code': c['status_code'],
+            'disk': {'root': {'usage': 512*1024*1024}},
+            'memory': {'usage': c['_memory'] if running else 0, 'usage_peak': c['_memory'] if running else 0,
+                       'swap_usage': 0, 'swap_usage_peak': 0},
+            'network': network if running else None,
+            'pid': 1234 if running else 0,
+            'processes': 10 if running else 0,
+            'cpu': {'usage': 1000000000 if running else 0},
+        }
+
+    def set_state(self, name, action):
+        with self.lock:
+            c = self.containers[name]
+        if action in ('stop', 'restart'):
+            time.sleep(self.stop_delay)
+            c['status'], c['status_code'] = STATUS_STOPPED
+        if action in ('start', 'restart'):
+            time.sleep(self.boot_delay)
+            # Containers get their NIC's `ipv4.address` (if it has one) when they boot
+            fixed = c['devices'].get(self.iface, {}).get('ipv4.address')
+            if fixed:
+                c['_ip'] = fixed
+            c['status'], c['status_code'] = STATUS_RUNNING
+            c['last_used_at'] = now()
+
+    def create(self, config, op=None):
+        source = config.get('source', {})
+        fingerprint = source.get('fingerprint')
+        if fingerprint is None and 'alias' in source:
+            for image in self.images.values():
+                if source['alias'] in (a['name'] for a in image['aliases']):
+                    fingerprint = image['fingerprint']
+        if fingerprint not in self.images:
+            raise KeyError('image not found')
+
+        # Report progress like LXD does while unpacking an image
+        for percent in range(0, 100, 25):
+            if op is not None:
+                op.metadata = {'create_instance_from_image_unpack_progress': 'Unpack: {}%'.format(percent)}
+            time.sleep(self.create_delay / 4)
+        c = self.add_container(config['name'], config=config.get('config'), devices=config.get('devices'))
+        c['profiles'] = config.get('profiles', ['default'])
+        c['ephemeral'] = config.get('ephemeral', False)
+        c['config']['volatile.base_image'] = fingerprint
+
+    def exec(self, name, command, record_output, op=None):
+        c = self.containers[name]
+        if c['status_code'] != 103:
+            raise KeyError('container is not running')
+        # Commands finish straight away, `false` fails and anything else echoes its arguments
+        status = 1 if command[0] == 'false' else 0
+        stdout = '' if status else ' '.join(command[1:]) + '\n'
+        stderr = 'fake error\n' if status else ''
+        op.metadata = {'return': status}
+        if record_output:
+            op.metadata['output'] = {}
+            for fd, ext, data in (('1', 'stdout', stdout), ('2', 'stderr', stderr)):
+                log = 'exec_{}.{}'.format(op.id, ext)
+                c['_logs'][log] = data.encode('utf-8')
+                op.metadata['output'][fd] = '/1.0/instances/{}/logs/{}'.format(name, log)
+
+class FakeLXDHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Unix socket, no nagle
+    disable_nagle_algorithm = False
+
+    def log_message(self, format, *args):
+        pass
+    def address_string(self):
+        return 'unix'
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+    def sync(self, metadata, status=200, headers=None):
+        self.send_json(status, {'type': 'sync', 'status': 'Success', 'status_code': 200,
+                                'operation': '', 'error_code': 0, 'error': '', 'metadata': metadata}, headers)
+    def error(self, status, message):
+        self.send_json(status, {'type': 'error', 'error': message, 'error_code': status, 'metadata': None})
+    def async_(self, op):
+        self.send_json(202, {'type': 'async', 'status': 'Operation created', 'status_code': 100,
+                             'operation': '/1.0/operations/{}'.format(op.id), 'error_code': 0, 'error': '',
+                             'metadata': op.to_json()})
+    def background(self, description, resources, fn, *args, with_op=False):
+        op = Operation(self.server, description, resources)
+        def run():
+            try:
+                fn(*args, **({'op': op} if with_op else {}))
+            except Exception as ex:
+                op.finish(err=str(ex))
+            else:
+                op.finish()
+        threading.Thread(target=run, daemon=True).start()
+        self.async_(op)
+
+    def body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            data = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return bytes(data)
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length) if length else b''
+        return data
+    def json_body(self):
+        data = self.body()
+        return json.loads(data) if data else {}
+
+    def route(self, method):
+        if self.server.api_latency:
+            time.sleep(self.server.api_latency)
+        self.server.requests += 1
+
+        url = parse.urlparse(self.path)
+        self.query = dict(parse.parse_qsl(url.query))
+        parts = [p for p in url.path.split('/') if p]
+        if not parts or parts[0] != '1.0':
+            return self.error(404, 'not found')
+        parts = parts[1:]
+        # pylxd >= 2.3 uses /instances, older versions /containers
+        if parts and parts[0] in ('containers', 'instances'):
+            parts[0] = 'containers'
+
+        if parts[:2] == ['images', 'aliases']:
+            parts = ['images_aliases'] + parts[2:]
+        handler = getattr(self, '{}_{}'.format(method, '_'.join(
+            p if i % 2 == 0 else 'x' for i, p in enumerate(parts)) or 'root'), None)
+        if handler is None:
+            return self.error(404, 'not found')
+        try:
+            handler(*[p for i, p in enumerate(parts) if i % 2 == 1])
+        except KeyError as ex:
+            self.error(404, 'not found: {}'.format(ex))
+
+    def do_GET(self):
+        self.route('get')
+    def do_POST(self):
+        self.route('post')
+    def do_PUT(self):
+        self.route('put')
+    def do_PATCH(self):
+        self.route('patch')
+    def do_DELETE(self):
+        self.route('delete')
+
+    def get_root(self):
+        self.sync({
+            'api_extensions': ['container_exec_recording', 'console', 'file_delete', 'file_append'],
+            'api_status': 'stable',
+            'api_version': '1.0',
+            'auth': 'trusted',
+            'public': False,
+            'auth_methods': ['tls'],
+            'environment': {'server': 'lxd', 'server_name': 'fake', 'server_version': '3.0.0',
+                            'server_clustered': False, 'driver': 'lxc', 'kernel': 'Linux'},
+        })
+
+    # Containers
+    def get_containers(self):
+        recursion = int(self.query.get('recursion', '0').split(';')[0])
+        with self.server.lock:
+            containers = list(self.server.containers.values())
+        if recursion:
+            return self.sync([self.server.container_json(c, recursion) for c in containers])
+        self.sync(['/1.0/instances/{}'.format(c['name']) for c in containers])
+    def post_containers(self):
+        config = self.json_body()
+        name = config['name']
+        if name in self.server.containers:
+            return self.error(409, 'container already exists')
+        self.background('Creating container', {'instances': ['/1.0/instances/' + name]}, self.server.create, config,
+                        with_op=True)
+    def get_containers_x(self, name):
+        self.sync(self.server.container_json(self.server.containers[name]))
+    def put_containers_x(self, name):
+        c = self.server.containers[name]
+        body = self.json_body()
+        for key in ('config', 'devices', 'profiles', 'description', 'ephemeral'):
+            if key in body:
+                c[key] = body[key]
+        self.background('Updating container', {'instances': ['/1.0/instances/' + name]}, lambda: None)
+    def patch_containers_x(self, name):
+        c = self.server.containers[name]
+        body = self.json_body()
+        for key in ('config', 'devices'):
+            if key in body:
+                c[key].update(body[key])
+        for key in ('profiles', 'description', 'ephemeral'):
+            if key in body:
+                c[key] = body[key]
+        self.sync({})
+    def post_containers_x(self, name):
+        body = self.json_body()
+        c = self.server.containers[name]
+        def rename():
+            with self.server.lock:
+                del self.server.containers[name]
+                c['name'] = body['name']
+                self.server.containers[body['name']] = c
+        self.background('Renaming container', {'instances': ['/1.0/instances/' + name]}, rename)
+    def delete_containers_x(self, name):
+        c = self.server.containers[name]
+        if c['status_code'] == 103:
+            return self.error(400, 'container is running')
+        def delete():
+            with self.server.lock:
+                del self.server.containers[name]
+        self.background('Deleting container', {'instances': ['/1.0/instances/' + name]}, delete)
+
+    def get_containers_x_state(self, name):
+        self.sync(self.server.container_state(self.server.containers[name]))
+    def put_containers_x_state(self, name):
+        self.server.containers[name]
+        action = self.json_body()['action']
+        self.background('Changing container state', {'instances': ['/1.0/instances/' + name]},
+                        self.server.set_state, name, action)
+
+    def raw(self, data, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except BrokenPipeError:
+            # The client only wanted the headers
+            self.close_connection = True
+    def get_containers_x_console(self, name):
+        self.raw(self.server.containers[name]['_log'].encode('utf-8'))
+    def get_containers_x_logs_x(self, name, log):
+        self.raw(self.server.containers[name]['_logs'][log])
+    def delete_containers_x_logs_x(self, name, log):
+        del self.server.containers[name]['_logs'][log]
+        self.sync({})
+    def get_containers_x_files(self, name):
+        files = self.server.containers[name]['_files']
+        path = os.path.normpath(self.query['path'])
+        f = files[path]
+        headers = {'X-LXD-type': f['type'], 'X-LXD-mode': '{:04o}'.format(f.get('mode', 0o777)),
+                   'X-LXD-uid': '0', 'X-LXD-gid': '0'}
+        if f['type'] == 'directory':
+            return self.sync(sorted(os.path.basename(p) for p in files if p != path and os.path.dirname(p) == path),
+                             headers=headers)
+        self.raw(bytes(f['data']), headers)
+    def post_containers_x_files(self, name):
+        files = self.server.containers[name]['_files']
+        path = os.path.normpath(self.query['path'])
+        data = self.body()
+        type_ = self.headers.get('X-LXD-type', 'file')
+        if files.get(os.path.dirname(path), {}).get('type') != 'directory':
+            return self.error(404, 'parent directory not found')
+        if type_ == 'directory':
+            if path in files and files[path]['type'] != 'directory':
+                return self.error(400, 'file exists')
+            files.setdefault(path, {'type': 'directory', 'mode': int(self.headers.get('X-LXD-mode', '0755'), 8)})
+        elif type_ == 'symlink':
+            files[path] = {'type': 'symlink', 'data': data}
+        else:
+            existing = files.get(path)
+            if existing is not None and existing['type'] == 'directory':
+                return self.error(400, 'is a directory')
+            if existing is not None and self.headers.get('X-LXD-write') == 'append':
+                existing['data'] += data
+            else:
+                files[path] = {'type': 'file', 'mode': int(self.headers.get('X-LXD-mode', '0644'), 8),
+                               'data': bytearray(data)}
+        self.sync({})
+    def websocket_op(self, name, description, metadata=None):
+        if self.server.containers[name]['status_code'] != 103:
+            return self.error(400, 'container is not running')
+        secrets = {'0': uuid.uuid4().hex, 'control': uuid.uuid4().hex}
+        op = Operation(self.server, description, {'instances': ['/1.0/instances/' + name]},
+                       metadata=dict(metadata or {}, fds=secrets),
+                       websockets={secret: fd for fd, secret in secrets.items()})
+        self.async_(op)
+    def post_containers_x_console(self, name):
+        self.json_body()
+        self.websocket_op(name, 'Showing console')
+    def post_containers_x_exec(self, name):
+        body = self.json_body()
+        if body.get('wait-for-websocket'):
+            return self.websocket_op(name, 'Executing command', {'command': body.get('command')})
+        self.server.containers[name]
+        self.background('Executing command', {'instances': ['/1.0/instances/' + name]}, self.server.exec, name,
+                        body['command'], body.get('record-output', False), with_op=True)
+
+    # Operations
+    def get_operations_x(self, op_id):
+        self.sync(self.server.operations[op_id].to_json())
+    def get_operations_x_wait(self, op_id):
+        op = self.server.operations[op_id]
+        timeout = float(self.query.get('timeout', -1))
+        op.done.wait(None if timeout < 0 else timeout)
+        self.sync(op.to_json())
+    def delete_operations_x(self, op_id):
+        self.server.operations[op_id].finish(err='cancelled')
+        self.sync({})
+    def get_operations_x_websocket(self, op_id):
+        op = self.server.operations[op_id]
+        fd = op.websockets.get(self.query.get('secret'))
+        if fd is None:
+            return self.error(403, 'invalid secret')
+
+        ws = self.upgrade()
+        op.connected[fd] = ws
+        try:
+            while True:
+                opcode, payload = ws.recv()
+                if opcode == OP_CLOSE:
+                    break
+                if fd == '0' and opcode == OP_BINARY:
+                    # Echo, like a tty
+                    ws.send(payload)
+        except (EOFError, OSError):
+            pass
+        finally:
+            ws.close()
+            if fd == '0':
+                op.finish()
+                control = op.connected.get('control')
+                if control is not None:
+                    control.close()
+
+    def get_events(self):
+        ws = self.upgrade()
+        self.server.event_listeners.add(ws)
+        try:
+            while ws.recv()[0] != OP_CLOSE:
+                pass
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.server.event_listeners.discard(ws)
+    def upgrade(self):
+        key = self.headers['Sec-WebSocket-Key']
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        return WebSocket(self.rfile, self.connection)
+
+    # Networks
+    def get_networks_x(self, name):
+        if name != self.server.bridge:
+            return self.error(404, 'not found')
+        self.sync({
+            'name': name,
+            'type': 'bridge',
+            'managed': True,
+            'config': {'ipv4.address': '{}/{}'.format(self.server.gateway, self.server.network.prefixlen),
+                       'ipv4.nat': 'true'},
+        })
+
+    # Images
+    def get_images(self):
+        if self.query.get('recursion'):
+            return self.sync(list(self.server.images.values()))
+        self.sync(['/1.0/images/{}'.format(fp) for fp in self.server.images])
+    def get_images_x(self, fingerprint):
+        self.sync(self.server.images[fingerprint])
+    def get_images_aliases_x(self, alias):
+        for image in self.server.images.values():
+            if alias in (a['name'] for a in image['aliases']):
+                return self.sync({'name': alias, 'description': '', 'target': image['fingerprint'], 'type': 'container'})
+        self.error(404, 'not found')
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--socket', default='/tmp/fake-lxd.socket', help='Path to the Unix socket to serve on')
+    parser.add_argument('--boot-delay', type=float, default=0, help='Seconds taken to start a container')
+    parser.add_argument('--stop-delay', type=float, default=0, help='Seconds taken to stop a container')
+    parser.add_argument('--create-delay', type=float, default=0, help='Seconds taken to create a container')
+    parser.add_argument('--api-latency', type=float, default=0, help='Seconds added to every API call')
+    parser.add_argument('--image', action='append', default=['tutorial'], help='Alias of an image to provide')
+    args = parser.parse_args()
+
+    lxd = FakeLXD(args.socket, boot_delay=args.boot_delay, stop_delay=args.stop_delay,
+                  create_delay=args.create_delay, api_latency=args.api_latency)
+    for alias in args.image:
+        lxd.add_image(alias, description='Fake {} image'.format(alias))
+    print('fake LXD listening on {}'.format(args.socket))
+    try:
+        lxd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
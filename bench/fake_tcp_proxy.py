@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Stand-in for webspace-tcp-proxy which accepts every command without forwarding anything.
+
+Commands are read from stdin (results on stderr), or from connections to a control
+socket if its path is given after the daemon's socket path.
+"""
+import os
+import socket
+import sys
+
+def serve(commands, results):
+    for line in commands:
+        if line.strip() == 'quit':
+            return True
+        print('ok', file=results, flush=True)
+    return False
+
+def main():
+    if len(sys.argv) < 3:
+        serve(sys.stdin, sys.stderr)
+        return
+
+    try:
+        os.unlink(sys.argv[2])
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(sys.argv[2])
+    listener.listen(1)
+    while True:
+        conn, _ = listener.accept()
+        with conn, conn.makefile('rw') as f:
+            if serve(f, f):
+                break
+    os.unlink(sys.argv[2])
+
+if __name__ == '__main__':
+    main()
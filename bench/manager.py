@@ -0,0 +1,212 @@
+"""
+Load test for webspaced's `Manager` against the fake LXD (`bench.fake_lxd`).
+
+Starts a fake LXD and a real RPC server + `Manager` in-process, creates a container for
+a number of existing system users (through the `init` RPC) and then drives each of the
+selected RPC calls at the given concurrency, over the daemon's Unix socket. Throughput
+and p50 / p99 latency are reported for each operation. Results can be saved as JSON and
+compared against a previous run:
+
+    python -m bench.manager --json before.json
+    (switch commits)
+    python -m bench.manager --compare before.json
+
+The calling user must be a member of the `webspace-admin` group.
+"""
+import argparse
+import getpass
+import grp
+import ipaddress
+import json
+import logging
+import os
+import pwd
+import re
+import tempfile
+import threading
+import time
+
+from munch import Munch
+
+from webspace_ng import ADMIN_GROUP
+from webspace_ng.unixrpc import ThreadedUnixRPCServer, UnixServerProxy
+from webspace_ng.cli.client import Client
+from webspace_ng.daemon import default_config
+from webspace_ng.daemon.webspace import Manager
+from .fake_lxd import FakeLXD
+
+OPS = ('boot_and_host', 'boot_and_ip', 'status', 'ports')
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.mkdtemp(prefix='webspace-bench-')
+
+        self.lxd = FakeLXD(os.path.join(self.tmp, 'lxd.socket'), boot_delay=args.boot_delay,
+                           stop_delay=args.stop_delay, api_latency=args.api_latency).start()
+        self.fingerprint = self.lxd.add_image('tutorial')
+
+        config = default_config()
+        config['bind_socket'] = os.path.join(self.tmp, 'webspaced.socket')
+        config['metrics_socket'] = ''
+        config['store_file'] = os.path.join(self.tmp, 'store.db')
+        config['lxd']['socket'] = self.lxd.socket_path
+        config['defaults']['startup_delay'] = str(args.startup_delay)
+        config['run_limit'] = args.run_limit
+        config['admission']['enabled'] = bool(args.memory_budget)
+        config['admission']['budget'] = args.memory_budget
+        config['lxd']['net']['bridge'] = args.bridge
+        config['ports']['proxy_bin'] = os.path.join(os.path.dirname(__file__), 'fake_tcp_proxy.py')
+        self.config = Munch.fromDict(config)
+        self.config.lxd.net.cidr = ipaddress.IPv4Network(self.config.lxd.net.cidr)
+
+        self.server = ThreadedUnixRPCServer(self.config.bind_socket, logRequests=False)
+        self.manager = Manager(self.config, self.server)
+        self.server.register_instance(self.manager)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        valid = re.compile('^[a-z][a-z0-9-]*$')
+        self.users = [p.pw_name for p in pwd.getpwall() if valid.match(p.pw_name)][:args.users]
+        for user in self.users:
+            with Client(self.config.bind_socket, user=user) as client:
+                op = client.init(self.fingerprint)
+                while True:
+                    info = client.operation_wait(op, 10)
+                    if info['state'] == 'failure':
+                        raise Exception('failed to create container for {}: {}'.format(user, info['error']))
+                    if info['state'] == 'success':
+                        break
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.manager._stop()
+        self.lxd.stop()
+
+    def call(self, op, worker, i):
+        user = self.users[(worker.id + i) % len(self.users)]
+        if op == 'boot_and_host':
+            worker.proxy.boot_and_host('{}{}'.format(user, self.config.domain_suffix), False)
+        elif op == 'boot_and_ip':
+            worker.proxy.boot_and_ip(user)
+        elif op == 'status':
+            worker.user_proxy(user).status()
+        elif op == 'ports':
+            client = worker.user_proxy(user)
+            iport = 10000 + worker.id
+            client.add_port(iport, 0)
+            client.remove_port(iport)
+
+    def run(self, op):
+        latencies = []
+        errors = []
+        counter = iter(range(self.args.requests))
+        counter_lock = threading.Lock()
+
+        def work(worker):
+            while True:
+                with counter_lock:
+                    i = next(counter, None)
+                if i is None:
+                    break
+
+                start = time.perf_counter()
+                try:
+                    self.call(op, worker, i)
+                except Exception as ex:
+                    errors.append(ex)
+                latencies.append(time.perf_counter() - start)
+
+        workers = [Worker(n, self.config.bind_socket) for n in range(self.args.concurrency)]
+        threads = [threading.Thread(target=work, args=(w,)) for w in workers]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        if errors:
+            logging.warning('%s: %d errors (first: %s)', op, len(errors), errors[0])
+        latencies.sort()
+        return {
+            'requests': len(latencies),
+            'errors': len(errors),
+            'throughput': len(latencies) / elapsed,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+        }
+
+class Worker:
+    def __init__(self, id_, socket_path):
+        self.id = id_
+        self.socket_path = socket_path
+        self.proxy = UnixServerProxy(socket_path)
+        self.user_proxies = {}
+
+    def user_proxy(self, user):
+        if user not in self.user_proxies:
+            self.user_proxies[user] = Client(self.socket_path, user=user)
+        return self.user_proxies[user]
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Number of concurrent clients')
+    parser.add_argument('-n', '--requests', type=int, default=1000, help='Number of requests per operation')
+    parser.add_argument('-o', '--ops', default=','.join(OPS), help='Comma separated operations to run')
+    parser.add_argument('--users', type=int, default=16, help='Maximum number of users (containers)')
+    parser.add_argument('--run-limit', type=int, default=8, help='Daemon run_limit')
+    parser.add_argument('--memory-budget', type=int, default=0,
+                        help='Memory (in MiB) containers may use, fake containers use 64 MiB (0 to only use --run-limit)')
+    parser.add_argument('--bridge', default='',
+                        help="Give containers fixed addresses on this bridge (the fake LXD's is lxdbr0)")
+    parser.add_argument('--boot-delay', type=float, default=0.05, help='Simulated container boot time (seconds)')
+    parser.add_argument('--stop-delay', type=float, default=0.01, help='Simulated container stop time (seconds)')
+    parser.add_argument('--startup-delay', type=int, default=0, help='Containers\' startup_delay option')
+    parser.add_argument('--api-latency', type=float, default=0, help='Latency added to every LXD API call (seconds)')
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--compare', help='Compare results against a previous --json file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show daemon logs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='[{asctime:s}] {levelname:s}: {message:s}', style='{')
+    if getpass.getuser() not in grp.getgrnam(ADMIN_GROUP).gr_mem:
+        parser.error('you must be a member of the {} group'.format(ADMIN_GROUP))
+
+    bench = Bench(args)
+    results = {}
+    try:
+        for op in args.ops.split(','):
+            results[op] = bench.run(op)
+    finally:
+        bench.stop()
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    print('{:<14} {:>8} {:>7} {:>12} {:>10} {:>10}'.format('operation', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+    for op, r in results.items():
+        line = '{:<14} {:>8} {:>7} {:>12.1f} {:>10.3f} {:>10.3f}'.format(
+            op, r['requests'], r['errors'], r['throughput'], r['p50'] * 1000, r['p99'] * 1000)
+        if op in previous:
+            p = previous[op]
+            line += '  ({:+.1f}% req/s, {:+.1f}% p50, {:+.1f}% p99)'.format(
+                (r['throughput'] / p['throughput'] - 1) * 100,
+                (r['p50'] / p['p50'] - 1) * 100 if p['p50'] else 0,
+                (r['p99'] / p['p99'] - 1) * 100 if p['p99'] else 0)
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Compare the user-space TCP proxy against nftables forwarding.
+
+Builds three network namespaces on the local machine (client <-> host <-> container),
+runs `webspace-tcp-proxy` and a stand-in `webspaced` in the host namespace and a
+TCP sink in the container namespace, then measures throughput and round-trip
+latency through a forwarded port with each backend. Must be run as root from the
+root of the repo:
+
+    python -m bench.netns_forwarding --proxy-bin tcp-proxy/target/release/webspace-tcp-proxy
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+NS_CLIENT = 'wsb-client'
+NS_HOST = 'wsb-host'
+NS_CT = 'wsb-ct'
+HOST_CLIENT_IP = '10.234.1.1'
+CLIENT_IP = '10.234.1.2'
+HOST_CT_IP = '10.234.2.1'
+CT_IP = '10.234.2.2'
+SINK_PORT = 5001
+EPORT = 50001
+
+def sh(*args, check=True):
+    return subprocess.run(args, check=check)
+def in_ns(ns, *args):
+    return ['ip', 'netns', 'exec', ns] + list(args)
+def self_cmd(*args):
+    return [sys.executable, '-m', 'bench.netns_forwarding'] + list(args)
+
+def setup():
+    teardown()
+    for ns in (NS_CLIENT, NS_HOST, NS_CT):
+        sh('ip', 'netns', 'add', ns)
+        sh(*in_ns(ns, 'ip', 'link', 'set', 'lo', 'up'))
+
+    for ns, ns_ip, host_ip, name in ((NS_CLIENT, CLIENT_IP, HOST_CLIENT_IP, 'cl'),
+                                     (NS_CT, CT_IP, HOST_CT_IP, 'ct')):
+        sh('ip', 'link', 'add', 'wsb-'+name, 'netns', NS_HOST, 'type', 'veth', 'peer', 'name', 'eth0', 'netns', ns)
+        sh(*in_ns(NS_HOST, 'ip', 'addr', 'add', host_ip+'/24', 'dev', 'wsb-'+name))
+        sh(*in_ns(NS_HOST, 'ip', 'link', 'set', 'wsb-'+name, 'up'))
+        sh(*in_ns(ns, 'ip', 'addr', 'add', ns_ip+'/24', 'dev', 'eth0'))
+        sh(*in_ns(ns, 'ip', 'link', 'set', 'eth0', 'up'))
+        sh(*in_ns(ns, 'ip', 'route', 'add', 'default', 'via', host_ip))
+    sh(*in_ns(NS_HOST, 'sysctl', '-qw', 'net.ipv4.ip_forward=1'))
+def teardown():
+    for ns in (NS_CLIENT, NS_HOST, NS_CT):
+        sh('ip', 'netns', 'del', ns, check=False)
+
+def sink(args):
+    """TCP sink in the container namespace."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', args.port))
+    listener.listen(128)
+
+    def handle(conn, addr):
+        with conn:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            mode = conn.recv(1)
+            if mode == b't':
+                total = 0
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    total += len(data)
+                conn.sendall('{} {}\n'.format(total, addr[0]).encode('ascii'))
+            elif mode == b'p':
+                while True:
+                    data = conn.recv(64)
+                    if not data:
+                        break
+                    conn.sendall(data)
+
+    while True:
+        conn, addr = listener.accept()
+        threading.Thread(target=handle, args=(conn, addr), daemon=True).start()
+
+def client(args):
+    """Throughput / latency client in the client namespace."""
+    payload = b'\0' * 65536
+    to_send = args.size * 1024 * 1024
+
+    sock = socket.create_connection((HOST_CLIENT_IP, args.port))
+    sock.sendall(b't')
+    start = time.perf_counter()
+    sent = 0
+    while sent < to_send:
+        sock.sendall(payload)
+        sent += len(payload)
+    sock.shutdown(socket.SHUT_WR)
+    received, peer = sock.makefile().readline().split()
+    elapsed = time.perf_counter() - start
+    sock.close()
+    if int(received) != sent:
+        raise Exception('sink received {} bytes, expected {}'.format(received, sent))
+
+    sock = socket.create_connection((HOST_CLIENT_IP, args.port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(b'p')
+    rtts = []
+    for _ in range(args.pings):
+        t = time.perf_counter()
+        sock.sendall(b'x')
+        sock.recv(1)
+        rtts.append(time.perf_counter() - t)
+    sock.close()
+    rtts.sort()
+
+    print('{:.1f} {} {:.1f} {:.1f}'.format(sent / elapsed / 1e6, peer,
+                                          rtts[len(rtts) // 2] * 1e6, rtts[int(len(rtts) * 0.99)] * 1e6))
+
+def host(args):
+    """Runs the proxy (and nftables) in the host namespace and drives the client."""
+    from webspace_ng.unixrpc import ThreadedUnixRPCServer
+    from webspace_ng.daemon.tcp_proxy import TcpProxy
+    from webspace_ng.daemon.nft import NftForwarding
+
+    sock_path = os.path.join(tempfile.mkdtemp(), 'webspaced.socket')
+    server = ThreadedUnixRPCServer(sock_path, logRequests=False)
+    server.register_function(lambda _user: CT_IP, 'boot_and_ip')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    proxy = TcpProxy(args.proxy_bin, sock_path)
+    proxy.add_forwarding(EPORT, 'bench', SINK_PORT)
+
+    def run_client(label, expected_peer):
+        out = subprocess.run(in_ns(NS_CLIENT, *self_cmd('client', '--port', str(EPORT),
+                                                         '--size', str(args.size), '--pings', str(args.pings))),
+                             check=True, stdout=subprocess.PIPE, encoding='utf8').stdout
+        mbps, peer, p50, p99 = out.split()
+        if peer != expected_peer:
+            raise Exception('{}: sink saw connection from {}, expected {}'.format(label, peer, expected_peer))
+        print('{:<10} {:>10} MB/s  rtt p50 {:>8} us  p99 {:>8} us'.format(label, mbps, p50, p99))
+
+    try:
+        # Connections through the proxy originate from the host
+        run_client('proxy', HOST_CT_IP)
+
+        nft = NftForwarding(proxy, table='wsb')
+        nft.container_started('bench', CT_IP)
+        # DNAT preserves the client's address
+        run_client('nftables', CLIENT_IP)
+
+        nft.container_stopped('bench')
+        run_client('fallback', HOST_CT_IP)
+        nft.stop()
+    finally:
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--proxy-bin', default='tcp-proxy/target/release/webspace-tcp-proxy',
+                        help='Path to the TCP proxy binary')
+    parser.add_argument('--size', type=int, default=1024, help='MiB to transfer per run')
+    parser.add_argument('--pings', type=int, default=2000, help='Number of round trips to time')
+    parser.add_argument('--port', type=int, default=SINK_PORT)
+    parser.add_argument('role', nargs='?', default='main', choices=('main', 'host', 'sink', 'client'))
+    args = parser.parse_args()
+
+    if args.role == 'sink':
+        return sink(args)
+    if args.role == 'client':
+        return client(args)
+    if args.role == 'host':
+        return host(args)
+
+    setup()
+    sink_proc = subprocess.Popen(in_ns(NS_CT, *self_cmd('sink', '--port', str(SINK_PORT))))
+    try:
+        time.sleep(0.5)
+        subprocess.run(in_ns(NS_HOST, *self_cmd('host', '--proxy-bin', os.path.abspath(args.proxy_bin),
+                                                '--size', str(args.size), '--pings', str(args.pings))),
+                       check=True)
+    finally:
+        sink_proc.terminate()
+        teardown()
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,8 @@ return {
 	https_error_sock = 'unix:/var/run/openresty-https-error.sock',
 	https_502_sock = 'unix:/var/run/openresty-https-502.sock',
 	memcached_sock = 'unix:/tmp/memcached.sock',
+	-- How often (in seconds) traffic stats are sent to webspaced
+	stats_interval = 10,
 	non_webspace_names = {
 		["www.my.website"] = true,
 		["my.website"] = true,
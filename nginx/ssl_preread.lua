@@ -29,7 +29,12 @@ local function memc_close()
 end
 
 local server_name = ngx.var.ssl_preread_server_name
-local res, err = rpc.call(constants.webspaced_sock, 'boot_and_host', server_name, true)
+-- $request_id isn't available in the stream module
+local trace_id = string.format('%x-%s-%d', ngx.worker.pid(), ngx.var.connection, math.floor(ngx.now() * 1000))
+local start = ngx.now()
+local res, err = rpc.call(constants.webspaced_sock, 'boot_and_host', server_name, true, trace_id)
+ngx.update_time()
+ngx.log(ngx.INFO, 'boot_and_host took ', (ngx.now() - start) * 1000, 'ms (trace ', trace_id, ')')
 if not res then
   ngx.log(ngx.ERR, json.encode(err))
   shared:set('peer', constants.https_error_sock)
@@ -7,6 +7,7 @@ local messages = {
   webspaced_user = 'This user does not exist',
   webspaced_iface = 'Container network interface unavailable',
   webspaced_ip = 'Container is unreachable (no IP address)',
+  webspaced_unavailable = 'Webspaces are temporarily unavailable, please try again shortly',
   ['502'] = 'Failed to connect to container over HTTP. Is there a server listening on your configured port?',
   ssl_source = 'Failed to retrieve SSL source address from memcached',
   ssl_502 = 'Failed to connect to container over HTTPS (custom SSL cert). Is there a server listening on your configured port?',
@@ -67,7 +67,11 @@ elseif ssl_cached then
   end
 else
   ngx.log(ngx.DEBUG, '_not_ using cached webspace value from ssl preread')
-  local res, err = rpc.call(constants.webspaced_sock, 'boot_and_host', ngx.var.host, false)
+  local trace_id = ngx.var.request_id
+  local start = ngx.now()
+  local res, err = rpc.call(constants.webspaced_sock, 'boot_and_host', ngx.var.host, false, trace_id)
+  ngx.update_time()
+  ngx.log(ngx.INFO, 'boot_and_host took ', (ngx.now() - start) * 1000, 'ms (trace ', trace_id, ')')
   if not res then
     ngx.log(ngx.ERR, json.encode(err))
     memc_close()
@@ -0,0 +1,113 @@
+-- Per-host traffic telemetry, aggregated in the `webspace_stats` shared dict by
+-- `log_by_lua` and sent to webspaced in batches by a timer (see `start()`), so
+-- requests never wait on the daemon.
+--
+-- Keys are `<generation>\t<host>\t<field>`. Each flush starts a new generation and
+-- sends everything from before the previous one, so no worker can still be adding
+-- to what's sent. If webspaced can't be reached the counts are kept for next time.
+local rpc = require('unixrpc')
+local json = require('json')
+local constants = require('constants')
+
+local stats = ngx.shared.webspace_stats
+
+local _M = {}
+
+local function incr(key, value)
+  local ok, err = stats:incr(key, value, 0)
+  if not ok and err ~= 'no memory' then
+    ngx.log(ngx.WARN, 'failed to record traffic: ', err)
+  end
+end
+
+-- Total of the times (in seconds) in an `$upstream_*_time` variable (one for each
+-- upstream tried), nil if no upstream was used
+local function upstream_time(value)
+  if not value then
+    return nil
+  end
+  local total
+  for t in value:gmatch('%d+%.?%d*') do
+    total = (total or 0) + tonumber(t)
+  end
+  return total
+end
+
+local function record(host, status, bytes_in, bytes_out, latency)
+  if not host or #host > 253 or not host:match('^[%w%.%-]+$') then
+    return
+  end
+  local prefix = (stats:get('generation') or 0)..'\t'..host:lower()..'\t'
+  incr(prefix..'requests', 1)
+  incr(prefix..'bytes_in', bytes_in or 0)
+  incr(prefix..'bytes_out', bytes_out or 0)
+  if status and status >= 100 and status < 600 then
+    incr(prefix..'status_'..math.floor(status / 100)..'xx', 1)
+  end
+  if latency then
+    incr(prefix..'upstream_time', math.floor(latency * 1000 + 0.5))
+    incr(prefix..'upstream_requests', 1)
+  end
+end
+
+function _M.log_http()
+  local var = ngx.var
+  record(var.host, tonumber(var.status), tonumber(var.request_length), tonumber(var.bytes_sent),
+         upstream_time(var.upstream_response_time))
+end
+
+function _M.log_stream()
+  local var = ngx.var
+  -- Connections handed to the http server (SSL termination and error pages) are counted there
+  local upstream = var.upstream_addr
+  if not upstream or upstream:sub(1, 5) == 'unix:' then
+    return
+  end
+  record(var.ssl_preread_server_name, tonumber(var.status), tonumber(var.bytes_received),
+         tonumber(var.bytes_sent), upstream_time(var.upstream_connect_time))
+end
+
+local function flush(premature)
+  if premature then
+    return
+  end
+  local generation = stats:incr('generation', 1, 0)
+
+  local traffic, keys = {}, {}
+  for _, key in ipairs(stats:get_keys(0)) do
+    local gen, host, field = key:match('^(%d+)\t([^\t]+)\t(.+)$')
+    if gen and tonumber(gen) < generation - 1 then
+      local value = stats:get(key)
+      if value then
+        traffic[host] = traffic[host] or {}
+        traffic[host][field] = (traffic[host][field] or 0) + value
+        keys[#keys + 1] = key
+      end
+    end
+  end
+  if #keys == 0 then
+    return
+  end
+
+  local res, err = rpc.call(constants.webspaced_sock, 'record_traffic', traffic)
+  if not res then
+    ngx.log(ngx.ERR, 'failed to send traffic stats to webspaced: ', json.encode(err))
+    return
+  end
+  for _, key in ipairs(keys) do
+    stats:delete(key)
+  end
+end
+
+-- Called from `init_worker_by_lua`, only the first worker sends stats
+function _M.start()
+  if ngx.worker.id() ~= 0 then
+    return
+  end
+  local ok, err = ngx.timer.every(constants.stats_interval, flush)
+  if not ok then
+    ngx.log(ngx.ERR, 'failed to start traffic stats timer: ', err)
+  end
+end
+
+return _M
@@ -9,7 +9,7 @@ setuptools.setup(
     author="Jack O'Sullivan",
     author_email='jackos1998@gmail.com',
     description='Next generation webspace management',
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=['bench', 'bench.*']),
     install_requires=requirements,
     entry_points={
         'console_scripts': [
@@ -4,9 +4,13 @@ use std::collections::HashMap;
 use std::env;
 use std::process;
 use std::thread;
-use std::io::{self, Read, Write};
+use std::sync::{Arc, Mutex};
+use std::time::{Duration, Instant};
+use std::fs::File;
+use std::io::{self, BufRead, BufReader, Read, Write};
 use std::net::{AddrParseError, Ipv4Addr, SocketAddr, TcpStream, TcpListener};
-use std::os::unix::io::{AsRawFd, RawFd};
+use std::os::unix::io::{AsRawFd, FromRawFd, RawFd};
+use std::os::unix::net::UnixListener;
 
 use quick_error::quick_error;
 use nix::errno::Errno;
@@ -81,8 +85,8 @@ quick_error! {
         }
 
         Usage(arg0: String) {
-            description("usage: tcp-proxy <webspaced socket path>")
-            display("usage: {} <webspaced socket path>", arg0)
+            description("usage: tcp-proxy <webspaced socket path> [control socket path]")
+            display("usage: {} <webspaced socket path> [control socket path]", arg0)
         }
         Quit
         InvalidCommand(reason: &'static str) {
@@ -107,6 +111,145 @@ quick_error! {
 type Result<T> = std::result::Result<T, Error>;
 
 const BUFFER_SIZE: usize = 65536;
+// Maximum number of idle buffers kept around per forwarded port
+const POOL_SIZE: usize = 32;
+// How often (in ms) a throttled listener checks if it can accept again
+const THROTTLE_INTERVAL: i32 = 100;
+
+#[derive(Clone, Copy)]
+struct Limits {
+    port_conns: usize,
+    user_conns: usize,
+    idle_timeout: Option<Duration>,
+    lifetime: Option<Duration>,
+}
+impl Limits {
+    pub fn unlimited() -> Limits {
+        Limits {
+            port_conns: 0,
+            user_conns: 0,
+            idle_timeout: None,
+            lifetime: None,
+        }
+    }
+    pub fn parse(args: &[&str]) -> Result<Limits> {
+        let timeout = |s: &str| -> Result<Option<Duration>> {
+            let secs: u64 = s.parse()?;
+            Ok(if secs == 0 { None } else { Some(Duration::from_secs(secs)) })
+        };
+
+        Ok(Limits {
+            port_conns: args[0].parse()?,
+            user_conns: args[1].parse()?,
+            idle_timeout: timeout(args[2])?,
+            lifetime: timeout(args[3])?,
+        })
+    }
+}
+
+// Current limits, shared between all forwardings so changes apply to existing ones too
+type SharedLimits = Arc<Mutex<Limits>>;
+
+// Number of open connections per user, shared between all forwardings
+type UserConns = Arc<Mutex<HashMap<String, usize>>>;
+
+struct ConnSlot {
+    users: UserConns,
+    user: String,
+}
+impl ConnSlot {
+    pub fn available(users: &UserConns, user: &str, limit: usize) -> bool {
+        limit == 0 || users.lock().expect("user conns lock").get(user).cloned().unwrap_or(0) < limit
+    }
+    pub fn claim(users: &UserConns, user: &str, limit: usize) -> Option<ConnSlot> {
+        let mut counts = users.lock().expect("user conns lock");
+        let count = counts.get(user).cloned().unwrap_or(0);
+        if limit != 0 && count >= limit {
+            return None;
+        }
+
+        counts.insert(user.to_owned(), count + 1);
+        Some(ConnSlot {
+            users: users.clone(),
+            user: user.to_owned(),
+        })
+    }
+}
+impl Drop for ConnSlot {
+    fn drop(&mut self) {
+        let mut counts = self.users.lock().expect("user conns lock");
+        let remove = match counts.get_mut(&self.user) {
+            Some(count) => {
+                *count -= 1;
+                *count == 0
+            },
+            None => false,
+        };
+        if remove {
+            counts.remove(&self.user);
+        }
+    }
+}
+
+// Buffers are only held by a connection while they contain data in flight,
+// idle connections don't use any buffer memory
+struct BufPool {
+    free: Vec<BytesMut>,
+}
+impl BufPool {
+    pub fn new() -> BufPool {
+        BufPool {
+            free: Vec::new(),
+        }
+    }
+
+    pub fn get(&mut self) -> BytesMut {
+        self.free.pop().unwrap_or_else(|| BytesMut::with_capacity(BUFFER_SIZE))
+    }
+    pub fn put(&mut self, mut buf: BytesMut) {
+        if self.free.len() < POOL_SIZE {
+            buf.clear();
+            buf.reserve(BUFFER_SIZE);
+            self.free.push(buf);
+        }
+    }
+}
+
+fn has_data(buf: &Option<BytesMut>) -> bool {
+    buf.as_ref().map_or(false, |b| !b.is_empty())
+}
+fn fill(sock: &mut TcpStream, buf: &mut Option<BytesMut>, pool: &mut BufPool) -> Result<()> {
+    let mut b = buf.take().unwrap_or_else(|| pool.get());
+    let read = match unsafe { sock.read(b.bytes_mut()) } {
+        Ok(read) => read,
+        Err(e) => {
+            pool.put(b);
+            return Err(e.into());
+        },
+    };
+    if read == 0 {
+        pool.put(b);
+        return Err(Error::ConnClosed);
+    }
+
+    unsafe {
+        b.advance_mut(read);
+    }
+    *buf = Some(b);
+    Ok(())
+}
+fn flush(sock: &mut TcpStream, buf: &mut Option<BytesMut>, pool: &mut BufPool) -> Result<()> {
+    if let Some(mut b) = buf.take() {
+        let written = sock.write(&b)?;
+        b.split_to(written);
+        if b.is_empty() {
+            pool.put(b);
+        } else {
+            *buf = Some(b);
+        }
+    }
+    Ok(())
+}
 
 struct UnixXmlrpc {
     uri: hyper::Uri,
@@ -155,18 +298,26 @@ impl xmlrpc::Transport for UnixXmlrpc {
 
 struct ForwardingConn {
     src: TcpStream,
-    src_buf: BytesMut,
+    src_buf: Option<BytesMut>,
 
     dst: TcpStream,
-    dst_buf: BytesMut,
+    dst_buf: Option<BytesMut>,
+
+    created: Instant,
+    last_active: Instant,
+    _slot: ConnSlot,
 }
 impl ForwardingConn {
-    pub fn new(src: TcpStream, dst: TcpStream) -> ForwardingConn {
+    pub fn new(src: TcpStream, dst: TcpStream, slot: ConnSlot) -> ForwardingConn {
+        let now = Instant::now();
         ForwardingConn {
             src,
-            src_buf: BytesMut::with_capacity(BUFFER_SIZE),
+            src_buf: None,
             dst,
-            dst_buf: BytesMut::with_capacity(BUFFER_SIZE),
+            dst_buf: None,
+            created: now,
+            last_active: now,
+            _slot: slot,
         }
     }
 
@@ -177,12 +328,12 @@ impl ForwardingConn {
         let mut src_flags = EventFlags::POLLPRI;
         let mut dst_flags = EventFlags::POLLPRI;
 
-        if self.src_buf.is_empty() {
+        if !has_data(&self.src_buf) {
             src_flags.insert(EventFlags::POLLIN);
         } else {
             dst_flags.insert(EventFlags::POLLOUT);
         }
-        if self.dst_buf.is_empty() {
+        if !has_data(&self.dst_buf) {
             dst_flags.insert(EventFlags::POLLIN);
         } else {
             src_flags.insert(EventFlags::POLLOUT);
@@ -191,37 +342,36 @@ impl ForwardingConn {
         list.push(PollFd::new(self.src.as_raw_fd(), src_flags));
         list.push(PollFd::new(self.dst.as_raw_fd(), dst_flags));
     }
-    pub fn update(&mut self, src: PollFd, dst: PollFd) -> Result<()> {
+    pub fn update(&mut self, src: PollFd, dst: PollFd, pool: &mut BufPool) -> Result<()> {
         let src_flags = src.revents().expect("src flags");
         if src_flags.contains(EventFlags::POLLOUT) {
-            self.src.write(&self.dst_buf)?;
-            self.dst_buf.clear();
+            flush(&mut self.src, &mut self.dst_buf, pool)?;
         } else if src_flags.contains(EventFlags::POLLIN) {
-            unsafe {
-                let read = self.src.read(self.src_buf.bytes_mut())?;
-                if read == 0 {
-                    return Err(Error::ConnClosed);
-                }
-                self.src_buf.advance_mut(read);
-            }
+            fill(&mut self.src, &mut self.src_buf, pool)?;
         }
 
         let dst_flags = dst.revents().expect("dst flags");
         if dst_flags.contains(EventFlags::POLLOUT) {
-            self.dst.write(&self.src_buf)?;
-            self.src_buf.clear();
+            flush(&mut self.dst, &mut self.src_buf, pool)?;
         } else if dst_flags.contains(EventFlags::POLLIN) {
-            unsafe {
-                let read = self.dst.read(self.dst_buf.bytes_mut())?;
-                if read == 0 {
-                    return Err(Error::ConnClosed);
-                }
-                self.dst_buf.advance_mut(read);
-            }
+            fill(&mut self.dst, &mut self.dst_buf, pool)?;
         }
 
+        if !src_flags.is_empty() || !dst_flags.is_empty() {
+            self.last_active = Instant::now();
+        }
         Ok(())
     }
+
+    // The point in time at which this connection will be closed
+    pub fn deadline(&self, limits: &Limits) -> Option<Instant> {
+        let idle = limits.idle_timeout.map(|t| self.last_active + t);
+        let lifetime = limits.lifetime.map(|t| self.created + t);
+        match (idle, lifetime) {
+            (Some(i), Some(l)) => Some(if i < l { i } else { l }),
+            (i, l) => i.or(l),
+        }
+    }
 }
 
 struct ForwardingInner {
@@ -233,10 +383,19 @@ struct ForwardingInner {
     listener: TcpListener,
     conns: HashMap<(SocketAddr, SocketAddr), ForwardingConn>,
     stop_fd: RawFd,
+    // Signalled when `shared_limits` changes
+    limits_fd: RawFd,
+
+    // Our copy of `shared_limits`, so it doesn't need locking on every poll
+    limits: Limits,
+    shared_limits: SharedLimits,
+    users: UserConns,
+    pool: BufPool,
 }
 impl ForwardingInner {
-    pub fn new(stop_fd: RawFd, webspaced_sock: &str, eport: u16, user: String, iport: u16) -> Result<ForwardingInner> {
+    pub fn new(stop_fd: RawFd, limits_fd: RawFd, webspaced_sock: &str, eport: u16, user: String, iport: u16, limits: SharedLimits, users: UserConns) -> Result<ForwardingInner> {
         let listener = TcpListener::bind(("::", eport))?;
+        let current = *limits.lock().expect("limits lock");
         Ok(ForwardingInner {
             webspaced_sock: webspaced_sock.to_owned(),
             eport,
@@ -245,7 +404,13 @@ impl ForwardingInner {
 
             listener,
             conns: HashMap::new(),
-            stop_fd, 
+            stop_fd,
+            limits_fd,
+
+            limits: current,
+            shared_limits: limits,
+            users,
+            pool: BufPool::new(),
         })
     }
 
@@ -258,7 +423,32 @@ impl ForwardingInner {
             None => Err(Error::Rpc("server did not return a string".to_string())),
         }
     }
+    // When at a connection limit we stop accepting, leaving new connections
+    // in the listen backlog until a slot frees up
+    fn can_accept(&self) -> bool {
+        (self.limits.port_conns == 0 || self.conns.len() < self.limits.port_conns) &&
+            ConnSlot::available(&self.users, &self.user, self.limits.user_conns)
+    }
+    fn poll_timeout(&self, accepting: bool) -> i32 {
+        let now = Instant::now();
+        let mut timeout = match self.conns.values().filter_map(|c| c.deadline(&self.limits)).min() {
+            Some(deadline) if deadline > now => {
+                let ms = (deadline - now).as_millis() + 1;
+                if ms > i32::max_value() as u128 { i32::max_value() } else { ms as i32 }
+            },
+            Some(_) => 0,
+            None => -1,
+        };
+        if !accepting && (timeout < 0 || timeout > THROTTLE_INTERVAL) {
+            timeout = THROTTLE_INTERVAL;
+        }
+        timeout
+    }
     fn new_conn(&mut self) -> Result<()> {
+        let slot = match ConnSlot::claim(&self.users, &self.user, self.limits.user_conns) {
+            Some(slot) => slot,
+            None => return Ok(()),
+        };
         let (src, src_addr) = self.listener.accept()?;
         src.set_nodelay(true)?;
 
@@ -267,27 +457,46 @@ impl ForwardingInner {
         dst.set_nodelay(true)?;
 
         println!("conn from {} -> {}", src_addr, dst_addr);
-        self.conns.insert((src.local_addr().expect("src local addr"), dst.local_addr().expect("dst local addr")), ForwardingConn::new(src, dst));
+        self.conns.insert((src.local_addr().expect("src local addr"), dst.local_addr().expect("dst local addr")), ForwardingConn::new(src, dst, slot));
         Ok(())
     }
     pub fn run(&mut self) -> Result<()> {
         let mut to_remove = Vec::new();
         loop {
-            let mut fds = vec![PollFd::new(self.stop_fd, EventFlags::POLLIN), PollFd::new(self.listener.as_raw_fd(), EventFlags::POLLIN | EventFlags::POLLPRI)];
+            let accepting = self.can_accept();
+            let listener_flags = if accepting { EventFlags::POLLIN | EventFlags::POLLPRI } else { EventFlags::empty() };
+            let mut fds = vec![
+                PollFd::new(self.stop_fd, EventFlags::POLLIN),
+                PollFd::new(self.limits_fd, EventFlags::POLLIN),
+                PollFd::new(self.listener.as_raw_fd(), listener_flags),
+            ];
             for conn in self.conns.values_mut() {
                 conn.add_polls(&mut fds);
             }
 
-            poll(&mut fds[..], -1)?;
+            poll(&mut fds[..], self.poll_timeout(accepting))?;
 
             if !fds[0].revents().expect("stop_fd revents").is_empty() {
                 println!("removing port {} forward", self.eport);
                 break;
             }
+            if !fds[1].revents().expect("limits_fd revents").is_empty() {
+                // Reset the eventfd's counter before reading the limits, so an update made
+                // in between wakes us up again
+                let mut count = [0u8; 8];
+                unistd::read(self.limits_fd, &mut count)?;
+                self.limits = *self.shared_limits.lock().expect("limits lock");
+            }
 
-            let mut i = 2;
+            let mut i = 3;
+            let now = Instant::now();
             for conn in self.conns.values_mut() {
-                match conn.update(fds[i], fds[i+1]) {
+                match conn.update(fds[i], fds[i+1], &mut self.pool) {
+                    Ok(()) if conn.deadline(&self.limits).map_or(false, |d| d <= now) => {
+                        let addrs = conn.addrs().expect("connection addresses");
+                        println!("conn timed out {:?}", addrs);
+                        to_remove.push(addrs);
+                    },
                     Ok(()) => {},
                     Err(e) => {
                         let addrs = conn.addrs().expect("connection addresses");
@@ -300,7 +509,7 @@ impl ForwardingInner {
                 }
                 i += 2;
             }
-            if !fds[1].revents().expect("listening socket revents").is_empty() {
+            if accepting && !fds[2].revents().expect("listening socket revents").is_empty() {
                 match self.new_conn() {
                     Ok(_) => {},
                     Err(e) => println!("error opening forwarding connection from {} -> {}: {}", self.eport, self.iport, e),
@@ -320,36 +529,62 @@ impl ForwardingInner {
 }
 
 struct Forwarding {
+    user: String,
+    iport: u16,
     stop_fd: RawFd,
+    limits_fd: RawFd,
     handle: thread::JoinHandle<Result<()>>,
 }
 impl Forwarding {
-    pub fn new(webspaced_sock: &str, eport: u16, user: &str, iport: u16) -> Result<Forwarding> {
+    pub fn new(webspaced_sock: &str, eport: u16, user: &str, iport: u16, limits: SharedLimits, users: UserConns) -> Result<Forwarding> {
         let stop_fd = eventfd(0, EfdFlags::empty()).expect("eventfd()");
-        let mut inner = ForwardingInner::new(stop_fd, webspaced_sock, eport, user.to_owned(), iport)?;
+        let limits_fd = eventfd(0, EfdFlags::empty()).expect("eventfd()");
+        let mut inner = match ForwardingInner::new(stop_fd, limits_fd, webspaced_sock, eport, user.to_owned(), iport, limits, users) {
+            Ok(inner) => inner,
+            Err(e) => {
+                let _ = unistd::close(stop_fd);
+                let _ = unistd::close(limits_fd);
+                return Err(e);
+            },
+        };
         let handle = thread::spawn(move || inner.run());
 
         Ok(Forwarding {
+            user: user.to_owned(),
+            iport,
             stop_fd,
+            limits_fd,
             handle,
         })
     }
 
+    // Tell the forwarding thread to pick up the new shared limits
+    pub fn update_limits(&self) -> Result<()> {
+        unistd::write(self.limits_fd, &1u64.to_ne_bytes())?;
+        Ok(())
+    }
     pub fn stop(self) -> Result<()> {
         unistd::write(self.stop_fd, &1u64.to_ne_bytes())?;
-        self.handle.join().expect("thread panicked")
+        let res = self.handle.join().expect("thread panicked");
+        unistd::close(self.stop_fd)?;
+        unistd::close(self.limits_fd)?;
+        res
     }
 }
 
 struct Proxy {
     ports: HashMap<u16, Forwarding>,
     webspaced_sock: String,
+    limits: SharedLimits,
+    users: UserConns,
 }
 impl Proxy {
     pub fn new(webspaced_sock: &str) -> Proxy {
         Proxy {
             ports: HashMap::new(),
             webspaced_sock: webspaced_sock.to_owned(),
+            limits: Arc::new(Mutex::new(Limits::unlimited())),
+            users: Arc::new(Mutex::new(HashMap::new())),
         }
     }
 
@@ -366,12 +601,28 @@ impl Proxy {
                 }
 
                 let eport: u16 = args[1].parse()?;
-                if self.ports.contains_key(&eport) {
+                let iport: u16 = args[3].parse()?;
+                if let Some(existing) = self.ports.get(&eport) {
+                    // Re-adding the same forwarding (e.g. after the daemon re-attaches) is a no-op
+                    if existing.user == args[2] && existing.iport == iport {
+                        return Ok(());
+                    }
                     return Err(Error::AlreadyForwarded(eport));
                 }
-                let iport: u16 = args[3].parse()?;
 
-                self.ports.insert(eport, Forwarding::new(&self.webspaced_sock, eport, args[2], iport)?);
+                self.ports.insert(eport, Forwarding::new(&self.webspaced_sock, eport, args[2], iport, self.limits.clone(), self.users.clone())?);
+            },
+            "limits" => {
+                if args.len() != 5 {
+                    return Err(Error::InvalidCommand("usage: limits <max port conns> <max user conns> <idle timeout> <max lifetime>"));
+                }
+
+                // Existing connections which are now over the idle timeout or lifetime are
+                // closed, but those over the (new) connection limits are left open
+                *self.limits.lock().expect("limits lock") = Limits::parse(&args[1..])?;
+                for forwarding in self.ports.values() {
+                    forwarding.update_limits()?;
+                }
             },
             "remove" => {
                 if args.len() != 2 {
@@ -384,6 +635,17 @@ impl Proxy {
                     None => return Err(Error::NotForwarded(eport)),
                 }
             },
+            "retain" => {
+                // Remove every forwarding not listed
+                let mut keep = Vec::new();
+                for arg in &args[1..] {
+                    keep.push(arg.parse::<u16>()?);
+                }
+                let remove: Vec<_> = self.ports.keys().filter(|p| !keep.contains(p)).cloned().collect();
+                for eport in remove {
+                    self.ports.remove(&eport).expect("forwarding").stop()?;
+                }
+            },
             _ => return Err(Error::InvalidCommand("unknown command")),
         }
 
@@ -397,9 +659,38 @@ impl Proxy {
     }
 }
 
+// Handle commands from `input` (replying on `output`) until it's closed, returns `true`
+// if we should quit
+fn serve<R: Read + AsRawFd, W: Write>(proxy: &mut Proxy, quit_fd: RawFd, input: R, output: &mut W) -> Result<bool> {
+    // Our own buffered reader (instead of `io::stdin()`) so we can tell if commands which
+    // were written in one go are still buffered, in which case the fd won't poll as readable
+    let input_fd = input.as_raw_fd();
+    let mut input = BufReader::new(input);
+    let mut fds = [PollFd::new(quit_fd, EventFlags::POLLIN), PollFd::new(input_fd, EventFlags::POLLIN | EventFlags::POLLPRI)];
+    loop {
+        if input.buffer().is_empty() {
+            poll(&mut fds, -1)?;
+            if !fds[0].revents().expect("signalfd revents").is_empty() {
+                return Ok(true);
+            }
+        }
+
+        let mut line = String::new();
+        if input.read_line(&mut line)? == 0 {
+            // Input was closed
+            return Ok(false);
+        }
+        let args: Vec<_> = line.trim().split(" ").collect();
+        match proxy.handle_command(&args[..]) {
+            Err(Error::Quit) => return Ok(true),
+            Ok(_) => writeln!(output, "ok")?,
+            Err(e) => writeln!(output, "error: {}", e)?,
+        }
+    }
+}
 fn run() -> Result<()> {
     let mut args: Vec<_> = env::args().collect();
-    if args.len() != 2 {
+    if args.len() != 2 && args.len() != 3 {
         return Err(Error::Usage(args.remove(0)));
     }
 
@@ -410,25 +701,49 @@ fn run() -> Result<()> {
     let quit_fd = SignalFd::new(&sigmask)?;
 
     let mut proxy = Proxy::new(&args[1]);
-    let stdin = io::stdin();
-    let mut fds = [PollFd::new(quit_fd.as_raw_fd(), EventFlags::POLLIN), PollFd::new(stdin.as_raw_fd(), EventFlags::POLLIN | EventFlags::POLLPRI)];
-    loop {
-        match poll(&mut fds, -1) {
-            Ok(_) => {},
-            Err(e) => return Err(e.into()),
-        };
-        if !fds[0].revents().expect("signalfd revents").is_empty() {
-            break;
+    if args.len() == 2 {
+        // Commands on stdin, results on stderr, quit when stdin is closed
+        let stdin = unsafe { File::from_raw_fd(libc::STDIN_FILENO) };
+        serve(&mut proxy, quit_fd.as_raw_fd(), stdin, &mut io::stderr())?;
+    } else {
+        // Commands over a control socket, keep running (and forwarding) when the daemon
+        // disconnects so it can be restarted and re-attach
+        if let Err(e) = std::fs::remove_file(&args[2]) {
+            if e.kind() != io::ErrorKind::NotFound {
+                return Err(e.into());
+            }
         }
+        let listener = UnixListener::bind(&args[2])?;
+        let mut fds = [PollFd::new(quit_fd.as_raw_fd(), EventFlags::POLLIN), PollFd::new(listener.as_raw_fd(), EventFlags::POLLIN)];
+        loop {
+            poll(&mut fds, -1)?;
+            if !fds[0].revents().expect("signalfd revents").is_empty() {
+                break;
+            }
 
-        let mut line = String::new();
-        stdin.read_line(&mut line)?;
-        let args: Vec<_> = line.trim().split(" ").collect();
-        match proxy.handle_command(&args[..]) {
-            Err(Error::Quit) => break,
-            Ok(_) => eprintln!("ok"),
-            Err(e) => eprintln!("error: {}", e),
+            // Errors talking to the daemon (e.g. it went away mid-command) only detach it,
+            // the forwardings keep running
+            let accepted = listener.accept().and_then(|(conn, _)| {
+                let output = conn.try_clone()?;
+                Ok((conn, output))
+            });
+            let (conn, mut output) = match accepted {
+                Ok(conn) => conn,
+                Err(e) => {
+                    println!("error accepting daemon connection: {}", e);
+                    // Don't spin if it's persistent (e.g. out of fds)
+                    thread::sleep(Duration::from_millis(THROTTLE_INTERVAL as u64));
+                    continue;
+                },
+            };
+            println!("daemon attached");
+            match serve(&mut proxy, quit_fd.as_raw_fd(), conn, &mut output) {
+                Ok(true) => break,
+                Ok(false) => println!("daemon detached"),
+                Err(e) => println!("daemon detached: {}", e),
+            }
         }
+        std::fs::remove_file(&args[2])?;
     }
 
     println!("shutting down");
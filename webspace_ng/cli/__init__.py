@@ -12,7 +12,8 @@ def main():
                         help="Path to the daemon's Unix socket",
                         default='/var/lib/webspace-ng/unix.socket')
     current_user = pwd.getpwuid(os.geteuid()).pw_name
-    if current_user in grp.getgrnam(ADMIN_GROUP).gr_mem:
+    is_admin = current_user in grp.getgrnam(ADMIN_GROUP).gr_mem
+    if is_admin:
         parser.add_argument('-u', '--user', help='User to perform operations as',
                             default=current_user)
 
@@ -24,20 +25,46 @@ def main():
     p_init = subparsers.add_parser('init', help='Create your container',
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     p_init.add_argument('image',
-                        help='Image alias / fingerprint to create your container from')
+                        help='Image alias / fingerprint (or unique prefix) to create your container from')
+    p_init.add_argument('-d', '--detach', action='store_true', help="Don't wait for the container to be created")
     p_init.set_defaults(func=init)
 
     p_status = subparsers.add_parser('status', help='Show the status of your container')
+    p_status.add_argument('-H', '--history', action='store_true',
+                          help='Show recent resource usage (CPU, memory, disk, processes and network)')
+    p_status.add_argument('-w', '--watch', action='store_true', help='Keep showing resource usage as it changes')
     p_status.set_defaults(func=status)
 
+    p_stats = subparsers.add_parser('stats', help='Show the web traffic your container has served')
+    p_stats.set_defaults(func=stats)
+
     p_shutdown = subparsers.add_parser('log', help="Retrieve your container's system log")
     p_shutdown.set_defaults(func=log)
 
     p_exec = subparsers.add_parser('exec', help='Run a command in your container')
+    p_exec.add_argument('-b', '--batch', action='store_true',
+                        help="Run without a terminal (stdin is empty, stdout and stderr are kept separate and the \
+                        command's exit status is returned)")
+    p_exec.add_argument('-t', '--timeout', type=int, default=0,
+                        help='Give up waiting for a batch command after this many seconds')
     p_exec.add_argument('command', help='Command to run')
     p_exec.add_argument('args', nargs=argparse.REMAINDER, help='Command arguments')
     p_exec.set_defaults(func=exec)
 
+    p_push = subparsers.add_parser('push', help='Copy a file (or directory) into your container')
+    p_push.add_argument('source', help='Local path')
+    p_push.add_argument('destination', help='Absolute path in your container (or a directory to copy into)')
+    p_push.add_argument('-r', '--recursive', action='store_true', help='Copy directories recursively')
+    p_push.add_argument('--resume', action='store_true', help='Continue files which were partially copied')
+    p_push.set_defaults(func=push)
+
+    p_pull = subparsers.add_parser('pull', help='Copy a file (or directory) out of your container')
+    p_pull.add_argument('source', help='Absolute path in your container')
+    p_pull.add_argument('destination', help='Local path (or a directory to copy into)')
+    p_pull.add_argument('-r', '--recursive', action='store_true', help='Copy directories recursively')
+    p_pull.add_argument('--resume', action='store_true', help='Continue files which were partially copied')
+    p_pull.set_defaults(func=pull)
+
     p_console = subparsers.add_parser('console', help="Attach to your container's console")
     p_console.set_defaults(func=console)
 
@@ -46,14 +73,22 @@ def main():
     p_exec.set_defaults(func=login)
 
     p_shutdown = subparsers.add_parser('shutdown', help='Shutdown your container')
+    p_shutdown.add_argument('-d', '--detach', action='store_true', help="Don't wait for the shutdown to finish")
     p_shutdown.set_defaults(func=shutdown)
 
     p_reboot = subparsers.add_parser('reboot', help='Reboot your container')
+    p_reboot.add_argument('-d', '--detach', action='store_true', help="Don't wait for the reboot to finish")
     p_reboot.set_defaults(func=reboot)
 
     p_delete = subparsers.add_parser('delete', help='Delete your container')
+    p_delete.add_argument('-d', '--detach', action='store_true', help="Don't wait for the container to be deleted")
     p_delete.set_defaults(func=delete)
 
+    p_operation = subparsers.add_parser('operation', help='Check on a background operation (e.g. creating your container)')
+    p_operation.add_argument('id', help='Operation ID')
+    p_operation.add_argument('-w', '--wait', action='store_true', help='Wait for the operation to finish')
+    p_operation.set_defaults(func=operation)
+
     p_config = subparsers.add_parser('config', help="Change your container's options")
     p_config.set_defaults(func=config_show)
     cfg_sub = p_config.add_subparsers(dest='cfg_command')
@@ -79,8 +114,14 @@ def main():
 
     dns_add = dns_sub.add_parser('add', help='Add a custom domain')
     dns_add.add_argument('domain', help='Domain to add')
+    dns_add.add_argument('-w', '--wait', action='store_true', help='Wait for the domain to be verified')
     dns_add.set_defaults(func=domains_add)
 
+    dns_verify = dns_sub.add_parser('verify', help="Check a custom domain's verification (TXT record)")
+    dns_verify.add_argument('domain', help='Domain to verify')
+    dns_verify.add_argument('-w', '--wait', action='store_true', help='Wait for the result')
+    dns_verify.set_defaults(func=domains_verify)
+
     dns_remove = dns_sub.add_parser('remove', help='Remove a custom domain')
     dns_remove.add_argument('domain', help='Domain to remove')
     dns_remove.set_defaults(func=domains_remove)
@@ -104,5 +145,31 @@ def main():
     p_tutorial = subparsers.add_parser('tutorial', help='Simple tutorial setup')
     p_tutorial.set_defaults(func=tutorial)
 
+    if is_admin:
+        p_profile = subparsers.add_parser('profile', help='(Admin) Profile the daemon for a number of seconds',
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        p_profile.add_argument('seconds', help='How long to profile for', type=int)
+        p_profile.add_argument('-m', '--mode', choices=('sample', 'cprofile'), default='sample',
+                               help='Sample thread stacks (collapsed flame graph format) or cProfile RPC calls')
+        p_profile.add_argument('-o', '--output', help='File to write the profile to (default stdout)')
+        p_profile.set_defaults(func=profile)
+
+        p_refresh = subparsers.add_parser('refresh-users', help="(Admin) Clear the daemon's user / group cache")
+        p_refresh.set_defaults(func=refresh_users)
+
+        p_fleet = subparsers.add_parser('fleet-exec', help="(Admin) Run a command in many users' containers",
+                                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        p_fleet.add_argument('--users', type=lambda s: s.split(','), default=[],
+                             help='Comma separated users whose containers to run the command in (default all)')
+        p_fleet.add_argument('-p', '--parallel', type=int, default=0,
+                             help='Number of containers to run the command in at once (default the server maximum)')
+        p_fleet.add_argument('-t', '--timeout', type=int, default=0,
+                             help='Give up waiting for the command after this many seconds in each container')
+        p_fleet.add_argument('-b', '--boot', action='store_true', help='Start containers which are not running')
+        p_fleet.add_argument('-d', '--detach', action='store_true', help="Don't wait for the command to finish")
+        p_fleet.add_argument('command', help='Command to run')
+        p_fleet.add_argument('args', nargs=argparse.REMAINDER, help='Command arguments')
+        p_fleet.set_defaults(func=fleet_exec)
+
     args = parser.parse_args()
     args.func(args)
@@ -8,15 +8,21 @@ import socket
 import select
 import shutil
 import getpass
+import posixpath
+import stat
+import time
 
 from humanfriendly import format_size
 from eventfd import EventFD
 
 from .. import WebspaceError
+from ..transfer import send_json, recv_json, send_data, recv_data
 from .client import Client
 
 CONSOLE_ESCAPE = b'\x1d'
 CONSOLE_ESCAPE_QUIT = b'q'
+# How long each request waits for an operation to finish (between progress updates)
+OPERATION_POLL = 1
 
 def ask(question, default="yes"):
     """Ask a yes/no question via input() and return their answer.
@@ -50,34 +56,31 @@ def ask(question, default="yes"):
             print("Please respond with 'yes' or 'no' "
                              "(or 'y' or 'n').")
 
-class process:
-    def __init__(self, message, done=' done.'):
-        self.message = message
-        self.done = done
-    def __enter__(self):
-        print(self.message, end='')
-        sys.stdout.flush()
-        return self
-    def __exit__(self, ex_type, e_value, trace):
-        if not e_value:
-            print(self.done)
-        else:
-            print()
-
-def find_image(client, id_):
-    image_list = client.images()
-    # First try to find it by an alias
-    for i in image_list:
-        for a in i['aliases']:
-            if a['name'] == id_:
-                return i
+def follow(client, args, op_id, message, done=' done.'):
+    """Show an operation's progress until it finishes, unless the user detaches (with -d or CTRL+C)."""
+    if getattr(args, 'detach', False):
+        print('{} (running in the background, see `webspace operation {}`)'.format(message, op_id))
+        return None
 
-    # Otherwise by fingerprint
-    for i in image_list:
-        if i['fingerprint'] == id_:
-            return i
-
-    return None
+    tty = sys.stdout.isatty()
+    print(message, end='', flush=True)
+    try:
+        while True:
+            info = client.operation_wait(op_id, OPERATION_POLL)
+            if tty and info['progress']:
+                print('\r\x1b[K{} {}'.format(message, info['progress']), end='', flush=True)
+            if info['state'] == 'success':
+                if tty:
+                    print('\r\x1b[K' + message, end='')
+                print(done)
+                return info
+            if info['state'] == 'failure':
+                print()
+                raise WebspaceError(info['error'])
+    except KeyboardInterrupt:
+        print()
+        print('Detached, the operation will continue in the background (see `webspace operation {}`)'.format(op_id))
+        sys.exit(0)
 
 def cmd(f):
     @wraps(f)
@@ -92,6 +95,17 @@ def cmd(f):
                 print('Error: {}'.format(ex), file=sys.stderr)
     return wrapper
 
+def admin_cmd(f):
+    @wraps(f)
+    def wrapper(args):
+        # Admin-only calls don't take a user argument
+        with Client(args.socket_path) as client:
+            try:
+                return f(client, args)
+            except Exception as ex:
+                print('Error: {}'.format(ex), file=sys.stderr)
+    return wrapper
+
 @cmd
 def images(client, _args):
     image_list = client.images()
@@ -107,15 +121,38 @@ def images(client, _args):
 
 @cmd
 def init(client, args):
-    with process('Creating your container...', done=' success!'):
-        image = find_image(client, args.image)
-        if image is None:
-            raise WebspaceError('"{}" is not a valid image alias / fingerprint'.format(args.image))
+    follow(client, args, client.init(args.image), 'Creating your container...', done=' success!')
 
-        client.init(image['fingerprint'])
+def print_samples(samples, header=True):
+    if header:
+        print('{:<10}{:>8}{:>12}{:>12}{:>7}{:>12}{:>12}'.format('Time', 'CPU', 'Memory', 'Disk', 'Procs',
+                                                              'Received/s', 'Sent/s'))
+    for t, cpu, memory, disk, processes, rx, tx in samples:
+        print('{:<10}{:>7.1f}%{:>12}{:>12}{:>7}{:>12}{:>12}'.format(
+            time.strftime('%H:%M:%S', time.localtime(t)), cpu, format_size(memory, binary=True),
+            format_size(disk, binary=True), processes, format_size(rx, binary=True), format_size(tx, binary=True)))
 
 @cmd
-def status(client, _args):
+def status(client, args):
+    if args.history or args.watch:
+        history = client.status_history()
+        if not history['samples'] and not args.watch:
+            print('No resource usage has been recorded for your container yet')
+            return
+        print_samples(history['samples'])
+        if not args.watch:
+            return
+
+        since = history['samples'][-1][0] if history['samples'] else 0
+        try:
+            while True:
+                samples = client.status_history(since, 2 * history['interval'])['samples']
+                if samples:
+                    print_samples(samples, header=False)
+                    since = samples[-1][0]
+        except KeyboardInterrupt:
+            return
+
     info = client.status()
     print('Container status: {}'.format(info['status']))
     if info['disk']:
@@ -137,6 +174,22 @@ def status(client, _args):
                 print('   IPv{} address: {}/{}'.format('6' if addr['family'] == 'inet6' else '4',
                                                     addr['address'], addr['netmask']))
 
+@cmd
+def stats(client, _args):
+    traffic = client.stats()
+    if not traffic:
+        print('No web traffic has been recorded for your container yet')
+        return
+    print('Since {}:'.format(time.strftime('%Y-%m-%d %H:%M', time.localtime(traffic['since']))))
+    print('Requests: {}'.format(traffic['requests']))
+    print('Responses: {}'.format(', '.join('{}xx: {}'.format(c, traffic['status_{}xx'.format(c)])
+                                           for c in range(1, 6))))
+    print('Received/sent: {}/{}'.format(format_size(traffic['bytes_in'], binary=True),
+                                        format_size(traffic['bytes_out'], binary=True)))
+    if traffic['upstream_requests']:
+        print('Average response time: {:.1f}ms'.format(traffic['upstream_time'] / traffic['upstream_requests']))
+    print('Last request: {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(traffic['last_request']))))
+
 @cmd
 def log(client, _args):
     print(client.log())
@@ -211,28 +264,119 @@ def _console(client, command=None, environment={}):
 
 @cmd
 def exec(client, args):
-    _console(client, command=[args.command] + args.args)
+    if not args.batch:
+        _console(client, command=[args.command] + args.args)
+        return
+
+    # Not using `follow()`, stdout and stderr are the command's
+    op_id = client.exec_batch([args.command] + args.args, {}, args.timeout)
+    try:
+        info = client.operation_wait(op_id, OPERATION_POLL)
+        while info['state'] not in ('success', 'failure'):
+            info = client.operation_wait(op_id, OPERATION_POLL)
+    except KeyboardInterrupt:
+        print('Detached, the command will continue in the background (see `webspace operation {}`)'.format(op_id),
+              file=sys.stderr)
+        sys.exit(0)
+    if info['state'] == 'failure':
+        raise WebspaceError(info['error'])
+
+    result, = info['result'].values()
+    sys.stdout.write(result['stdout'])
+    sys.stderr.write(result['stderr'])
+    if result['truncated']:
+        print('Warning: output was truncated', file=sys.stderr)
+    sys.exit(result['status'])
+def _connect(sock_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sock_path)
+    return sock
+
+@cmd
+def push(client, args):
+    source = os.path.abspath(args.source)
+    if os.path.isdir(source) and not os.path.islink(source) and not args.recursive:
+        raise WebspaceError('{} is a directory (use -r to push it)'.format(args.source))
+
+    files = total = 0
+    with _connect(client.push(args.destination, os.path.basename(source))) as sock:
+        def push_entry(local, rel):
+            nonlocal files, total
+            st = os.lstat(local)
+            if stat.S_ISLNK(st.st_mode):
+                send_json(sock, {'path': rel, 'type': 'symlink', 'target': os.readlink(local)})
+            elif stat.S_ISDIR(st.st_mode):
+                send_json(sock, {'path': rel, 'type': 'directory', 'mode': stat.S_IMODE(st.st_mode)})
+            else:
+                send_json(sock, {'path': rel, 'type': 'file', 'mode': stat.S_IMODE(st.st_mode),
+                                 'size': st.st_size, 'resume': args.resume})
+                offset = recv_json(sock)['offset']
+                with open(local, 'rb') as f:
+                    f.seek(offset)
+                    total += send_data(sock, f)
+                files += 1
+            recv_json(sock)
+
+        push_entry(source, '')
+        if args.recursive:
+            for root, dirs, names in os.walk(source):
+                rel_root = os.path.relpath(root, source)
+                for name in sorted(dirs) + sorted(names):
+                    push_entry(os.path.join(root, name), name if rel_root == '.' else posixpath.join(rel_root, name))
+        send_json(sock, {'type': 'end'})
+        recv_json(sock)
+    print('Pushed {} file{} ({})'.format(files, '' if files == 1 else 's', format_size(total, binary=True)))
+
+@cmd
+def pull(client, args):
+    destination = args.destination
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, posixpath.basename(args.source.rstrip('/')) or 'root')
+
+    files = total = 0
+    with _connect(client.pull(args.source)) as sock:
+        while True:
+            entry = recv_json(sock)
+            if entry['type'] == 'end':
+                break
+            local = os.path.join(destination, entry['path']) if entry['path'] else destination
+            if entry['type'] == 'directory':
+                if not args.recursive:
+                    raise WebspaceError('{} is a directory (use -r to pull it)'.format(args.source))
+                os.makedirs(local, exist_ok=True)
+            elif entry['type'] == 'symlink':
+                if os.path.lexists(local):
+                    os.unlink(local)
+                os.symlink(entry['target'], local)
+            else:
+                offset = os.path.getsize(local) if args.resume and os.path.isfile(local) else 0
+                send_json(sock, {'offset': offset})
+                with open(local, 'ab' if offset else 'wb') as f:
+                    for chunk in recv_data(sock):
+                        f.write(chunk)
+                        total += len(chunk)
+                os.chmod(local, entry['mode'])
+                files += 1
+    print('Pulled {} file{} ({})'.format(files, '' if files == 1 else 's', format_size(total, binary=True)))
+
 @cmd
 def console(client, _args):
     _console(client)
 
 @cmd
-def shutdown(client, _args):
-    with process('Shutting your container down...'):
-        client.shutdown()
+def shutdown(client, args):
+    follow(client, args, client.shutdown(), 'Shutting your container down...')
 
 @cmd
-def reboot(client, _args):
-    with process('Rebooting your container...'):
-        client.reboot()
+def reboot(client, args):
+    follow(client, args, client.reboot(), 'Rebooting your container...')
 
 @cmd
-def delete(client, _args):
+def delete(client, args):
     if not ask('Are you sure?', default='no'):
         return
 
-    with process('Deleting your container...'):
-        client.delete()
+    follow(client, args, client.delete(), 'Deleting your container...')
 
 @cmd
 def config_show(client, args):
@@ -253,9 +397,26 @@ def domains_show(client, args):
     print('Container domains:')
     for domain in domains:
         print(' - {}'.format(domain))
+def wait_domain(client, args, status):
+    if args.wait:
+        while status['state'] == 'pending':
+            time.sleep(0.5)
+            status = client.verify_domain(args.domain)
+
+    if status['state'] == 'failed':
+        raise WebspaceError(status['message'])
+    print(status['message'])
 @cmd
 def domains_add(client, args):
-    client.add_domain(args.domain)
+    status = client.add_domain(args.domain)
+    if status['state'] == 'pending' and not args.wait:
+        print("Verifying '{}', it will be added once verified (check with `webspace domains verify {}`)".format(
+            args.domain, args.domain))
+        return
+    wait_domain(client, args, status)
+@cmd
+def domains_verify(client, args):
+    wait_domain(client, args, client.verify_domain(args.domain))
 @cmd
 def domains_remove(client, args):
     client.remove_domain(args.domain)
@@ -276,12 +437,7 @@ def ports_remove(client, args):
 
 @cmd
 def tutorial(client, args):
-    with process('Creating your container...', done=' success!'):
-        image = find_image(client, 'tutorial')
-        if image is None:
-            raise WebspaceError('"{}" is not a valid image alias / fingerprint'.format(args.image))
-
-        client.init(image['fingerprint'])
+    follow(client, args, client.init('tutorial'), 'Creating your container...', done=' success!')
 
     print('Performing initial setup...')
     _console(client, ['/usr/local/bin/first_run'])
@@ -303,3 +459,53 @@ def login(client, _args):
     # `script` is a workaround for LXD's lack of pts allocation with `exec`
     env = {'TERM': os.environ.get('TERM', 'vt100')}
     _console(client, ['script', '-q', '-c', 'su - {}'.format(user), '/dev/null'], environment=env)
+
+@cmd
+def operation(client, args):
+    if args.wait:
+        info = follow(client, args, args.id, 'Waiting for {}...'.format(args.id))
+    else:
+        info = client.operation_status(args.id)
+    print('Operation {}: {} ({})'.format(info['id'], info['action'], info['state']))
+    if info['progress']:
+        print('Progress: {}'.format(info['progress']))
+    if info['error']:
+        print('Error: {}'.format(info['error']))
+    if info['action'] == 'exec' and 'result' in info:
+        print_exec_results(info['result'])
+
+@admin_cmd
+def profile(client, args):
+    print('Profiling for {} seconds...'.format(args.seconds), file=sys.stderr)
+    result = client.profile(args.mode, args.seconds)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(result)
+    else:
+        print(result)
+
+def print_exec_results(results):
+    for user, result in sorted(results.items()):
+        if 'error' in result:
+            print('== {}: {} =='.format(user, result['error']))
+            continue
+        print('== {}: exit status {}{} =='.format(user, result['status'],
+                                                ' (output truncated)' if result['truncated'] else ''))
+        if result['stdout']:
+            print(result['stdout'], end='' if result['stdout'].endswith('\n') else '\n')
+        if result['stderr']:
+            print(result['stderr'], end='' if result['stderr'].endswith('\n') else '\n', file=sys.stderr)
+
+@admin_cmd
+def fleet_exec(client, args):
+    op_id = client.fleet_exec(args.users, [args.command] + args.args, {}, args.parallel, args.timeout, args.boot)
+    # The operation belongs to us
+    with Client(args.socket_path, user=getpass.getuser()) as user_client:
+        info = follow(user_client, args, op_id, 'Running the command...')
+    if info is not None:
+        print_exec_results(info['result'])
+
+@admin_cmd
+def refresh_users(client, _args):
+    admins = client.refresh_users()
+    print('User / group cache cleared, admins: {}'.format(', '.join(admins)))
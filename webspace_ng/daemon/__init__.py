@@ -9,8 +9,10 @@ from os import path
 from munch import Munch
 from ruamel.yaml import YAML
 
-from ..unixrpc import ThreadedUnixRPCServer
+from .. import WebspaceError
+from ..unixrpc import ThreadedUnixRPCServer, systemd_sockets
 from . import webspace
+from .metrics import MetricsServer
 
 is_shutdown = False
 def shutdown():
@@ -42,16 +44,27 @@ def merge(source, destination):
             destination[key] = value
 
     return destination
-def load_config():
-    config = {
+def default_config():
+    return {
         'bind_socket': '/var/lib/webspace-ng/unix.socket',
+        'metrics_socket': '/var/lib/webspace-ng/metrics.socket',
+        'store_file': '/var/lib/webspace-ng/store.db',
         'lxd': {
             'socket': '/var/lib/lxd/unix.socket',
             'profile': 'webspace',
             'suffix': '-ws',
+            'image_ttl': 300,
+            'pool_size': 16,
+            'pool_timeout': 10,
+            'connect_timeout': 5,
+            'timeout': 120,
+            'retries': 2,
+            'breaker_threshold': 5,
+            'breaker_reset': 10,
             'net': {
                 'cidr': '10.233.0.0/24',
-                'container_iface': 'eth0'
+                'container_iface': 'eth0',
+                'bridge': ''
             }
         },
         'defaults': {
@@ -59,15 +72,78 @@ def load_config():
             'startup_delay': '3'
         },
         'domain_suffix': '.ng.localhost',
+        'dns': {
+            'nameservers': [],
+            'port': 53,
+            'timeout': 5,
+            'cache_ttl': 3600,
+            'negative_ttl': 30,
+            'reverify_interval': 86400,
+            'reverify_batch': 16,
+            'reverify_delay': 1,
+            'reverify_failures': 0
+        },
+        'warm_pool': {
+            'images': {},
+            'prefix': 'webspace-warm-'
+        },
+        'operations': {
+            'workers': 4,
+            'keep': 3600
+        },
+        'shutdown': {
+            'timeout': 60,
+            'workers': 8,
+            'persist': False
+        },
+        'nss': {
+            'ttl': 300,
+            'negative_ttl': 30
+        },
         'max_startup_delay': 60,
+        'slow_request_threshold': 1.0,
         'run_limit': 20,
+        'sessions': {
+            'max_per_user': 8,
+            'max': 256,
+            'connect_timeout': 30
+        },
+        'exec': {
+            'timeout': 3600,
+            'max_output': 1048576,
+            'fleet_workers': 16
+        },
+        'sampler': {
+            'interval': 10,
+            'history': 360,
+            'max_wait': 30
+        },
+        'admission': {
+            'enabled': False,
+            'budget': 0,
+            'reserve': 512,
+            'default_usage': 256,
+            'psi_threshold': 0,
+            'max_age': 30,
+            'cgroup': '/sys/fs/cgroup/lxc.payload.{}/memory.current'
+        },
         'ports': {
             'proxy_bin': '/usr/local/bin/webspace-tcp-proxy',
+            'proxy_control': '',
+            'mode': 'proxy',
+            'nft_table': 'webspace',
             'start': 49152,
             'end': 65535,
-            'max': 64
+            'max': 64,
+            'reserved': [],
+            'max_conns': 256,
+            'max_user_conns': 1024,
+            'idle_timeout': 3600,
+            'max_lifetime': 0
         }
     }
+def load_config():
+    config = default_config()
 
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-c', '--config', help='Path to config file', default='/etc/webspaced.yaml')
@@ -106,8 +182,10 @@ def load_config():
         level = logging.DEBUG
     logging.basicConfig(level=level, format='[{asctime:s}] {levelname:s}: {message:s}', style='{')
 
-    if config.run_limit <= 0:
+    if config.run_limit < 0 or (config.run_limit == 0 and not config.admission.enabled):
         raise WebspaceError('Configuration must allow at least one container to run')
+    if config.ports.mode not in ('proxy', 'nftables'):
+        raise WebspaceError('ports.mode must be either "proxy" or "nftables"')
 
     return config
 
@@ -115,7 +193,10 @@ def main():
     config = load_config()
 
     global server
-    server = ThreadedUnixRPCServer(config.bind_socket, allow_none=True)
+    fds = systemd_sockets()
+    if fds:
+        logging.info('using socket passed by systemd')
+    server = ThreadedUnixRPCServer(config.bind_socket, allow_none=True, fd=fds[0] if fds else None)
     manager = webspace.Manager(config, server)
 
     # Shutdown handler
@@ -124,8 +205,17 @@ def main():
 
     server.register_instance(manager)
 
+    metrics_server = None
+    if config.metrics_socket:
+        metrics_server = MetricsServer(config.metrics_socket, lambda user: user in manager.admins)
+        metrics_server.start()
+
     # RPC main loop
     server.serve_forever()
+    # Waits for requests in progress to finish
     server.server_close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
 
     manager._stop()
@@ -0,0 +1,57 @@
+import hashlib
+import ipaddress
+import threading
+
+from .. import WebspaceError
+
+class AddressAllocator:
+    """
+    Gives each user a fixed IPv4 address in `network`. The first address tried is derived
+    from a hash of the username, so a user keeps the same address when their container is
+    re-created (unless someone else has taken it in the meantime), otherwise the following
+    addresses are tried in turn. Addresses in `reserved` (e.g. the bridge's own) are never
+    handed out. Allocations are persisted by the caller (the `Store`) and re-loaded with
+    `load()` at startup.
+    """
+    def __init__(self, network, reserved=()):
+        self.network = network
+        self.first = int(network.network_address) + 1
+        # Excluding the network and broadcast addresses
+        self.size = network.num_addresses - 2
+        if self.size < 1:
+            raise WebspaceError('{} is too small to give containers their own addresses'.format(network))
+        self.reserved = {str(ip) for ip in reserved}
+
+        self.lock = threading.Lock()
+        # user -> address
+        self.users = {}
+        # address -> user
+        self.taken = {}
+
+    def get(self, user):
+        return self.users.get(user)
+    def load(self, addresses):
+        """Replace all allocations with `addresses` (a dict of user -> address)."""
+        with self.lock:
+            self.users = dict(addresses)
+            self.taken = {ip: user for user, ip in self.users.items()}
+    def allocate(self, user):
+        """Returns the user's address, allocating one if they don't have one yet."""
+        with self.lock:
+            if user in self.users:
+                return self.users[user]
+            start = int.from_bytes(hashlib.sha256(user.encode('utf-8')).digest()[:8], 'big') % self.size
+            for i in range(self.size):
+                ip = str(ipaddress.IPv4Address(self.first + (start + i) % self.size))
+                if ip not in self.taken and ip not in self.reserved:
+                    self.users[user] = ip
+                    self.taken[ip] = user
+                    return ip
+        raise WebspaceError('No addresses left for new containers')
+    def _release(self, user):
+        ip = self.users.pop(user, None)
+        if ip is not None:
+            del self.taken[ip]
+    def release(self, user):
+        with self.lock:
+            self._release(user)
@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+
+from .. import WebspaceError
+
+class NotEnoughMemory(WebspaceError):
+    pass
+
+def host_available():
+    """`MemAvailable` from /proc/meminfo, in bytes."""
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    raise WebspaceError('MemAvailable missing from /proc/meminfo')
+def memory_pressure(path='/proc/pressure/memory'):
+    """The `some avg10` memory pressure stall percentage (0 if PSI isn't available)."""
+    try:
+        with open(path) as pressure:
+            for line in pressure:
+                if line.startswith('some'):
+                    return float(dict(f.split('=') for f in line.split()[1:])['avg10'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return 0
+
+class AdmissionController:
+    """
+    Decides whether a container can boot based on memory rather than a count of running
+    containers, and which running containers (least recently used first) to shut down
+    to make room.
+
+    Memory available to containers is either a fixed `budget` less what running
+    containers use, or (with no budget) the host's available memory. `reserve` bytes are
+    always kept free, and while memory pressure (PSI `some avg10`) is above
+    `psi_threshold` at least one container is evicted. A container is expected to need
+    the most memory it was last seen using, or `default_usage` if it's never been seen.
+    `usage(name)` returns a running container's current memory use, cached for `max_age`
+    seconds.
+    """
+    def __init__(self, usage, budget=0, reserve=0, default_usage=256*1024*1024, psi_threshold=0,
+                 max_age=10, available=host_available, pressure=memory_pressure):
+        self.usage = usage
+        self.budget = budget
+        self.reserve = reserve
+        self.default_usage = default_usage
+        self.psi_threshold = psi_threshold
+        self.max_age = max_age
+        self.available = available
+        self.pressure = pressure
+
+        self.lock = threading.Lock()
+        # name -> (usage, sampled at)
+        self.samples = {}
+        # name -> highest usage seen
+        self.peaks = {}
+
+    def record(self, name, usage):
+        with self.lock:
+            self.samples[name] = (usage, time.monotonic())
+            self.peaks[name] = max(usage, self.peaks.get(name, 0))
+    def current(self, name):
+        sample = self.samples.get(name)
+        if sample is None or time.monotonic() - sample[1] > self.max_age:
+            try:
+                self.record(name, self.usage(name))
+            except Exception as ex:
+                logging.warning('failed to get memory usage of %s: %s', name, ex)
+                if sample is None:
+                    return self.estimate(name)
+            sample = self.samples[name]
+        return sample[0]
+    def estimate(self, name):
+        return self.peaks.get(name, self.default_usage)
+
+    def plan(self, name, running):
+        """
+        Returns the containers in `running` (in eviction order) which must be shut down before
+        `name` can boot, raises `WebspaceError` if it can't fit even if all of them were.
+        """
+        usage = {c: self.current(c) for c in running}
+        if self.budget:
+            free = self.budget - sum(usage.values())
+        else:
+            free = self.available()
+        free -= self.reserve
+        need = self.estimate(name)
+        pressured = self.psi_threshold and self.pressure() > self.psi_threshold
+
+        evict = []
+        for c in running:
+            if free >= need and not pressured:
+                break
+            evict.append(c)
+            free += usage[c]
+            pressured = False
+        if free < need:
+            raise NotEnoughMemory('Not enough memory to start your container')
+        if evict:
+            logging.info('evicting %s to boot %s (needs %d MiB)', ', '.join(evict), name, need // 2**20)
+        return evict
+
+    def forget(self, name):
+        with self.lock:
+            self.samples.pop(name, None)
@@ -12,6 +12,22 @@ from eventfd import EventFD
 from ws4py.client import WebSocketBaseClient
 from ws4py.messaging import TextMessage
 
+def user_socket(user, suffix):
+    """Listen on a Unix socket in /tmp which only `user` can connect to, returns its path and the socket."""
+    socket_path = path.join('/tmp', '{}-ws-{}.socket'.format(user, suffix))
+    try:
+        os.unlink(socket_path)
+    except OSError:
+        if os.path.exists(socket_path):
+            raise
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    sock.listen(1)
+    shutil.chown(socket_path, user=user)
+    os.chmod(socket_path, stat.S_IRWXU)
+    return socket_path, sock
+
 class ConsoleControl(WebSocketBaseClient):
     def __init__(self, ws_uri, resource, *args, **kwargs):
         WebSocketBaseClient.__init__(self, ws_uri, *args, **kwargs)
@@ -37,21 +53,14 @@ class ConsoleControl(WebSocketBaseClient):
         print('control msg', message.data)
 
 class ConsoleSession(WebSocketBaseClient):
-    def __init__(self, user, ws_uri, console_path, control_path, *args, socket_suffix='console', **kwargs):
+    def __init__(self, user, ws_uri, console_path, control_path, *args, socket_suffix='console',
+                 connect_timeout=None, **kwargs):
         self.__shutdown_event = EventFD()
+        self.connect_timeout = connect_timeout
+        # Called once the session has finished
+        self.on_exit = None
 
-        self.socket_path = path.join('/tmp', '{}-ws-{}.socket'.format(user, socket_suffix))
-        try:
-            os.unlink(self.socket_path)
-        except OSError:
-            if os.path.exists(self.socket_path):
-                raise
-
-        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.socket.bind(self.socket_path)
-        self.socket.listen(1)
-        shutil.chown(self.socket_path, user=user)
-        os.chmod(self.socket_path, stat.S_IRWXU)
+        self.socket_path, self.socket = user_socket(user, socket_suffix)
 
         self.control = ConsoleControl(ws_uri, control_path)
         self.control.connect()
@@ -65,7 +74,10 @@ class ConsoleSession(WebSocketBaseClient):
 
     def __accept(self):
         while True:
-            r, _, _ = select.select([self.__shutdown_event, self.socket], [], [])
+            r, _, _ = select.select([self.__shutdown_event, self.socket], [], [], self.connect_timeout)
+            if not r:
+                logging.info('nothing connected to %s after %ds, closing', self.socket_path, self.connect_timeout)
+                break
             if self.__shutdown_event in r:
                 break
             if self.socket in r:
@@ -96,28 +108,32 @@ class ConsoleSession(WebSocketBaseClient):
 
                 self.send(read, binary=True)
     def run_read(self):
-        self.__accept()
-        self.socket.close()
+        try:
+            self.__accept()
+            self.socket.close()
 
-        if self.socket_conn is not None:
-            self.__read_loop()
-            self.socket_conn.close()
+            if self.socket_conn is not None:
+                self.__read_loop()
+                self.socket_conn.close()
 
-        os.unlink(self.socket_path)
+            os.unlink(self.socket_path)
 
-        logging.debug('closing websockets')
-        try:
-            self.control.close()
-            self.close()
-        except:
-            pass
-        self.control.terminate()
-        self.terminate()
+            logging.debug('closing websockets')
+            try:
+                self.control.close()
+                self.close()
+            except:
+                pass
+            self.control.terminate()
+            self.terminate()
+        finally:
+            if self.on_exit is not None:
+                self.on_exit()
 
     def start(self):
         self.run_thread.start()
-    def join(self):
-        self.run_thread.join()
+    def join(self, timeout=None):
+        self.run_thread.join(timeout)
     def stop(self, join=False):
         self.__shutdown_event.set()
         if join:
@@ -0,0 +1,129 @@
+from .. import WebspaceError
+
+class _Node:
+    __slots__ = ('children', 'user', 'wildcards', 'user_suffix')
+    def __init__(self):
+        self.children = {}
+        # User for the domain ending at this node
+        self.user = None
+        # Number of leading `*` labels -> user, e.g. `*.*.example.com` is stored as
+        # `wildcards[2]` on the node for `example.com`
+        self.wildcards = {}
+        # Set on the node for `domain_suffix`, `<user><domain_suffix>` routes to `<user>`
+        self.user_suffix = False
+
+def _labels(domain):
+    return domain.lower().rstrip('.').split('.')
+
+def split_domain(domain):
+    """
+    Split a domain into its number of leading wildcard labels and the remaining (lower case)
+    labels.
+    """
+    labels = _labels(domain)
+    wildcards = 0
+    while wildcards < len(labels) and labels[wildcards] == '*':
+        wildcards += 1
+    rest = labels[wildcards:]
+    if not rest or any(not l or l == '*' for l in rest):
+        raise WebspaceError("'{}' is not a valid domain (wildcards are only allowed as leading labels)".format(domain))
+    return wildcards, rest
+
+class DomainIndex:
+    """
+    Maps hosts to users, indexed by a trie of domain labels (in reverse, i.e. starting
+    from the TLD), so any host is resolved in O(number of labels). In order of precedence,
+    a host matches:
+
+    1. A custom domain exactly
+    2. A wildcard custom domain, each leading `*` matches exactly one label (so
+       `*.example.com` matches `a.example.com` and `*.*.example.com` matches
+       `a.b.example.com`). The wildcard with the longest non-wildcard suffix wins
+    3. `<user><domain_suffix>`, for any user (everything before `domain_suffix`, which
+       might not be a valid username)
+
+    Domains are case-insensitive, they're kept in lower case.
+    """
+    def __init__(self, user_suffix=None):
+        self.user_suffix = user_suffix
+        self.domains = {}
+        self.root = self._build({})
+
+    def _build(self, domains):
+        root = _Node()
+        if self.user_suffix:
+            self._node(root, _labels(self.user_suffix.lstrip('.')), create=True).user_suffix = True
+        for domain, user in domains.items():
+            self._insert(root, domain, user)
+        return root
+    @staticmethod
+    def _node(root, labels, create=False):
+        node = root
+        for label in reversed(labels):
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[label] = _Node()
+            node = child
+        return node
+    def _insert(self, root, domain, user):
+        wildcards, labels = split_domain(domain)
+        node = self._node(root, labels, create=True)
+        if wildcards:
+            node.wildcards[wildcards] = user
+        else:
+            node.user = user
+
+    def load(self, domains):
+        """Replace the whole index with `domains` (a dict of domain -> user)."""
+        domains = {domain.lower(): user for domain, user in domains.items()}
+        root = self._build(domains)
+        self.root, self.domains = root, domains
+    def add(self, domain, user):
+        domain = domain.lower()
+        self._insert(self.root, domain, user)
+        self.domains[domain] = user
+    def remove(self, domain):
+        domain = domain.lower()
+        if domain not in self.domains:
+            raise WebspaceError("'{}' has not been configured as a custom domain".format(domain))
+        wildcards, labels = split_domain(domain)
+        node = self._node(self.root, labels)
+        if wildcards:
+            del node.wildcards[wildcards]
+        else:
+            node.user = None
+        del self.domains[domain]
+
+    def __contains__(self, domain):
+        return domain.lower() in self.domains
+    def get(self, domain):
+        return self.domains.get(domain.lower())
+
+    def lookup(self, host):
+        """
+        Returns `(user, kind)` for the user a host routes to, where `kind` is `domain`,
+        `wildcard` or `suffix`. Returns `(None, None)` if nothing matches.
+        """
+        labels = _labels(host)
+        # Walk down as far as possible, remembering each node along the way
+        path = [self.root]
+        node = self.root
+        for label in reversed(labels):
+            node = node.children.get(label)
+            if node is None:
+                break
+            path.append(node)
+
+        if len(path) == len(labels) + 1 and path[-1].user is not None:
+            return path[-1].user, 'domain'
+        for depth in range(len(path) - 1, 0, -1):
+            user = path[depth].wildcards.get(len(labels) - depth)
+            if user is not None:
+                return user, 'wildcard'
+        # At least one label has to come before the suffix
+        for depth in range(1, min(len(path), len(labels))):
+            if path[depth].user_suffix:
+                return '.'.join(labels[:len(labels) - depth]), 'suffix'
+        return None, None
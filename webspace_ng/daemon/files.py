@@ -0,0 +1,171 @@
+import logging
+import os
+import posixpath
+import select
+import socket
+import threading
+
+from eventfd import EventFD
+from pylxd.exceptions import NotFound
+
+from .. import WebspaceError
+from ..transfer import CHUNK_SIZE, send_frame, send_json, recv_json, recv_data
+from . import metrics
+from .console import user_socket
+
+class FileTransfer:
+    """
+    Streams files between a user and their container (`api` is the container's LXD API
+    node) over a Unix socket, using LXD's file API. The user pushes to or pulls from
+    `path`, see `webspace_ng.transfer` for the protocol. Only one chunk of a file is held
+    in memory at a time.
+    """
+    def __init__(self, user, api, direction, path, name='', socket_suffix='transfer', connect_timeout=None):
+        self.api = api
+        self.direction = direction
+        self.path = path
+        self.name = name
+        self.connect_timeout = connect_timeout
+        # Called once the transfer has finished
+        self.on_exit = None
+
+        self.shutdown_event = EventFD()
+        self.socket_path, self.socket = user_socket(user, socket_suffix)
+        self.conn = None
+        self.thread = threading.Thread(target=self.run)
+
+    def _get(self, path):
+        with metrics.lxd('files.get'):
+            return self.api.files.get(params={'path': path}, stream=True, is_api=False)
+    def _post(self, path, data=b'', **headers):
+        with metrics.lxd('files.post'):
+            self.api.files.post(params={'path': path}, data=data,
+                                headers={'X-LXD-{}'.format(k): v for k, v in headers.items()})
+    def _size(self, path):
+        """Size of the file at `path` (0 if it doesn't exist)."""
+        try:
+            response = self._get(path)
+        except NotFound:
+            return 0
+        with response:
+            if response.headers.get('X-LXD-type', 'file') != 'file':
+                raise WebspaceError('{} is not a file'.format(path))
+            if 'Content-Length' in response.headers:
+                return int(response.headers['Content-Length'])
+            return sum(len(c) for c in response.iter_content(CHUNK_SIZE))
+
+    def _pull(self, path, rel):
+        try:
+            response = self._get(path)
+        except NotFound:
+            raise WebspaceError('{} does not exist'.format(path))
+        with response:
+            type_ = response.headers.get('X-LXD-type', 'file')
+            mode = int(response.headers.get('X-LXD-mode', '644'), 8)
+            if type_ == 'directory':
+                send_json(self.conn, {'path': rel, 'type': 'directory', 'mode': mode})
+                names = response.json()['metadata']
+            elif type_ == 'symlink':
+                send_json(self.conn, {'path': rel, 'type': 'symlink', 'target': response.text.strip()})
+                return
+            else:
+                send_json(self.conn, {'path': rel, 'type': 'file', 'mode': mode})
+                skip = recv_json(self.conn)['offset']
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if skip >= len(chunk):
+                        skip -= len(chunk)
+                        continue
+                    send_frame(self.conn, b'D', chunk[skip:])
+                    skip = 0
+                send_frame(self.conn, b'E')
+                return
+        for name in names:
+            self._pull(posixpath.join(path, name), posixpath.join(rel, name))
+    def pull(self):
+        self._pull(self.path, '')
+        send_json(self.conn, {'type': 'end'})
+
+    def push(self):
+        root = self.path
+        try:
+            with self._get(root) as response:
+                # Pushing into an existing directory
+                if response.headers.get('X-LXD-type') == 'directory' and self.name:
+                    root = posixpath.join(root, self.name)
+        except NotFound:
+            pass
+
+        while True:
+            entry = recv_json(self.conn)
+            if entry['type'] == 'end':
+                send_json(self.conn, {'ok': True})
+                return
+            path = posixpath.join(root, entry['path']) if entry['path'] else root
+            mode = '{:04o}'.format(entry.get('mode', 0o644))
+            if entry['type'] == 'directory':
+                try:
+                    self._post(path, type='directory', mode=mode)
+                except Exception:
+                    # Fine if it already exists
+                    with self._get(path) as response:
+                        if response.headers.get('X-LXD-type') != 'directory':
+                            raise
+            elif entry['type'] == 'symlink':
+                self._post(path, entry['target'].encode('utf-8'), type='symlink')
+            elif entry['type'] == 'file':
+                offset = self._size(path) if entry.get('resume') else 0
+                if offset > entry['size']:
+                    offset = 0
+                send_json(self.conn, {'offset': offset})
+                self._post(path, recv_data(self.conn), type='file', mode=mode,
+                           write='append' if offset else 'overwrite')
+            else:
+                raise WebspaceError('Unknown entry type {}'.format(entry['type']))
+            send_json(self.conn, {'ok': True})
+
+    def accept(self):
+        r, _, _ = select.select([self.shutdown_event, self.socket], [], [], self.connect_timeout)
+        if not r:
+            logging.info('nothing connected to %s after %ds, closing', self.socket_path, self.connect_timeout)
+        elif self.socket in r:
+            self.conn, _ = self.socket.accept()
+    def run(self):
+        try:
+            self.accept()
+            self.socket.close()
+            if self.conn is not None:
+                try:
+                    if self.direction == 'push':
+                        self.push()
+                    else:
+                        self.pull()
+                except Exception as ex:
+                    if not isinstance(ex, (WebspaceError, OSError)):
+                        logging.exception('%s of %s failed', self.direction, self.path)
+                    try:
+                        send_json(self.conn, {'error': str(ex)})
+                    except OSError:
+                        pass
+                self.conn.close()
+        finally:
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            if self.on_exit is not None:
+                self.on_exit()
+
+    def start(self):
+        self.thread.start()
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+    def stop(self, join=False):
+        self.shutdown_event.set()
+        conn = self.conn
+        if conn is not None:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if join:
+            self.join()
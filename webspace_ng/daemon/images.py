@@ -0,0 +1,131 @@
+from bisect import bisect_left
+import json
+import logging
+import threading
+import time
+
+from ws4py.client import WebSocketBaseClient
+
+from .. import WebspaceError
+from . import metrics
+
+def image_info(image):
+    return {
+        'fingerprint': image['fingerprint'],
+        'aliases': image['aliases'],
+        'properties': image['properties'],
+        'size': image['size'],
+    }
+
+class ImageEvents(WebSocketBaseClient):
+    """Calls `on_change()` whenever LXD reports an image (or image alias) lifecycle event."""
+    def __init__(self, ws_uri, on_change, *args, **kwargs):
+        WebSocketBaseClient.__init__(self, ws_uri, *args, **kwargs)
+        self.resource = '/1.0/events?type=lifecycle'
+        self.on_change = on_change
+
+    def received_message(self, message):
+        try:
+            event = json.loads(message.data)
+        except ValueError:
+            return
+        if event.get('metadata', {}).get('action', '').startswith('image'):
+            self.on_change()
+
+class ImageCatalog:
+    """
+    Cache of LXD's images, indexed by alias and fingerprint. Refreshed (with a single
+    request) after `ttl` seconds, when LXD reports an image changing or when looking up
+    an unknown image (at most every `miss_interval` seconds).
+    """
+    def __init__(self, client, ttl=300, miss_interval=5, retry_interval=5):
+        self.client = client
+        self.ttl = ttl
+        self.miss_interval = miss_interval
+        self.retry_interval = retry_interval
+
+        self.lock = threading.Lock()
+        self.images = []
+        # alias -> image
+        self.aliases = {}
+        # Sorted, for looking up by prefix
+        self.fingerprints = []
+        self.by_fingerprint = {}
+        self.refreshed = 0
+        self.expiry = 0
+        self.invalidated = 0
+
+        self.events = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._watch, daemon=True)
+        self.thread.start()
+
+    def _watch(self):
+        while not self.stopped.is_set():
+            try:
+                self.events = ImageEvents(self.client.websocket_url, self.invalidate)
+                self.events.connect()
+                # Anything could have changed while we weren't listening
+                self.invalidate()
+                self.events.run()
+            except Exception as ex:
+                logging.warning('failed to listen for LXD image events: %s', ex)
+            self.stopped.wait(self.retry_interval)
+
+    def invalidate(self):
+        self.invalidated = time.monotonic()
+        self.expiry = 0
+    def _refresh(self):
+        started = time.monotonic()
+        with metrics.lxd('images.all'):
+            images = self.client.api.images.get(params={'recursion': 1}).json()['metadata']
+
+        self.images = [image_info(i) for i in images]
+        self.aliases = {a['name']: i for i in self.images for a in i['aliases']}
+        self.by_fingerprint = {i['fingerprint']: i for i in self.images}
+        self.fingerprints = sorted(self.by_fingerprint)
+        self.refreshed = started
+        # Don't keep the result if an image changed while we were fetching
+        self.expiry = 0 if self.invalidated >= started else started + self.ttl
+    def _current(self):
+        if time.monotonic() >= self.expiry:
+            self._refresh()
+
+    def all(self):
+        with self.lock:
+            self._current()
+            return self.images
+
+    def _find(self, id_):
+        if id_ in self.aliases:
+            return self.aliases[id_]
+
+        i = bisect_left(self.fingerprints, id_)
+        matches = []
+        while i < len(self.fingerprints) and self.fingerprints[i].startswith(id_) and len(matches) < 2:
+            matches.append(self.fingerprints[i])
+            i += 1
+        if len(matches) > 1:
+            raise WebspaceError('"{}" matches more than one image fingerprint'.format(id_))
+        return self.by_fingerprint[matches[0]] if matches else None
+    def resolve(self, id_):
+        """Find an image by alias or (unambiguous) fingerprint prefix."""
+        if not id_:
+            raise WebspaceError('No image alias / fingerprint given')
+        with self.lock:
+            self._current()
+            image = self._find(id_)
+            if image is None and time.monotonic() - self.refreshed >= self.miss_interval:
+                self._refresh()
+                image = self._find(id_)
+        if image is None:
+            raise WebspaceError('"{}" is not a valid image alias / fingerprint'.format(id_))
+        return image
+
+    def stop(self):
+        self.stopped.set()
+        if self.events is not None:
+            try:
+                self.events.close()
+            except Exception:
+                pass
@@ -0,0 +1,202 @@
+import logging
+import random
+import re
+import socket
+import threading
+import time
+from urllib import parse
+
+import requests
+import urllib3
+from urllib3.exceptions import EmptyPoolError
+
+from .. import WebspaceError
+from . import metrics
+
+# LXD reports ordinary failures (e.g. a container that isn't running) as 400 / 500
+RETRY_STATUSES = (502, 503, 504)
+# `wait=True` calls (starting, stopping, deleting containers...) block on this until the operation finishes
+OPERATION_WAIT = re.compile(r'/operations/[^/]+/wait$')
+
+class LXDUnavailable(WebspaceError):
+    pass
+
+class CircuitBreaker:
+    """
+    Stops all LXD calls for `reset_timeout` seconds after `threshold` consecutive calls
+    fail, then lets a single call through to check whether LXD has recovered.
+    """
+    def __init__(self, threshold=5, reset_timeout=10):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+        self.trial = False
+
+    @property
+    def healthy(self):
+        return self.state == 'closed'
+    def allow(self):
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened >= self.reset_timeout:
+                self.state = 'half_open'
+            if self.state == 'half_open':
+                if self.trial:
+                    return False
+                self.trial = True
+            return self.state != 'open'
+    def success(self):
+        with self.lock:
+            if self.state != 'closed':
+                logging.info('LXD has recovered')
+            self.state = 'closed'
+            self.failures = 0
+            self.trial = False
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.threshold):
+                if self.state == 'closed':
+                    logging.error('%d consecutive LXD calls failed, not calling LXD for %ds',
+                                  self.failures, self.reset_timeout)
+                self.state = 'open'
+                self.opened = time.monotonic()
+
+class _UnixConnection(urllib3.connection.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class _UnixConnectionPool(urllib3.HTTPConnectionPool):
+    """At most `maxsize` keep-alive connections to a Unix socket, waiting up to `pool_timeout` for one to be free."""
+    def __init__(self, socket_path, maxsize, pool_timeout, connect_timeout):
+        super().__init__('localhost', maxsize=maxsize, block=True)
+        self.socket_path = socket_path
+        self.pool_timeout = pool_timeout
+        self.connect_timeout = connect_timeout
+        self.count_lock = threading.Lock()
+        self.in_use = 0
+
+    def _new_conn(self):
+        return _UnixConnection(self.socket_path, self.connect_timeout)
+    def _get_conn(self, timeout=None):
+        with metrics.lxd_pool_wait.time():
+            conn = super()._get_conn(self.pool_timeout)
+        with self.count_lock:
+            self.in_use += 1
+        return conn
+    def _put_conn(self, conn):
+        with self.count_lock:
+            self.in_use -= 1
+        super()._put_conn(conn)
+
+    def idle(self):
+        queue = self.pool
+        return 0 if queue is None else sum(1 for c in list(queue.queue) if c is not None)
+
+class LXDAdapter(requests.adapters.HTTPAdapter):
+    """
+    `requests` adapter for LXD's Unix socket, shared by every thread. Keeps a bounded pool
+    of keep-alive connections, applies default timeouts, retries idempotent requests
+    which fail with a connection error (`retries` times, backing off `retry_backoff`
+    seconds with jitter) and fails fast while `breaker` considers LXD unhealthy.
+    Waiting for an LXD operation takes as long as the operation does, so these requests
+    have no read timeout, aren't retried and don't count towards the breaker.
+    """
+    def __init__(self, pool_size=16, pool_timeout=10, connect_timeout=5, read_timeout=120, retries=2,
+                 retry_backoff=0.1, breaker=None):
+        super().__init__()
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+        self.lock = threading.Lock()
+        # socket path -> pool
+        self.pools = {}
+
+        metrics.Gauge('webspaced_lxd_connections', 'Connections to LXD', self._connection_counts, label='state')
+        metrics.Gauge('webspaced_lxd_breaker_open', 'Whether LXD calls are being refused because LXD is unhealthy',
+                      lambda: {None: 0 if self.breaker.healthy else 1})
+
+    def _connection_counts(self):
+        with self.lock:
+            pools = list(self.pools.values())
+        return {
+            'in_use': sum(p.in_use for p in pools),
+            'idle': sum(p.idle() for p in pools),
+        }
+
+    def get_connection(self, url, proxies=None):
+        socket_path = parse.unquote(parse.urlparse(url).netloc)
+        with self.lock:
+            pool = self.pools.get(socket_path)
+            if pool is None:
+                pool = self.pools[socket_path] = _UnixConnectionPool(socket_path, self.pool_size, self.pool_timeout,
+                                                                     self.timeout[0])
+            return pool
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.get_connection(request.url)
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def send(self, request, **kwargs):
+        if request.method == 'GET' and OPERATION_WAIT.search(parse.urlparse(request.url).path):
+            if kwargs.get('timeout') is None:
+                kwargs['timeout'] = (self.timeout[0], None)
+            try:
+                return super().send(request, **kwargs)
+            except EmptyPoolError:
+                raise LXDUnavailable('Timed out waiting for a connection to LXD')
+
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if not self.breaker.allow():
+            metrics.lxd_rejected.inc()
+            raise LXDUnavailable('LXD is unavailable, try again shortly')
+
+        attempts = 1 + (self.retries if request.method in ('GET', 'HEAD') else 0)
+        for attempt in range(attempts):
+            error = response = None
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout, EmptyPoolError) as ex:
+                error = ex
+            except Exception:
+                # Not worth retrying, but still a failure (which also ends a half-open breaker's trial)
+                self.breaker.failure()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.success()
+                    return response
+            if attempt + 1 < attempts:
+                if response is not None:
+                    response.close()
+                metrics.lxd_retries.inc()
+                time.sleep(self.retry_backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+        self.breaker.failure()
+        if isinstance(error, EmptyPoolError):
+            raise LXDUnavailable('Timed out waiting for a connection to LXD')
+        if error is not None:
+            raise error
+        return response
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools.clear()
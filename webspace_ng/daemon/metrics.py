@@ -0,0 +1,205 @@
+import bisect
+import logging
+import os
+import socketserver
+import stat
+import threading
+import time
+
+from ..unixrpc import UnixHTTPRequestHandler
+from . import trace
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _labels(label_name, value, extra=None):
+    pairs = []
+    if label_name is not None:
+        pairs.append('{}="{}"'.format(label_name, str(value).replace('\\', '\\\\').replace('"', '\\"')))
+    if extra is not None:
+        pairs.append(extra)
+    return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+def _fmt(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help_, label=None):
+        self.name = name
+        self.help = help_
+        self.label = label
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def render(self):
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = {}
+
+    def inc(self, label=None, amount=1):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def render(self):
+        lines = super().render()
+        with self.lock:
+            values = list(self.values.items())
+        for label, value in values:
+            lines.append('{}{} {}'.format(self.name, _labels(self.label, label), _fmt(value)))
+        return lines
+
+class Gauge(Metric):
+    """A gauge whose values are computed by `fn` (returning a dict of label -> value) at scrape time."""
+    type = 'gauge'
+
+    def __init__(self, name, help_, fn, label=None):
+        super().__init__(name, help_, label=label)
+        self.fn = fn
+
+    def render(self):
+        lines = super().render()
+        for label, value in self.fn().items():
+            lines.append('{}{} {}'.format(self.name, _labels(self.label, label), _fmt(value)))
+        return lines
+
+class _Timer:
+    __slots__ = ('histogram', 'label', 'errors', 'start')
+    def __init__(self, histogram, label, errors):
+        self.histogram = histogram
+        self.label = label
+        self.errors = errors
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, ex_type, _ex, _trace):
+        elapsed = time.perf_counter() - self.start
+        self.histogram.observe(elapsed, self.label)
+        if self.label is not None:
+            trace.record(self.label, elapsed)
+        if ex_type is not None and self.errors is not None:
+            self.errors.inc(self.label)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # label -> [bucket counts..., sum]
+        self.values = {}
+
+    def observe(self, value, label=None):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(label)
+            if v is None:
+                v = self.values[label] = [0] * (len(self.buckets) + 1)
+            v[i] += 1
+            v[-1] += value
+    def time(self, label=None, errors=None):
+        """Time a block of code, counting exceptions in `errors` (a `Counter`) if given."""
+        return _Timer(self, label, errors)
+
+    def render(self):
+        lines = super().render()
+        with self.lock:
+            values = [(label, list(v)) for label, v in self.values.items()]
+        for label, v in values:
+            total = 0
+            for bound, count in zip(self.buckets, v):
+                total += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(self.label, label, 'le="{}"'.format(_fmt(bound))), total))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(self.label, label), _fmt(v[-1])))
+            lines.append('{}_count{} {}'.format(self.name, _labels(self.label, label), total))
+        return lines
+
+class TimedLock:
+    """Wraps a lock, recording how long callers wait to acquire it."""
+    def __init__(self, lock, histogram):
+        self.lock = lock
+        self.histogram = histogram
+
+    def acquire(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = self.lock.acquire(*args, **kwargs)
+        self.histogram.observe(time.perf_counter() - start)
+        return result
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+    def __exit__(self, _ex_type, _ex, _trace):
+        self.release()
+
+registry = []
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+rpc_duration = Histogram('webspaced_rpc_duration_seconds', 'Time taken to handle RPC calls', label='method')
+rpc_errors = Counter('webspaced_rpc_errors_total', 'RPC calls which raised an exception', label='method')
+lxd_duration = Histogram('webspaced_lxd_duration_seconds', 'Time taken by LXD API calls', label='call')
+lxd_errors = Counter('webspaced_lxd_errors_total', 'LXD API calls which raised an exception', label='call')
+lxd_pool_wait = Histogram('webspaced_lxd_pool_wait_seconds', 'Time spent waiting for a free connection to LXD')
+lxd_retries = Counter('webspaced_lxd_retries_total', 'LXD API calls retried after a connection error or timeout')
+lxd_rejected = Counter('webspaced_lxd_rejected_total', 'LXD API calls refused because LXD is unhealthy')
+lock_wait = Histogram('webspaced_container_lock_wait_seconds', 'Time spent waiting to acquire the container lock')
+boot_duration = Histogram('webspaced_boot_duration_seconds',
+                          'Time taken to boot a container (including any eviction and startup delay)')
+evictions = Counter('webspaced_evictions_total', 'Containers shut down to make room for another to boot',
+                    label='reason')
+warm_pool_claims = Counter('webspaced_warm_pool_claims_total',
+                           'Containers created by whether a pre-created one could be claimed', label='result')
+warm_pool_refill = Histogram('webspaced_warm_pool_refill_seconds',
+                             'Time taken to pre-create a container for the warm pool', label='image')
+
+def lxd(call):
+    """Time an LXD API call."""
+    return lxd_duration.time(call, lxd_errors)
+
+class MetricsRequestHandler(UnixHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug('metrics: %s', format % args)
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        if not self.server.is_admin(self.client_user):
+            self.send_error(403)
+            return
+
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class MetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves metrics in the Prometheus text format at /metrics over HTTP on a Unix socket (admins only)."""
+    daemon_threads = True
+
+    def __init__(self, addr, is_admin, socket_mode=stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO):
+        self.is_admin = is_admin
+
+        try:
+            os.unlink(addr)
+        except OSError:
+            if os.path.exists(addr):
+                raise
+
+        socketserver.UnixStreamServer.__init__(self, addr, MetricsRequestHandler)
+        os.chmod(addr, socket_mode)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
@@ -0,0 +1,129 @@
+import logging
+import subprocess
+import threading
+
+from .. import WebspaceError
+
+class NftError(WebspaceError):
+    pass
+
+class NftForwarding:
+    """
+    Kernel fast path for forwarded ports.
+
+    The user-space proxy (`TcpProxy`) keeps listening on every forwarded port and
+    acts as a stand-in: while a container is stopped, new connections land on the
+    proxy, which boots the container via `boot_and_ip`. Once the container is
+    running and its IP is known, DNAT entries are added to an nftables map so that
+    new connections bypass user space entirely. When the container stops, the
+    entries are removed again and the next SYN wakes it up through the proxy.
+
+    Only IPv4 traffic is DNAT'd, IPv6 clients always go through the proxy.
+    """
+    def __init__(self, proxy, table='webspace', nft_bin='nft'):
+        self.proxy = proxy
+        self.table = table
+        self.nft_bin = nft_bin
+        self.lock = threading.Lock()
+
+        # eport -> (user, iport)
+        self.ports = {}
+        # user -> ip (users whose container is running with a known IP)
+        self.active = {}
+
+        self._nft('delete table ip {}'.format(self.table), check=False)
+        self._nft(
+            'table ip {t} {{\n'
+            '  map fwd {{ type inet_service : ipv4_addr . inet_service; }}\n'
+            '  chain prerouting {{\n'
+            '    type nat hook prerouting priority -100;\n'
+            '    fib daddr type local dnat ip to tcp dport map @fwd\n'
+            '  }}\n'
+            '  chain output {{\n'
+            '    type nat hook output priority -100;\n'
+            '    fib daddr type local dnat ip to tcp dport map @fwd\n'
+            '  }}\n'
+            '  chain postrouting {{\n'
+            '    type nat hook postrouting priority 100;\n'
+            '    ip saddr 127.0.0.0/8 ct status dnat masquerade\n'
+            '  }}\n'
+            '}}\n'.format(t=self.table))
+
+    def _nft(self, script, check=True):
+        result = subprocess.run([self.nft_bin, '-f', '-'], input=script, encoding='utf8',
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if check and result.returncode != 0:
+            raise NftError('nft failed: {}'.format(result.stderr.strip()))
+        return result
+    def _add_elements(self, elements):
+        if elements:
+            self._nft('add element ip {} fwd {{ {} }}'.format(self.table, ', '.join(
+                '{} : {} . {}'.format(eport, ip, iport) for eport, ip, iport in elements)))
+    def _delete_elements(self, eports):
+        if eports:
+            self._nft('delete element ip {} fwd {{ {} }}'.format(self.table, ', '.join(map(str, eports))))
+
+    def add_forwarding(self, eport, user, iport):
+        self.proxy.add_forwarding(eport, user, iport)
+        with self.lock:
+            try:
+                if user in self.active:
+                    self._add_elements([(eport, self.active[user], iport)])
+            except NftError:
+                # Keep the proxy and the kernel in step
+                try:
+                    self.proxy.remove_forwarding(eport)
+                except WebspaceError as ex:
+                    logging.error('%s', ex)
+                raise
+            self.ports[eport] = (user, iport)
+    def add_forwardings(self, forwardings):
+        try:
+            self.proxy.add_forwardings(forwardings)
+        finally:
+            with self.lock:
+                for eport, user, iport in forwardings:
+                    self.ports[eport] = (user, iport)
+                self._add_elements([(eport, self.active[user], iport)
+                                    for eport, user, iport in forwardings if user in self.active])
+    def remove_forwarding(self, eport):
+        with self.lock:
+            user, iport = self.ports[eport]
+            if user in self.active:
+                self._delete_elements([eport])
+            try:
+                self.proxy.remove_forwarding(eport)
+            except WebspaceError:
+                if user in self.active:
+                    self._add_elements([(eport, self.active[user], iport)])
+                raise
+            del self.ports[eport]
+
+    def retain_forwardings(self, eports):
+        self.proxy.retain_forwardings(eports)
+
+    def container_started(self, user, ip):
+        with self.lock:
+            if self.active.get(user) == ip:
+                return
+
+            eports = [eport for eport, (u, _) in self.ports.items() if u == user]
+            if user in self.active:
+                self._delete_elements(eports)
+            self.active[user] = ip
+            logging.debug('enabling kernel forwarding for %s (%s)', user, ip)
+            self._add_elements([(eport, ip, self.ports[eport][1]) for eport in eports])
+    def container_stopped(self, user):
+        with self.lock:
+            if user not in self.active:
+                return
+
+            del self.active[user]
+            logging.debug('disabling kernel forwarding for %s', user)
+            self._delete_elements([eport for eport, (u, _) in self.ports.items() if u == user])
+
+    def stop(self):
+        # A re-attachable proxy keeps forwarding after we exit, so keep the kernel doing the same
+        if not self.proxy.control_path:
+            self._nft('delete table ip {}'.format(self.table), check=False)
+        self.proxy.stop()
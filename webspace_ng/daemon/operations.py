@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+import uuid
+
+from .. import WebspaceError
+
+class Operation:
+    def __init__(self, user, action):
+        self.id = uuid.uuid4().hex[:16]
+        self.user = user
+        self.action = action
+        self.state = 'pending'
+        self.progress = ''
+        self.result = None
+        self.error = ''
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+        self.future = None
+
+    def info(self):
+        info = {
+            'id': self.id,
+            'action': self.action,
+            'state': self.state,
+            'progress': self.progress,
+            'error': self.error,
+            'created': self.created,
+        }
+        if self.result is not None:
+            info['result'] = self.result
+        if self.finished is not None:
+            info['finished'] = self.finished
+        return info
+
+class Operations:
+    """
+    Runs slow container actions (create, delete, shutdown...) on a pool of `workers`
+    threads so they don't tie up RPC threads. Each user may only have one operation in
+    progress at a time, finished operations are kept for `keep` seconds.
+    """
+    def __init__(self, workers=4, keep=3600, max_wait=30):
+        self.keep = keep
+        self.max_wait = max_wait
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='operation')
+
+        self.lock = threading.Lock()
+        # id -> Operation
+        self.operations = {}
+        # user -> Operation in progress
+        self.active = {}
+
+    def _expire(self):
+        cutoff = time.time() - self.keep
+        for op_id, op in list(self.operations.items()):
+            if op.finished is not None and op.finished < cutoff:
+                del self.operations[op_id]
+    def _run(self, op, f, args):
+        op.state = 'running'
+        try:
+            op.result = f(op, *args)
+            op.state = 'success'
+        except Exception as ex:
+            if not isinstance(ex, WebspaceError):
+                logging.exception('%s for %s failed', op.action, op.user)
+            op.error = str(ex)
+            op.state = 'failure'
+        finally:
+            op.progress = ''
+            op.finished = time.time()
+            with self.lock:
+                if self.active.get(op.user) is op:
+                    del self.active[op.user]
+            op.done.set()
+
+    def submit(self, user, action, f, *args):
+        """Run `f(operation, *args)` in the background, returns the `Operation`."""
+        with self.lock:
+            self._expire()
+            active = self.active.get(user)
+            if active is not None:
+                raise WebspaceError('Your container is busy ({} in progress, operation {})'.format(
+                    active.action, active.id))
+            op = Operation(user, action)
+            self.operations[op.id] = op
+            self.active[user] = op
+        op.future = self.pool.submit(self._run, op, f, args)
+        return op
+    def get(self, user, op_id):
+        op = self.operations.get(op_id)
+        if op is None or op.user != user:
+            raise WebspaceError('Operation {} does not exist'.format(op_id))
+        return op
+    def wait(self, user, op_id, timeout):
+        """Wait (at most `max_wait` seconds) for an operation to finish, returns its info."""
+        op = self.get(user, op_id)
+        op.done.wait(max(min(timeout, self.max_wait), 0))
+        return op.info()
+
+    def stop(self, timeout=None):
+        """Cancel operations which haven't started yet and wait for the rest to finish."""
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for op in list(self.operations.values()):
+            if op.future is not None and op.future.cancelled():
+                op.state, op.error = 'failure', 'cancelled, the daemon is shutting down'
+                op.done.set()
+            elif not op.done.is_set():
+                op.done.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
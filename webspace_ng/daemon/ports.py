@@ -0,0 +1,91 @@
+from array import array
+import random
+
+from .. import WebspaceError
+
+class PortAllocator:
+    """
+    Allocates external ports for forwarding in the (inclusive) range `start` - `end` and
+    indexes each user's forwards, limiting each user to `per_user` of them.
+
+    Free ports are kept in an array, along with each port's position in that array, so
+    taking a random port, taking a specific port and freeing one are all O(1). Ports in
+    `reserved` are never handed out. Allocations are persisted by the caller (the `Store`)
+    and re-added with `add()` at startup.
+    """
+    def __init__(self, start, end, per_user, reserved=()):
+        self.start = start
+        self.end = end
+        self.per_user = per_user
+
+        self.free = array('H', range(start, end + 1))
+        # Index of each port in `free` (offset by `start`), -1 if the port isn't free
+        self.positions = array('l', range(end - start + 1))
+        # eport -> (user, iport)
+        self.forwards = {}
+        # user -> {iport: eport}
+        self.users = {}
+
+        self.reserved = set(reserved)
+        for eport in self.reserved:
+            if self.in_range(eport):
+                self._take(eport)
+
+    def in_range(self, eport):
+        return self.start <= eport <= self.end
+    def is_free(self, eport):
+        return self.in_range(eport) and self.positions[eport - self.start] != -1
+    def _take(self, eport):
+        i = self.positions[eport - self.start]
+        last = self.free.pop()
+        if last != eport:
+            self.free[i] = last
+            self.positions[last - self.start] = i
+        self.positions[eport - self.start] = -1
+    def _put(self, eport):
+        if self.in_range(eport) and eport not in self.reserved:
+            self.positions[eport - self.start] = len(self.free)
+            self.free.append(eport)
+
+    def user_ports(self, user):
+        """Returns a user's forwards as a dict of internal port -> external port."""
+        return dict(self.users.get(user, {}))
+
+    def add(self, user, iport, eport):
+        """Record an existing forward (regardless of limits or reservations)."""
+        if eport in self.forwards:
+            self.release(eport)
+        if self.is_free(eport):
+            self._take(eport)
+        self.forwards[eport] = (user, iport)
+        self.users.setdefault(user, {})[iport] = eport
+    def allocate(self, user, iport, eport=0):
+        """Allocate `eport` (or a random port if zero) for a new forward to the user's `iport`."""
+        existing = self.users.get(user, {})
+        if iport in existing:
+            raise WebspaceError('external port {} is already forwarded to port {}'.format(existing[iport], iport))
+        if len(existing) >= self.per_user:
+            raise WebspaceError('you cannot forward any more ports')
+
+        if type(eport) != int or (eport != 0 and not self.in_range(eport)):
+            raise WebspaceError('{} is not a valid port: must be in the range {} - {} (or zero for random)'.format(
+                eport, self.start, self.end))
+        if eport == 0:
+            if not self.free:
+                raise WebspaceError('all ports have been allocated')
+            eport = self.free[random.randrange(len(self.free))]
+        elif eport in self.reserved:
+            raise WebspaceError('external port {} is reserved'.format(eport))
+        elif not self.is_free(eport):
+            raise WebspaceError('external port {} has already been forwarded'.format(eport))
+
+        self.add(user, iport, eport)
+        return eport
+    def release(self, eport):
+        """Free an external port, returns the `(user, iport)` it was forwarded to."""
+        user, iport = self.forwards.pop(eport)
+        del self.users[user][iport]
+        if not self.users[user]:
+            del self.users[user]
+        self._put(eport)
+        return user, iport
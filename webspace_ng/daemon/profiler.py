@@ -0,0 +1,96 @@
+import cProfile
+import collections
+import io
+import pstats
+import sys
+import threading
+import time
+
+from .. import WebspaceError
+
+MAX_DURATION = 300
+
+class Profiler:
+    """
+    On-demand profiling of a running daemon. Only one profile can be taken at a time.
+
+    - `sample` mode periodically snapshots the stacks of all threads and returns them in
+      the "collapsed" format (one `frame;frame;frame count` line per unique stack), suitable
+      for flame graph tools
+    - `cprofile` mode runs cProfile around every RPC call that starts and finishes while
+      profiling and returns the merged statistics, sorted by cumulative time
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = None
+        self.stats_lock = threading.Lock()
+
+    def run(self, mode, seconds, interval=0.005):
+        if seconds <= 0 or seconds > MAX_DURATION:
+            raise WebspaceError('Profiling duration must be between 0 and {} seconds'.format(MAX_DURATION))
+        if mode not in ('sample', 'cprofile'):
+            raise WebspaceError('Profiling mode must be either "sample" or "cprofile"')
+        if not self.lock.acquire(blocking=False):
+            raise WebspaceError('A profile is already being taken')
+
+        try:
+            if mode == 'sample':
+                return self._sample(seconds, interval)
+            return self._cprofile(seconds)
+        finally:
+            self.lock.release()
+
+    def _sample(self, seconds, interval):
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(code.co_filename, code.co_name))
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+
+        return '\n'.join('{} {}'.format(stack, count) for stack, count in stacks.most_common())
+
+    def _cprofile(self, seconds):
+        with self.stats_lock:
+            self.stats = []
+        time.sleep(seconds)
+        with self.stats_lock:
+            profiles, self.stats = self.stats, None
+
+        if not profiles:
+            return 'no calls were made while profiling'
+        out = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=out)
+        for p in profiles[1:]:
+            stats.add(p)
+        stats.sort_stats('cumulative').print_stats(100)
+        return out.getvalue()
+
+    def call(self, f, *args):
+        """Call `f`, profiling it if a cProfile session is active."""
+        if self.stats is None:
+            return f(*args)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python >= 3.12 only allows one active profiler at a time
+            return f(*args)
+        try:
+            return f(*args)
+        finally:
+            profile.disable()
+            profile.create_stats()
+            with self.stats_lock:
+                if self.stats is not None:
+                    self.stats.append(profile)
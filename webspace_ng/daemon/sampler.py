@@ -0,0 +1,145 @@
+from array import array
+import logging
+import threading
+import time
+
+from . import metrics
+
+# Stored for each sample, `cpu` (nanoseconds), `rx` and `tx` (bytes) are cumulative counters. Rates have the
+# same fields, but `cpu` is a percentage of one core and `rx` / `tx` are bytes per second.
+FIELDS = ('time', 'cpu', 'memory', 'disk', 'processes', 'rx', 'tx')
+
+def state_sample(now, state):
+    """Reduce an LXD container state to a tuple of `FIELDS`."""
+    rx = tx = 0
+    for name, iface in (state.get('network') or {}).items():
+        if name != 'lo':
+            rx += iface['counters']['bytes_received']
+            tx += iface['counters']['bytes_sent']
+    return (now, (state.get('cpu') or {}).get('usage', 0), (state.get('memory') or {}).get('usage', 0),
+            sum(d.get('usage', 0) for d in (state.get('disk') or {}).values()), state.get('processes', 0), rx, tx)
+
+class History:
+    """Ring buffer of the last `size` samples of a container, stored as one array per field."""
+    def __init__(self, size):
+        self.size = size
+        self.columns = [array('d' if f == 'time' else 'q', [0]) * size for f in FIELDS]
+        self.next = 0
+        self.count = 0
+
+    def append(self, sample):
+        for column, value in zip(self.columns, sample):
+            column[self.next] = value
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+    def _row(self, i):
+        return tuple(column[i] for column in self.columns)
+    def samples(self):
+        """Samples, oldest first."""
+        start = (self.next - self.count) % self.size
+        return [self._row((start + i) % self.size) for i in range(self.count)]
+
+    def rates(self, since=0):
+        """Turn counters into rates for samples taken after `since`."""
+        rates = []
+        prev = None
+        for sample in self.samples():
+            # A restarted container's counters go back to 0
+            if prev is not None and sample[0] > since and sample[1] >= prev[1]:
+                dt = sample[0] - prev[0]
+                rates.append((sample[0], (sample[1] - prev[1]) / dt / 1e7, sample[2], sample[3], sample[4],
+                              max(sample[5] - prev[5], 0) / dt, max(sample[6] - prev[6], 0) / dt))
+            prev = sample
+        return rates
+
+class ResourceSampler:
+    """
+    Samples the state of all (running) containers whose names end with `suffix` every
+    `interval` seconds in a single LXD request, keeping the last `size` samples of each.
+    The latest full LXD state of every container is kept too, so `status` doesn't need to
+    ask LXD. `on_sample(name, sample)` is called for every new sample and
+    `on_stopped(names)` with the containers which aren't running. `rates` waits at most
+    `max_wait` seconds for a new sample.
+    """
+    def __init__(self, client, suffix, interval=10, size=360, on_sample=None, on_stopped=None, max_wait=30):
+        self.client = client
+        self.suffix = suffix
+        self.interval = interval
+        self.size = size
+        self.max_wait = max_wait
+        self.on_sample = on_sample
+        self.on_stopped = on_stopped
+
+        self.cond = threading.Condition()
+        # name -> History
+        self.histories = {}
+        # name -> (time, LXD state)
+        self.states = {}
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def tick(self):
+        with metrics.lxd('containers.state'):
+            containers = self.client.api.containers.get(params={'recursion': 2}).json()['metadata']
+        now = time.time()
+        states = {c['name']: (now, c['state']) for c in containers
+                  if c['name'].endswith(self.suffix) and c.get('state')}
+
+        samples = {}
+        with self.cond:
+            for name, (_, state) in states.items():
+                if state['status_code'] != 103:
+                    continue
+                if name not in self.histories:
+                    self.histories[name] = History(self.size)
+                samples[name] = state_sample(now, state)
+                self.histories[name].append(samples[name])
+            # Keep the history of stopped containers, but not deleted ones
+            for name in list(self.histories):
+                if name not in states:
+                    del self.histories[name]
+            self.states = states
+            self.cond.notify_all()
+
+        if self.on_sample is not None:
+            for name, sample in samples.items():
+                self.on_sample(name, sample)
+        if self.on_stopped is not None:
+            self.on_stopped([name for name in states if name not in samples])
+    def _run(self):
+        while not self.stopped.is_set():
+            start = time.monotonic()
+            try:
+                self.tick()
+            except Exception:
+                logging.exception('failed to sample container resource usage')
+            self.stopped.wait(max(self.interval - (time.monotonic() - start), 0))
+
+    def state(self, name, max_age=None):
+        """The latest LXD state of a container (`None` if there isn't one newer than `max_age` seconds)."""
+        with self.cond:
+            sampled, state = self.states.get(name, (0, None))
+        if max_age is not None and time.time() - sampled > max_age:
+            return None
+        return state
+    def rates(self, name, since=0, timeout=0):
+        """
+        Rates for samples taken after `since`, waiting up to `timeout` seconds (at most
+        `max_wait`) for a new sample if there aren't any yet.
+        """
+        deadline = time.monotonic() + max(min(timeout, self.max_wait), 0)
+        with self.cond:
+            while True:
+                history = self.histories.get(name)
+                rates = history.rates(since) if history is not None else []
+                remaining = deadline - time.monotonic()
+                if rates or remaining <= 0 or self.stopped.is_set():
+                    return rates
+                self.cond.wait(remaining)
+
+    def stop(self):
+        self.stopped.set()
+        with self.cond:
+            self.cond.notify_all()
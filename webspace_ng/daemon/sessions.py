@@ -0,0 +1,60 @@
+import threading
+
+from .. import WebspaceError
+
+class SessionRegistry:
+    """
+    Keeps track of users' console / exec / file transfer sessions, forgetting them as soon as they finish
+    (including when nothing connects to them in time). Each user can have at most
+    `max_per_user` sessions and there can be at most `max_total` overall.
+    """
+    def __init__(self, max_per_user=8, max_total=256):
+        self.max_per_user = max_per_user
+        self.max_total = max_total
+
+        self.lock = threading.Lock()
+        # (user, kind, id) -> session
+        self.sessions = {}
+
+    def _check(self, user):
+        if self.max_total and len(self.sessions) >= self.max_total:
+            raise WebspaceError('Too many sessions are open, try again later')
+        if self.max_per_user and sum(1 for u, _, _ in self.sessions if u == user) >= self.max_per_user:
+            raise WebspaceError('You have too many sessions open (at most {})'.format(self.max_per_user))
+    def check(self, user):
+        """Raise `WebspaceError` if `user` can't open another session."""
+        with self.lock:
+            self._check(user)
+
+    def _finished(self, key, session):
+        with self.lock:
+            if self.sessions.get(key) is session:
+                del self.sessions[key]
+    def start(self, user, kind, sid, session):
+        """Register and start `session`, it's removed once its thread exits."""
+        key = (user, kind, sid)
+        with self.lock:
+            try:
+                if key not in self.sessions:
+                    self._check(user)
+            except WebspaceError:
+                # Let the session's thread clean up its socket and websockets
+                session.stop()
+                session.start()
+                raise
+            self.sessions[key] = session
+        session.on_exit = lambda: self._finished(key, session)
+        session.start()
+
+    def get(self, user, kind, sid=None):
+        with self.lock:
+            return self.sessions.get((user, kind, sid))
+    def all(self):
+        with self.lock:
+            return list(self.sessions.values())
+    def counts(self):
+        counts = {'console': 0, 'exec': 0, 'transfer': 0}
+        with self.lock:
+            for _, kind, _ in self.sessions:
+                counts[kind] = counts.get(kind, 0) + 1
+        return counts
@@ -0,0 +1,321 @@
+import logging
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS containers (
+    user TEXT PRIMARY KEY,
+    -- Incremented on every change, `synced` is the last version written to LXD
+    version INTEGER NOT NULL DEFAULT 0,
+    synced INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS options (
+    user TEXT NOT NULL REFERENCES containers(user) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (user, key)
+);
+CREATE TABLE IF NOT EXISTS domains (
+    domain TEXT PRIMARY KEY,
+    user TEXT NOT NULL REFERENCES containers(user) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS domains_user ON domains(user);
+CREATE TABLE IF NOT EXISTS ports (
+    eport INTEGER PRIMARY KEY,
+    user TEXT NOT NULL REFERENCES containers(user) ON DELETE CASCADE,
+    iport INTEGER NOT NULL,
+    UNIQUE (user, iport)
+);
+-- Fixed address of each container (its NIC's `ipv4.address` in LXD)
+CREATE TABLE IF NOT EXISTS addresses (
+    user TEXT PRIMARY KEY REFERENCES containers(user) ON DELETE CASCADE,
+    ip TEXT NOT NULL UNIQUE
+);
+-- Containers left running when the daemon last exited, in boot order. `started` is the
+-- container's `last_used_at` at the time, to tell if `ip` is still valid
+CREATE TABLE IF NOT EXISTS running (
+    position INTEGER PRIMARY KEY,
+    user TEXT NOT NULL REFERENCES containers(user) ON DELETE CASCADE,
+    ip TEXT,
+    started TEXT
+);
+-- Request totals for each container, as reported by nginx (`upstream_time` is in ms)
+CREATE TABLE IF NOT EXISTS traffic (
+    user TEXT PRIMARY KEY REFERENCES containers(user) ON DELETE CASCADE,
+    requests INTEGER NOT NULL DEFAULT 0,
+    bytes_in INTEGER NOT NULL DEFAULT 0,
+    bytes_out INTEGER NOT NULL DEFAULT 0,
+    status_1xx INTEGER NOT NULL DEFAULT 0,
+    status_2xx INTEGER NOT NULL DEFAULT 0,
+    status_3xx INTEGER NOT NULL DEFAULT 0,
+    status_4xx INTEGER NOT NULL DEFAULT 0,
+    status_5xx INTEGER NOT NULL DEFAULT 0,
+    upstream_time INTEGER NOT NULL DEFAULT 0,
+    upstream_requests INTEGER NOT NULL DEFAULT 0,
+    since REAL NOT NULL,
+    last_request REAL NOT NULL
+);
+'''
+TRAFFIC_FIELDS = ('requests', 'bytes_in', 'bytes_out', 'status_1xx', 'status_2xx', 'status_3xx', 'status_4xx',
+                  'status_5xx', 'upstream_time', 'upstream_requests')
+
+class Store:
+    """
+    Local copy of each container's options, custom domains, port forwards and fixed
+    address, indexed by user, domain and external port. LXD container config remains the durable record (see
+    `Mirror`), every change here bumps the container's version until it has been written
+    back.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SCHEMA)
+
+    def _transaction(self):
+        return _Transaction(self)
+    def _query(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+    def _touch(self, user):
+        self.db.execute('UPDATE containers SET version = version + 1 WHERE user = ?', (user,))
+    def _load(self, user, options, domains, ports, address=None):
+        self.db.execute('DELETE FROM options WHERE user = ?', (user,))
+        self.db.execute('DELETE FROM domains WHERE user = ?', (user,))
+        self.db.execute('DELETE FROM ports WHERE user = ?', (user,))
+        self.db.execute('DELETE FROM addresses WHERE user = ?', (user,))
+        self.db.executemany('INSERT INTO options VALUES (?, ?, ?)', ((user, k, v) for k, v in options.items()))
+        self.db.executemany('INSERT OR REPLACE INTO domains VALUES (?, ?)', ((d, user) for d in domains))
+        self.db.executemany('INSERT OR REPLACE INTO ports VALUES (?, ?, ?)',
+                            ((eport, user, iport) for iport, eport in ports.items()))
+        if address is not None:
+            self.db.execute('INSERT OR REPLACE INTO addresses VALUES (?, ?)', (user, address))
+
+    def containers(self):
+        return [user for user, in self._query('SELECT user FROM containers')]
+    def has_container(self, user):
+        return bool(self._query('SELECT 1 FROM containers WHERE user = ?', user))
+    def add_container(self, user, options, address=None):
+        """Add a container which was just created in LXD with `options` (and `address`)."""
+        with self._transaction():
+            self.db.execute('INSERT OR REPLACE INTO containers (user) VALUES (?)', (user,))
+            self._load(user, options, [], {}, address)
+    def remove_container(self, user):
+        with self._transaction():
+            self.db.execute('DELETE FROM containers WHERE user = ?', (user,))
+
+    def options(self, user):
+        return dict(self._query('SELECT key, value FROM options WHERE user = ?', user))
+    def option(self, user, key):
+        rows = self._query('SELECT value FROM options WHERE user = ? AND key = ?', user, key)
+        if not rows:
+            raise KeyError(key)
+        return rows[0][0]
+    def set_option(self, user, key, value):
+        with self._transaction():
+            self.db.execute('INSERT OR REPLACE INTO options VALUES (?, ?, ?)', (user, key, value))
+            self._touch(user)
+    def unset_option(self, user, key):
+        with self._transaction():
+            self.db.execute('DELETE FROM options WHERE user = ? AND key = ?', (user, key))
+            self._touch(user)
+
+    def domains(self, user):
+        return [d for d, in self._query('SELECT domain FROM domains WHERE user = ? ORDER BY rowid', user)]
+    def all_domains(self):
+        return dict(self._query('SELECT domain, user FROM domains'))
+    def add_domain(self, user, domain):
+        with self._transaction():
+            self.db.execute('INSERT INTO domains VALUES (?, ?)', (domain, user))
+            self._touch(user)
+    def remove_domain(self, user, domain):
+        with self._transaction():
+            self.db.execute('DELETE FROM domains WHERE domain = ? AND user = ?', (domain, user))
+            self._touch(user)
+
+    def ports(self, user):
+        """Returns the user's port forwards as a dict of internal port -> external port."""
+        return dict(self._query('SELECT iport, eport FROM ports WHERE user = ? ORDER BY rowid', user))
+    def all_ports(self):
+        """Returns every port forward as a dict of external port -> (user, internal port)."""
+        return {eport: (user, iport) for eport, user, iport in self._query('SELECT eport, user, iport FROM ports')}
+    def add_port(self, user, iport, eport):
+        with self._transaction():
+            self.db.execute('INSERT INTO ports VALUES (?, ?, ?)', (eport, user, iport))
+            self._touch(user)
+    def remove_port(self, user, iport):
+        with self._transaction():
+            self.db.execute('DELETE FROM ports WHERE user = ? AND iport = ?', (user, iport))
+            self._touch(user)
+
+    def all_addresses(self):
+        """Returns every container's fixed address as a dict of user -> address."""
+        return dict(self._query('SELECT user, ip FROM addresses'))
+    def set_address(self, user, ip):
+        with self._transaction():
+            self.db.execute('INSERT OR REPLACE INTO addresses VALUES (?, ?)', (user, ip))
+            self._touch(user)
+
+    def get(self, user):
+        """
+        Returns `(version, options, domains, ports, address)` for a container, or `None`
+        if it doesn't exist.
+        """
+        with self._transaction():
+            rows = self.db.execute('SELECT version FROM containers WHERE user = ?', (user,)).fetchall()
+            if not rows:
+                return None
+            options = dict(self.db.execute('SELECT key, value FROM options WHERE user = ?', (user,)))
+            domains = [d for d, in self.db.execute('SELECT domain FROM domains WHERE user = ? ORDER BY rowid', (user,))]
+            ports = dict(self.db.execute('SELECT iport, eport FROM ports WHERE user = ? ORDER BY rowid', (user,)))
+            address = self.db.execute('SELECT ip FROM addresses WHERE user = ?', (user,)).fetchone()
+        return rows[0][0], options, domains, ports, address[0] if address else None
+    def mark_synced(self, user, version):
+        with self._transaction():
+            self.db.execute('UPDATE containers SET synced = ? WHERE user = ?', (version, user))
+
+    def reconcile(self, containers):
+        """
+        Bring the store in line with `containers` as read from LXD (a dict of user ->
+        `(options, domains, ports, address)`). Containers with changes not yet written to LXD keep
+        their local state. Returns the list of such containers.
+        """
+        unsynced = []
+        with self._transaction():
+            existing = {user: version != synced for user, version, synced in
+                        self.db.execute('SELECT user, version, synced FROM containers')}
+            for user in existing.keys() - containers.keys():
+                self.db.execute('DELETE FROM containers WHERE user = ?', (user,))
+
+            for user, (options, domains, ports, address) in containers.items():
+                if existing.get(user):
+                    unsynced.append(user)
+                    continue
+                if user not in existing:
+                    self.db.execute('INSERT INTO containers (user) VALUES (?)', (user,))
+                self._load(user, options, domains, ports, address)
+        return unsynced
+
+    def running(self):
+        """Returns the containers saved by `save_running()` as a list of `(user, ip, started)`."""
+        return self._query('SELECT user, ip, started FROM running ORDER BY position')
+    def save_running(self, running):
+        """Replace the saved list of running containers (`(user, ip, started)`, in boot order)."""
+        with self._transaction():
+            self.db.execute('DELETE FROM running')
+            self.db.executemany('INSERT INTO running (user, ip, started) VALUES (?, ?, ?)', running)
+
+    def traffic(self, user):
+        """
+        Returns a container's request totals as a dict of `TRAFFIC_FIELDS`, `since` and
+        `last_request`, or `None` if nothing has been recorded.
+        """
+        columns = TRAFFIC_FIELDS + ('since', 'last_request')
+        rows = self._query('SELECT {} FROM traffic WHERE user = ?'.format(', '.join(columns)), user)
+        return dict(zip(columns, rows[0])) if rows else None
+    def add_traffic(self, traffic, now):
+        """Add to the request totals of each container in `traffic` (a dict of user -> dict of `TRAFFIC_FIELDS`)."""
+        sql = 'INSERT INTO traffic (user, {0}, since, last_request) VALUES (?, {1}, ?, ?) ' \
+              'ON CONFLICT (user) DO UPDATE SET {2}, last_request = excluded.last_request'.format(
+                  ', '.join(TRAFFIC_FIELDS), ', '.join('?' * len(TRAFFIC_FIELDS)),
+                  ', '.join('{0} = {0} + excluded.{0}'.format(f) for f in TRAFFIC_FIELDS))
+        with self._transaction():
+            self.db.executemany(sql, ((user,) + tuple(counts[f] for f in TRAFFIC_FIELDS) + (now, now)
+                                      for user, counts in traffic.items()))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class _Transaction:
+    __slots__ = ('store',)
+    def __init__(self, store):
+        self.store = store
+    def __enter__(self):
+        self.store.lock.acquire()
+        self.store.db.execute('BEGIN')
+    def __exit__(self, ex_type, _ex, _trace):
+        try:
+            self.store.db.execute('ROLLBACK' if ex_type is not None else 'COMMIT')
+        finally:
+            self.store.lock.release()
+
+class Mirror:
+    """
+    Writes changes in the `Store` back to LXD in the background. Multiple changes to the
+    same container are coalesced into a single write, failed writes are retried after
+    `retry_interval` seconds.
+    """
+    def __init__(self, sync, retry_interval=5):
+        self.sync = sync
+        self.retry_interval = retry_interval
+        self.pending = set()
+        # user -> when to retry a failed write (monotonic)
+        self.retrying = {}
+        self.syncing = None
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, user):
+        with self.cond:
+            if self.stopped:
+                return
+            self.pending.add(user)
+            # Written straight away instead
+            self.retrying.pop(user, None)
+            self.cond.notify_all()
+
+    def _next(self):
+        """Wait for a user to write (with the lock held), `None` once stopped."""
+        while True:
+            now = time.monotonic()
+            for user, retry_at in list(self.retrying.items()):
+                if retry_at <= now:
+                    del self.retrying[user]
+                    self.pending.add(user)
+            if self.pending:
+                return self.pending.pop()
+            if self.stopped:
+                return None
+            self.cond.wait(min(self.retrying.values()) - now if self.retrying else None)
+    def run(self):
+        while True:
+            with self.cond:
+                self.syncing = user = self._next()
+                if user is None:
+                    return
+
+            try:
+                self.sync(user)
+            except Exception as ex:
+                logging.error('failed to write configuration for %s to LXD (retrying in %ds): %s',
+                              user, self.retry_interval, ex)
+                with self.cond:
+                    if not self.stopped and user not in self.pending:
+                        self.retrying[user] = time.monotonic() + self.retry_interval
+            finally:
+                with self.cond:
+                    self.syncing = None
+                    self.cond.notify_all()
+
+    def _idle(self):
+        return not self.pending and not self.retrying and self.syncing is None
+    def flush(self, timeout=None):
+        """Wait for pending writes (including retries of failed ones) to complete, returns `False` on timeout."""
+        with self.cond:
+            return self.cond.wait_for(self._idle, timeout)
+    def stop(self, timeout=None):
+        if not self.flush(timeout):
+            with self.cond:
+                users = self.pending | self.retrying.keys() | ({self.syncing} if self.syncing else set())
+            logging.warning('gave up waiting to write configuration for %s to LXD', ', '.join(sorted(users)))
+        with self.cond:
+            self.stopped = True
+            self.pending.clear()
+            self.retrying.clear()
+            self.cond.notify_all()
+        self.thread.join()
@@ -1,29 +1,115 @@
+import logging
+import socket
 import subprocess
+import time
 
 from .. import WebspaceError
 
 class TcpProxyError(WebspaceError):
     pass
 
+# Maximum number of commands written before reading their results, keeps the pipes from filling up
+BATCH_SIZE = 256
+
+# How long to wait for a newly started proxy's control socket to appear
+ATTACH_TIMEOUT = 5
+
 class TcpProxy:
-    def __init__(self, proxy_bin, sock_path):
-        self.proc = subprocess.Popen([proxy_bin, sock_path], stdin=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
+    """
+    Controls `webspace-tcp-proxy`. By default the proxy is a child process commanded over
+    its stdin / stderr which exits along with the daemon. With a `control_path` the proxy
+    is started in its own session (if it isn't already running) and commanded over a Unix
+    socket, it keeps forwarding after the daemon exits and is re-attached on startup.
+    """
+    def __init__(self, proxy_bin, sock_path, control_path=''):
+        self.control_path = control_path
+        if not control_path:
+            self.proc = subprocess.Popen([proxy_bin, sock_path], stdin=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
+            self.commands, self.results = self.proc.stdin, self.proc.stderr
+            return
 
-    def add_forwarding(self, eport, user, iport):
-        self.proc.stdin.write('add {} {} {}\n'.format(eport, user, iport))
-        self.proc.stdin.flush()
+        self.proc = None
+        self.sock = self._connect()
+        if self.sock is not None:
+            logging.info('re-attached to TCP proxy at %s', control_path)
+        else:
+            self.proc = subprocess.Popen([proxy_bin, sock_path, control_path], stdin=subprocess.DEVNULL,
+                                         start_new_session=True)
+            deadline = time.monotonic() + ATTACH_TIMEOUT
+            while self.sock is None:
+                if self.proc.poll() is not None or time.monotonic() > deadline:
+                    raise TcpProxyError('TCP proxy did not open its control socket {}'.format(control_path))
+                time.sleep(0.05)
+                self.sock = self._connect()
+        self.commands = self.results = self.sock.makefile('rw', encoding='utf8')
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.control_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            return None
+        return sock
+
+    def _command(self, command):
+        self.commands.write(command + '\n')
+        self.commands.flush()
+
+        result = self.results.readline().strip()
+        return None if result == 'ok' else result
 
-        result = self.proc.stderr.readline().strip()
-        if result != 'ok':
+    def set_limits(self, max_conns, max_user_conns, idle_timeout, max_lifetime):
+        """
+        Limit connections for all forwardings (existing ones too). `max_conns` is per
+        external port and `max_user_conns` across all of a user's ports, timeouts are
+        in seconds. Zero means unlimited.
+        """
+        result = self._command('limits {} {} {} {}'.format(max_conns, max_user_conns, idle_timeout, max_lifetime))
+        if result is not None:
+            raise TcpProxyError('failed to set connection limits: {}'.format(result))
+    def add_forwarding(self, eport, user, iport):
+        result = self._command('add {} {} {}'.format(eport, user, iport))
+        if result is not None:
             raise TcpProxyError('failed to add port forwarding {} -> {}:{}: {}'.format(eport, user, iport, result))
+    def add_forwardings(self, forwardings):
+        """
+        Add many `(eport, user, iport)` forwardings, pipelining the commands instead of
+        waiting for each result in turn. Every forwarding is attempted, failures are
+        reported together afterwards.
+        """
+        errors = []
+        for i in range(0, len(forwardings), BATCH_SIZE):
+            batch = forwardings[i:i + BATCH_SIZE]
+            self.commands.write(''.join('add {} {} {}\n'.format(*f) for f in batch))
+            self.commands.flush()
+            for eport, user, iport in batch:
+                result = self.results.readline().strip()
+                if result != 'ok':
+                    errors.append('{} -> {}:{}: {}'.format(eport, user, iport, result))
+        if errors:
+            raise TcpProxyError('failed to add port forwardings: {}'.format(', '.join(errors)))
     def remove_forwarding(self, eport):
-        self.proc.stdin.write('remove {}\n'.format(eport))
-        self.proc.stdin.flush()
-
-        result = self.proc.stderr.readline().strip()
-        if result != 'ok':
+        result = self._command('remove {}'.format(eport))
+        if result is not None:
             raise TcpProxyError('failed to remove port {}: {}'.format(eport, result))
 
+    def retain_forwardings(self, eports):
+        """Remove any forwardings (left over in a re-attached proxy) not in `eports`."""
+        result = self._command(' '.join(['retain'] + list(map(str, eports))))
+        if result is not None:
+            raise TcpProxyError('failed to remove stale port forwardings: {}'.format(result))
+
+    # The user-space proxy looks up the container IP on every connection
+    def container_started(self, user, ip):
+        pass
+    def container_stopped(self, user):
+        pass
+
     def stop(self):
+        if self.control_path:
+            # Leave the proxy running for the next daemon to re-attach to
+            self.commands.close()
+            self.sock.close()
+            return
         self.proc.terminate()
         self.proc.wait(timeout=3)
@@ -0,0 +1,74 @@
+import ipaddress
+
+import pytest
+
+from .. import WebspaceError
+from .addresses import AddressAllocator
+
+def allocator(cidr='10.0.0.0/24', reserved=()):
+    return AddressAllocator(ipaddress.IPv4Network(cidr), [ipaddress.IPv4Address(ip) for ip in reserved])
+
+def test_allocation_is_stable():
+    first = allocator()
+    ip = first.allocate('alice')
+    assert ipaddress.IPv4Address(ip) in first.network
+    assert first.allocate('alice') == ip
+    assert first.get('alice') == ip
+
+    # Another allocator (e.g. after the container was re-created) hands out the same one
+    second = allocator()
+    second.allocate('bob')
+    assert second.allocate('alice') == ip
+
+def test_taken_addresses_skipped():
+    first = allocator()
+    ip = first.allocate('alice')
+    # Someone else already has alice's address
+    taken = allocator()
+    taken.load({'bob': ip})
+    other = taken.allocate('alice')
+    assert other != ip
+    assert taken.taken == {ip: 'bob', other: 'alice'}
+
+def test_reserved_addresses_skipped():
+    ip = allocator().allocate('alice')
+    assert allocator(reserved=[ip]).allocate('alice') != ip
+
+def test_network_and_broadcast_skipped():
+    # A /30 only has two usable addresses
+    network = allocator('10.0.0.0/30')
+    assert {network.allocate('alice'), network.allocate('bob')} == {'10.0.0.1', '10.0.0.2'}
+
+def test_wraps_around():
+    # In a /29, all but the first usable address is reserved or taken (alice's hash starts at the last)
+    network = allocator('10.0.0.0/29', reserved=['10.0.0.2', '10.0.0.3', '10.0.0.4'])
+    network.load({'x': '10.0.0.5', 'y': '10.0.0.6'})
+    assert network.allocate('alice') == '10.0.0.1'
+
+def test_exhausted():
+    network = allocator('10.0.0.0/30', reserved=['10.0.0.1'])
+    network.allocate('alice')
+    with pytest.raises(WebspaceError):
+        network.allocate('bob')
+    assert network.get('bob') is None
+
+    network.release('alice')
+    assert network.allocate('bob') == '10.0.0.2'
+    # Already released
+    network.release('alice')
+
+def test_too_small():
+    with pytest.raises(WebspaceError):
+        allocator('10.0.0.0/31')
+
+def test_load_replaces_allocations():
+    network = allocator()
+    old = network.allocate('alice')
+    network.load({'bob': '10.0.0.7'})
+    assert network.get('alice') is None
+    assert network.get('bob') == '10.0.0.7'
+    assert network.taken == {'10.0.0.7': 'bob'}
+    # alice's old address is free again
+    assert network.allocate('carol') != '10.0.0.7'
+    network.load({})
+    assert network.allocate('alice') == old
@@ -0,0 +1,58 @@
+import pytest
+
+from .admission import AdmissionController, NotEnoughMemory
+
+MiB = 1024 * 1024
+
+def controller(usage, **kwargs):
+    kwargs.setdefault('default_usage', 256 * MiB)
+    kwargs.setdefault('available', lambda: 0)
+    kwargs.setdefault('pressure', lambda: 0)
+    return AdmissionController(usage.__getitem__, **kwargs)
+
+def test_fits_without_evicting():
+    admission = controller({'a': 100 * MiB}, budget=1024 * MiB)
+    assert admission.plan('new', ['a']) == []
+
+def test_refused_if_it_cant_fit():
+    admission = controller({'a': 100 * MiB}, budget=512 * MiB, default_usage=1024 * MiB)
+    with pytest.raises(NotEnoughMemory):
+        admission.plan('new', ['a'])
+
+def test_refused_with_host_memory():
+    admission = controller({}, available=lambda: 300 * MiB, reserve=100 * MiB)
+    with pytest.raises(NotEnoughMemory):
+        admission.plan('new', [])
+
+def test_evicts_least_recently_used_first():
+    usage = {'a': 200 * MiB, 'b': 200 * MiB, 'c': 200 * MiB}
+    admission = controller(usage, budget=800 * MiB, default_usage=500 * MiB)
+    # 200 MiB free, evicting `a` and `b` (the first in `running`) makes room
+    assert admission.plan('new', ['a', 'b', 'c']) == ['a', 'b']
+    assert admission.plan('new', ['c', 'b', 'a']) == ['c', 'b']
+
+def test_evicts_under_pressure():
+    usage = {'a': 100 * MiB, 'b': 100 * MiB}
+    admission = controller(usage, budget=4096 * MiB, psi_threshold=10, pressure=lambda: 50)
+    assert admission.plan('new', ['a', 'b']) == ['a']
+
+def test_expects_peak_usage():
+    usage = {'a': 100 * MiB}
+    admission = controller(usage, budget=900 * MiB)
+    admission.record('new', 900 * MiB)
+    admission.record('new', 100 * MiB)
+    assert admission.plan('new', ['a']) == ['a']
+
+def test_usage_is_cached():
+    calls = []
+    def usage(name):
+        calls.append(name)
+        return 100 * MiB
+    admission = AdmissionController(usage, budget=1024 * MiB, max_age=60)
+    admission.plan('new', ['a'])
+    admission.plan('new', ['a'])
+    assert calls == ['a']
+
+    admission.forget('a')
+    admission.plan('new', ['a'])
+    assert calls == ['a', 'a']
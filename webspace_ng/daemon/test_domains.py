@@ -0,0 +1,95 @@
+import pytest
+
+from .. import WebspaceError
+from .domains import DomainIndex, split_domain
+
+@pytest.fixture
+def index():
+    index = DomainIndex('.ng.localhost')
+    index.load({
+        'a.com': 'exact',
+        'x.b.a.com': 'exact-deep',
+        '*.a.com': 'one',
+        '*.*.a.com': 'two',
+        '*.b.a.com': 'b',
+    })
+    return index
+
+@pytest.mark.parametrize('host, expected', [
+    ('a.com', ('exact', 'domain')),
+    ('x.b.a.com', ('exact-deep', 'domain')),
+    # Each `*` matches exactly one label
+    ('c.a.com', ('one', 'wildcard')),
+    ('y.c.a.com', ('two', 'wildcard')),
+    ('z.y.c.a.com', (None, None)),
+    # The wildcard with the longest non-wildcard suffix wins
+    ('y.b.a.com', ('b', 'wildcard')),
+    ('b.a.com', ('one', 'wildcard')),
+    ('a.org', (None, None)),
+    ('com', (None, None)),
+])
+def test_precedence(index, host, expected):
+    assert index.lookup(host) == expected
+
+@pytest.mark.parametrize('host, expected', [
+    ('alice.ng.localhost', ('alice', 'suffix')),
+    # Everything before the suffix, which isn't a valid user (`_boot_and_host` reports `user`)
+    ('a.b.ng.localhost', ('a.b', 'suffix')),
+    ('.ng.localhost', ('', 'suffix')),
+    ('ng.localhost', (None, None)),
+    ('localhost', (None, None)),
+    ('alice.ng.localhost.', ('alice', 'suffix')),
+])
+def test_user_suffix(index, host, expected):
+    assert index.lookup(host) == expected
+
+def test_custom_domain_under_suffix(index):
+    index.add('www.alice.ng.localhost', 'bob')
+    assert index.lookup('www.alice.ng.localhost') == ('bob', 'domain')
+    assert index.lookup('alice.ng.localhost') == ('alice', 'suffix')
+
+def test_case_insensitive(index):
+    assert index.lookup('X.B.A.Com') == ('exact-deep', 'domain')
+    assert index.lookup('ALICE.ng.localhost') == ('alice', 'suffix')
+
+    index.add('Example.COM', 'carol')
+    assert 'example.com' in index
+    assert index.get('EXAMPLE.com') == 'carol'
+    assert index.lookup('example.com') == ('carol', 'domain')
+    index.remove('eXample.com')
+    assert 'example.com' not in index.domains
+
+def test_remove_and_readd(index):
+    index.remove('*.b.a.com')
+    assert index.lookup('y.b.a.com') == ('two', 'wildcard')
+    index.remove('x.b.a.com')
+    assert index.lookup('x.b.a.com') == ('two', 'wildcard')
+
+    index.add('*.b.a.com', 'b2')
+    index.add('x.b.a.com', 'exact2')
+    assert index.lookup('y.b.a.com') == ('b2', 'wildcard')
+    assert index.lookup('x.b.a.com') == ('exact2', 'domain')
+
+def test_remove_unknown(index):
+    for domain in ('nope.com', 'y.a.com', '*.*.*.a.com'):
+        with pytest.raises(WebspaceError, match='has not been configured'):
+            index.remove(domain)
+    assert len(index.domains) == 5
+
+def test_load_replaces(index):
+    index.load({'Other.com': 'dave'})
+    assert index.domains == {'other.com': 'dave'}
+    assert index.lookup('a.com') == (None, None)
+    assert index.lookup('alice.ng.localhost') == ('alice', 'suffix')
+
+@pytest.mark.parametrize('domain, expected', [
+    ('Example.com', (0, ['example', 'com'])),
+    ('*.*.a.com', (2, ['a', 'com'])),
+])
+def test_split_domain(domain, expected):
+    assert split_domain(domain) == expected
+
+@pytest.mark.parametrize('domain', ['*', 'a.*.com', 'a..com', '*.', ''])
+def test_split_domain_invalid(domain):
+    with pytest.raises(WebspaceError, match='not a valid domain'):
+        split_domain(domain)
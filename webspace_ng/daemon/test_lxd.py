@@ -0,0 +1,144 @@
+import io
+
+import pytest
+import requests
+
+from . import lxd
+from .lxd import CircuitBreaker, LXDAdapter, LXDUnavailable
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(lxd.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(lxd.time, 'sleep', lambda _: None)
+    return clock
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(threshold=3, reset_timeout=10)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.state == 'closed'
+    # A success in between starts the count again
+    breaker.success()
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.state == 'open'
+    assert not breaker.healthy
+    assert not breaker.allow()
+
+def test_breaker_half_open_trial(clock):
+    breaker = CircuitBreaker(threshold=1, reset_timeout=10)
+    breaker.failure()
+    clock.now += 10
+    # Only one call is let through to check on LXD
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+
+    # Which re-opens the breaker if it fails
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    clock.now += 10
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == 'closed'
+    assert breaker.allow() and breaker.allow()
+
+class FakeSend:
+    """Stands in for the connection pool, each call pops the next result (raised if it's an exception)."""
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = []
+    def __call__(self, request, **kwargs):
+        self.calls.append((request.method, request.path_url, kwargs.get('timeout')))
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        response = requests.Response()
+        response.status_code = result
+        response.raw = io.BytesIO()
+        return response
+
+@pytest.fixture
+def adapter(clock):
+    return LXDAdapter(read_timeout=120, retries=2, breaker=CircuitBreaker(threshold=2, reset_timeout=10))
+@pytest.fixture
+def lxd_results(monkeypatch):
+    def results(*results):
+        fake = FakeSend(results)
+        monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', lambda _, request, **kwargs: fake(request, **kwargs))
+        return fake
+    return results
+def request(method='GET', path='/1.0/instances'):
+    return requests.Request(method, 'http+unix://%2Fvar%2Flxd.socket' + path).prepare()
+
+def test_retries_reads(adapter, lxd_results):
+    fake = lxd_results(requests.ConnectionError(), 503, 200)
+    assert adapter.send(request()).status_code == 200
+    assert len(fake.calls) == 3
+    assert fake.calls[0][2] == (5, 120)
+    assert adapter.breaker.failures == 0
+
+def test_gives_up_after_retries(adapter, lxd_results):
+    fake = lxd_results(*[requests.Timeout()] * 3)
+    with pytest.raises(requests.Timeout):
+        adapter.send(request())
+    assert len(fake.calls) == 3
+    assert adapter.breaker.failures == 1
+
+def test_writes_not_retried(adapter, lxd_results):
+    fake = lxd_results(503)
+    assert adapter.send(request('POST')).status_code == 503
+    assert len(fake.calls) == 1
+    assert adapter.breaker.failures == 1
+
+def test_ordinary_errors_not_retried(adapter, lxd_results):
+    fake = lxd_results(404)
+    assert adapter.send(request()).status_code == 404
+    assert len(fake.calls) == 1
+    assert adapter.breaker.failures == 0
+
+def test_open_breaker_fails_fast(adapter, lxd_results):
+    fake = lxd_results()
+    adapter.breaker.failure()
+    adapter.breaker.failure()
+    with pytest.raises(LXDUnavailable):
+        adapter.send(request())
+    assert fake.calls == []
+
+def test_operation_wait_bypasses_breaker(adapter, lxd_results):
+    adapter.breaker.failure()
+    adapter.breaker.failure()
+    # No read timeout, no retries and the breaker isn't consulted or updated
+    fake = lxd_results(200, requests.ConnectionError())
+    assert adapter.send(request(path='/1.0/operations/abc/wait?timeout=1')).status_code == 200
+    assert fake.calls == [('GET', '/1.0/operations/abc/wait?timeout=1', (5, None))]
+    with pytest.raises(requests.ConnectionError):
+        adapter.send(request(path='/1.0/operations/abc/wait'))
+    assert len(fake.calls) == 2
+    assert adapter.breaker.failures == 2
+
+def test_unexpected_error_ends_trial(adapter, lxd_results, clock):
+    adapter.breaker.failure()
+    adapter.breaker.failure()
+    clock.now += 10
+    lxd_results(requests.exceptions.InvalidHeader())
+    with pytest.raises(requests.exceptions.InvalidHeader):
+        adapter.send(request())
+    assert adapter.breaker.state == 'open'
+
+    # Rather than refusing every call from now on
+    clock.now += 10
+    lxd_results(200)
+    assert adapter.send(request()).status_code == 200
+    assert adapter.breaker.healthy
@@ -0,0 +1,87 @@
+import stat
+
+import pytest
+
+from .nft import NftError, NftForwarding
+from .tcp_proxy import TcpProxyError
+
+class FakeProxy:
+    control_path = None
+
+    def __init__(self):
+        self.ports = {}
+        self.fail = False
+    def add_forwarding(self, eport, user, iport):
+        if self.fail:
+            raise TcpProxyError('failed')
+        self.ports[eport] = (user, iport)
+    def remove_forwarding(self, eport):
+        if self.fail:
+            raise TcpProxyError('failed')
+        del self.ports[eport]
+    def stop(self):
+        pass
+
+class FakeNft:
+    """An `nft` which logs its scripts (one per line) and fails after `start_failing()`."""
+    def __init__(self, tmp_path):
+        self.log = tmp_path / 'nft.log'
+        self.fail = tmp_path / 'fail'
+        self.path = tmp_path / 'nft'
+        self.path.write_text('#!/bin/sh\n'
+                             '[ -e {fail} ] && exit 1\n'
+                             'tr "\\n" " " >> {log}; echo >> {log}\n'.format(fail=self.fail, log=self.log))
+        self.path.chmod(self.path.stat().st_mode | stat.S_IEXEC)
+
+    def scripts(self):
+        """Scripts run since the last call."""
+        lines = self.log.read_text().splitlines() if self.log.exists() else []
+        self.log.write_text('')
+        return [l.strip() for l in lines]
+    def start_failing(self):
+        self.fail.touch()
+
+@pytest.fixture
+def nft_bin(tmp_path):
+    return FakeNft(tmp_path)
+@pytest.fixture
+def nft(nft_bin):
+    forwarding = NftForwarding(FakeProxy(), nft_bin=str(nft_bin.path))
+    nft_bin.scripts()
+    return forwarding
+
+def test_dnat_follows_container(nft, nft_bin):
+    nft.add_forwarding(8080, 'alice', 80)
+    nft.add_forwarding(8081, 'bob', 80)
+    assert nft_bin.scripts() == []
+
+    nft.container_started('alice', '10.0.0.2')
+    assert nft_bin.scripts() == ['add element ip webspace fwd { 8080 : 10.0.0.2 . 80 }']
+
+    nft.container_stopped('alice')
+    assert nft_bin.scripts() == ['delete element ip webspace fwd { 8080 }']
+    assert 'alice' not in nft.active
+
+    # Already stopped
+    nft.container_stopped('alice')
+    assert nft_bin.scripts() == []
+
+def test_add_rolled_back(nft, nft_bin):
+    nft.container_started('alice', '10.0.0.2')
+    nft_bin.start_failing()
+    with pytest.raises(NftError):
+        nft.add_forwarding(8080, 'alice', 80)
+    assert 8080 not in nft.ports
+    assert 8080 not in nft.proxy.ports
+
+def test_remove_rolled_back(nft, nft_bin):
+    nft.container_started('alice', '10.0.0.2')
+    nft.add_forwarding(8080, 'alice', 80)
+    nft_bin.scripts()
+
+    nft.proxy.fail = True
+    with pytest.raises(TcpProxyError):
+        nft.remove_forwarding(8080)
+    assert nft_bin.scripts() == ['delete element ip webspace fwd { 8080 }',
+                                 'add element ip webspace fwd { 8080 : 10.0.0.2 . 80 }']
+    assert nft.ports[8080] == ('alice', 80)
@@ -0,0 +1,66 @@
+import pytest
+
+from .. import WebspaceError
+from .ports import PortAllocator
+
+def test_exhaustion_includes_end():
+    ports = PortAllocator(40000, 40009, per_user=100, reserved=(40000, 40005, 50000))
+    allocated = {ports.allocate('alice', iport) for iport in range(10 - 2)}
+    assert allocated == set(range(40000, 40010)) - {40000, 40005}
+    with pytest.raises(WebspaceError, match='all ports have been allocated'):
+        ports.allocate('alice', 100)
+
+    # Freed ports can be allocated again
+    assert ports.release(40009)[0] == 'alice'
+    assert ports.allocate('alice', 100) == 40009
+
+def test_specific_port():
+    ports = PortAllocator(40000, 40009, per_user=5, reserved=(40005,))
+    assert ports.allocate('alice', 80, 40009) == 40009
+    with pytest.raises(WebspaceError, match='already been forwarded'):
+        ports.allocate('bob', 80, 40009)
+    with pytest.raises(WebspaceError, match='reserved'):
+        ports.allocate('bob', 80, 40005)
+    with pytest.raises(WebspaceError, match='already forwarded to port 80'):
+        ports.allocate('alice', 80, 40001)
+
+@pytest.mark.parametrize('eport', [39999, 40010, -1, True, '40001', 40001.0])
+def test_invalid_ports(eport):
+    ports = PortAllocator(40000, 40009, per_user=5)
+    with pytest.raises(WebspaceError, match='not a valid port'):
+        ports.allocate('alice', 80, eport)
+    assert len(ports.free) == 10
+
+def test_per_user_limit():
+    ports = PortAllocator(40000, 40009, per_user=2)
+    ports.allocate('alice', 80)
+    ports.allocate('alice', 443)
+    with pytest.raises(WebspaceError, match='cannot forward any more'):
+        ports.allocate('alice', 22)
+    # Other users aren't affected
+    ports.allocate('bob', 22)
+
+    eport = ports.user_ports('alice')[80]
+    ports.release(eport)
+    assert ports.allocate('alice', 22)
+    assert set(ports.user_ports('alice')) == {443, 22}
+
+def test_add_existing():
+    ports = PortAllocator(40000, 40009, per_user=1, reserved=(40005,))
+    # Forwards from before the limits / reservations changed are kept
+    ports.add('alice', 80, 40005)
+    ports.add('alice', 443, 40001)
+    ports.add('alice', 22, 50000)
+    assert ports.user_ports('alice') == {80: 40005, 443: 40001, 22: 50000}
+    assert not ports.is_free(40001)
+
+    # Re-adding a port moves it
+    ports.add('bob', 80, 40001)
+    assert ports.user_ports('alice') == {80: 40005, 22: 50000}
+    assert ports.forwards[40001] == ('bob', 80)
+
+    # Reserved and out of range ports aren't handed out once released
+    ports.release(40005)
+    ports.release(50000)
+    assert sorted(ports.free) == [40000, 40002, 40003, 40004, 40006, 40007, 40008, 40009]
+    assert 'alice' not in ports.users
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from .sampler import History, ResourceSampler, state_sample
+
+GB = 1000 ** 3
+
+def sample(t, cpu=0, rx=0, tx=0, memory=0):
+    return (t, cpu, memory, 0, 1, rx, tx)
+
+def test_ring_buffer_keeps_latest():
+    history = History(3)
+    assert history.samples() == []
+    for t in range(1, 6):
+        history.append(sample(t))
+    assert [s[0] for s in history.samples()] == [3, 4, 5]
+
+def test_rates():
+    history = History(10)
+    history.append(sample(100, cpu=0, rx=0, tx=0))
+    # 1s of CPU time over 10s is 10% of one core
+    history.append(sample(110, cpu=GB, rx=5000, tx=1000, memory=42))
+    history.append(sample(120, cpu=3 * GB, rx=5000, tx=3000))
+    assert history.rates() == [(110, 10.0, 42, 0, 1, 500.0, 100.0),
+                               (120, 20.0, 0, 0, 1, 0.0, 200.0)]
+
+def test_rates_since():
+    history = History(10)
+    for t in (100, 110, 120):
+        history.append(sample(t, cpu=t * GB))
+    assert [r[0] for r in history.rates(since=110)] == [120]
+    assert history.rates(since=120) == []
+
+def test_counter_reset_skipped():
+    history = History(10)
+    history.append(sample(100, cpu=5 * GB, rx=9000))
+    # Restarted: the counters start from 0 again
+    history.append(sample(110, cpu=GB, rx=1000))
+    history.append(sample(120, cpu=2 * GB, rx=500))
+    assert history.rates() == [(120, 10.0, 0, 0, 1, 0.0, 0.0)]
+
+def test_rates_after_wrap_around():
+    history = History(3)
+    for t in range(1, 6):
+        history.append(sample(t * 10, cpu=t * GB))
+    assert [(r[0], r[1]) for r in history.rates()] == [(40, 10.0), (50, 10.0)]
+
+def test_state_sample_ignores_loopback():
+    def iface(rx, tx):
+        return {'counters': {'bytes_received': rx, 'bytes_sent': tx}}
+    state = {'cpu': {'usage': 7}, 'memory': {'usage': 8}, 'disk': {'root': {'usage': 9}}, 'processes': 3,
+             'network': {'lo': iface(100, 100), 'eth0': iface(1, 2), 'eth1': iface(3, 4)}}
+    assert state_sample(1.5, state) == (1.5, 7, 8, 9, 3, 4, 6)
+    assert state_sample(1.5, {}) == (1.5, 0, 0, 0, 0, 0, 0)
+
+class FakeClient:
+    """Just enough of pylxd for `ResourceSampler.tick` with no containers."""
+    def __init__(self):
+        self.api = self
+        self.containers = self
+    def get(self, params):
+        return self
+    def json(self):
+        return {'metadata': []}
+
+@pytest.fixture
+def sampler():
+    sampler = ResourceSampler(FakeClient(), '-ws', interval=3600, max_wait=0.2)
+    yield sampler
+    sampler.stop()
+
+def test_rates_wait_capped(sampler):
+    start = time.monotonic()
+    assert sampler.rates('alice-ws', timeout=60) == []
+    assert time.monotonic() - start < 5
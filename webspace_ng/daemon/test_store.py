@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+from .store import Mirror, Store
+
+@pytest.fixture
+def store(tmp_path):
+    store = Store(str(tmp_path / 'store.db'))
+    yield store
+    store.close()
+
+def test_changes_bump_version(store):
+    store.add_container('alice', {'terminate_ssl': 'true'}, '10.0.0.2')
+    version, options, domains, ports, address = store.get('alice')
+    assert (options, domains, ports, address) == ({'terminate_ssl': 'true'}, [], {}, '10.0.0.2')
+
+    store.add_domain('alice', 'example.com')
+    store.add_port('alice', 80, 40000)
+    store.set_option('alice', 'http_port', '8080')
+    assert store.get('alice') == (version + 3, {'terminate_ssl': 'true', 'http_port': '8080'}, ['example.com'],
+                                  {80: 40000}, '10.0.0.2')
+    assert store.get('bob') is None
+
+def test_reconcile(store):
+    store.add_container('alice', {})
+    store.add_container('bob', {})
+    store.add_container('gone', {})
+    lxd = {
+        'alice': ({'http_port': '81'}, ['alice.com'], {80: 40000}, '10.0.0.2'),
+        'bob': ({}, ['bob.com'], {}, None),
+        'new': ({}, [], {22: 40001}, '10.0.0.4'),
+    }
+    assert store.reconcile(lxd) == []
+    assert sorted(store.containers()) == ['alice', 'bob', 'new']
+    assert store.get('alice')[1:] == lxd['alice']
+    assert store.all_ports() == {40000: ('alice', 80), 40001: ('new', 22)}
+
+def test_reconcile_keeps_unsynced(store):
+    store.add_container('alice', {})
+    store.add_domain('alice', 'local.com')
+    lxd = {'alice': ({}, ['lxd.com'], {}, None)}
+
+    # Not written to LXD yet, so LXD's copy is out of date
+    assert store.reconcile(lxd) == ['alice']
+    assert store.domains('alice') == ['local.com']
+
+    version = store.get('alice')[0]
+    store.mark_synced('alice', version - 1)
+    assert store.reconcile(lxd) == ['alice']
+    store.mark_synced('alice', version)
+    assert store.reconcile(lxd) == []
+    assert store.domains('alice') == ['lxd.com']
+
+def test_mirror_coalesces_writes():
+    written = []
+    release = threading.Event()
+    def sync(user):
+        release.wait()
+        written.append(user)
+    mirror = Mirror(sync)
+    mirror.schedule('alice')
+    mirror.schedule('bob')
+    mirror.schedule('bob')
+    assert not mirror.flush(0.1)
+    release.set()
+    assert mirror.flush(5)
+    assert sorted(written) == ['alice', 'bob']
+    mirror.stop()
+
+def test_mirror_flush_waits_for_retries():
+    attempts = []
+    def sync(user):
+        attempts.append(user)
+        if len(attempts) < 3:
+            raise Exception('LXD is down')
+    mirror = Mirror(sync, retry_interval=0.05)
+    mirror.schedule('alice')
+    assert mirror.flush(5)
+    assert attempts == ['alice'] * 3
+    mirror.stop()
+
+def test_mirror_stop_drops_retries():
+    def sync(user):
+        raise Exception('LXD is down')
+    mirror = Mirror(sync, retry_interval=60)
+    mirror.schedule('alice')
+    assert not mirror.flush(0.2)
+    assert 'alice' in mirror.retrying
+    mirror.stop(timeout=0)
+    assert not mirror.thread.is_alive()
+    # Nothing left to keep the process alive or write after stopping
+    assert not any(isinstance(t, threading.Timer) for t in threading.enumerate())
+    mirror.schedule('alice')
+    assert not mirror.pending
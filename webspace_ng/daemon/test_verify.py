@@ -0,0 +1,57 @@
+import threading
+
+import pytest
+
+from bench.fake_dns import FakeDNS
+from .verify import DomainVerifier
+
+@pytest.fixture
+def dns():
+    dns = FakeDNS(records={'example.com': ['webspace:alice', 'other']}, drop=['slow.com']).start()
+    yield dns
+    dns.shutdown()
+    dns.server_close()
+
+@pytest.fixture
+def verifier(dns):
+    verifier = DomainVerifier(['127.0.0.1'], dns.port, timeout=0.5, ttl=60, negative_ttl=60)
+    yield verifier
+    verifier.stop()
+
+def test_verify(verifier):
+    assert verifier.verify('example.com', 'alice').result(5).verified
+    result = verifier.verify('example.com', 'bob').result(5)
+    assert not result.verified and result.definitive
+    result = verifier.verify('nx.com', 'alice').result(5)
+    assert not result.verified and result.definitive
+    # Timeouts might be temporary
+    result = verifier.verify('slow.com', 'alice').result(5)
+    assert not result.verified and not result.definitive
+
+def test_cached(verifier, dns):
+    assert verifier.verify('example.com', 'alice').result(5).verified
+    dns.records['example.com'] = ['webspace:bob']
+    assert verifier.verify('example.com', 'alice').done()
+    assert verifier.verify('example.com', 'alice').result().verified
+    assert not verifier.verify('example.com', 'alice', fresh=True).result(5).verified
+
+def test_reverify_survives_errors(verifier):
+    results = []
+    calls = []
+    done = threading.Event()
+    def get_domains():
+        calls.append(1)
+        if len(calls) == 1:
+            raise Exception('store is locked')
+        return {'example.com': 'alice', 'nx.com': 'alice'}
+    def on_result(domain, user, verification):
+        results.append((domain, verification.verified))
+        if len(results) >= 4:
+            done.set()
+        if domain == 'example.com':
+            raise Exception('handler failed')
+
+    verifier.start_reverify(get_domains, on_result, 0.01, batch_interval=0)
+    # The first pass failing and each failing handler don't stop the next ones
+    assert done.wait(5)
+    assert results[:4] == [('example.com', True), ('nx.com', False)] * 2
@@ -0,0 +1,202 @@
+import argparse
+import shutil
+import threading
+import time
+
+import pytest
+
+from bench.fake_dns import FakeDNS
+from bench.manager import Bench
+from webspace_ng.cli.client import Client
+from webspace_ng.unixrpc import UnixServerProxy
+from .verify import DomainVerifier, Verification
+
+def bench_args(**kwargs):
+    args = dict(boot_delay=0, stop_delay=0, api_latency=0, startup_delay=0, run_limit=4, users=1,
+                memory_budget=0, bridge='')
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+@pytest.fixture
+def make_bench():
+    """Start a `Manager` against the fake LXD (see `bench.manager`), with a container for `users` users."""
+    benches = []
+    def make(**kwargs):
+        bench = Bench(bench_args(**kwargs))
+        benches.append(bench)
+        return bench
+    yield make
+    for bench in benches:
+        bench.stop()
+        shutil.rmtree(bench.tmp, ignore_errors=True)
+
+def test_forwarding_dropped_when_container_stops(make_bench):
+    bench = make_bench()
+    manager, user = bench.manager, bench.users[0]
+    name = manager.user_container(user)
+    stopped = []
+    container_stopped = manager.tcp_proxy.container_stopped
+    manager.tcp_proxy.container_stopped = lambda u: (stopped.append(u), container_stopped(u))
+
+    with UnixServerProxy(bench.config.bind_socket) as proxy:
+        ip = proxy.boot_and_ip(user)
+    assert manager.ip_cache[name] == ip
+    assert name in manager.running_containers
+
+    # Stopped from inside the container, noticed by the next sample
+    bench.lxd.set_state(name, 'stop')
+    manager.sampler.tick()
+    assert name not in manager.ip_cache
+    assert name not in manager.running_containers
+    assert stopped == [user]
+
+    with UnixServerProxy(bench.config.bind_socket) as proxy:
+        assert proxy.boot_and_ip(user) == ip
+    assert bench.lxd.containers[name]['status'] == 'Running'
+
+def test_reverify_failures_counted(make_bench):
+    bench = make_bench()
+    manager, user = bench.manager, bench.users[0]
+    dns = FakeDNS(records={'example.com': ['webspace:{}'.format(user)]}).start()
+    manager.verifier.stop()
+    manager.verifier = DomainVerifier(['127.0.0.1'], dns.port, timeout=1)
+
+    with Client(bench.config.bind_socket, user=user) as client:
+        client.add_domain('example.com')
+        wait_for(lambda: 'example.com' in client.get_domains())
+
+    dns.records['example.com'] = ['webspace:someone-else']
+    manager.verifier.start_reverify(lambda: dict(manager.custom_domains.domains), manager._domain_reverified,
+                                    0.05, batch_interval=0)
+    # Only reported by default
+    wait_for(lambda: manager.domain_failures.get('example.com', 0) >= 3)
+    assert manager.custom_domains.get('example.com') == user
+
+    manager.config.dns.reverify_failures = 5
+    wait_for(lambda: 'example.com' not in manager.custom_domains)
+    assert manager.store.domains(user) == []
+    assert 'example.com' not in manager.domain_failures
+    dns.shutdown()
+
+def test_reverify_success_resets_failures(make_bench):
+    bench = make_bench()
+    manager, user = bench.manager, bench.users[0]
+    manager.store.add_domain(user, 'example.com')
+    manager.custom_domains.add('example.com', user)
+    manager.config.dns.reverify_failures = 2
+
+    failed = Verification(False, True, 'no TXT record')
+    manager._domain_reverified('example.com', user, failed)
+    assert manager.domain_failures['example.com'] == 1
+    manager._domain_reverified('example.com', user, Verification(True, True, 'verified'))
+    assert 'example.com' not in manager.domain_failures
+
+    # A failure which might be temporary starts the count again
+    manager._domain_reverified('example.com', user, failed)
+    manager._domain_reverified('example.com', user, Verification(False, False, 'timed out'))
+    manager._domain_reverified('example.com', user, failed)
+    assert manager.custom_domains.get('example.com') == user
+
+def test_removed_domain_failures_forgotten(make_bench):
+    bench = make_bench()
+    manager, user = bench.manager, bench.users[0]
+    manager.store.add_domain(user, 'example.com')
+    manager.custom_domains.add('example.com', user)
+    manager._domain_reverified('example.com', user, Verification(False, True, 'no TXT record'))
+
+    with Client(bench.config.bind_socket, user=user) as client:
+        client.remove_domain('example.com')
+    assert 'example.com' not in manager.domain_failures
+
+def test_admission_refused(make_bench):
+    bench = make_bench(memory_budget=128)
+    user = bench.users[0]
+    with UnixServerProxy(bench.config.bind_socket) as proxy:
+        assert proxy.boot_and_host('{}{}'.format(user, bench.config.domain_suffix), False) == [None, 'unavailable']
+    assert bench.lxd.containers[bench.manager.user_container(user)]['status'] == 'Stopped'
+
+def test_admission_evicts_least_recently_used(make_bench):
+    bench = make_bench(memory_budget=500, users=3)
+    manager = bench.manager
+    manager.admission.reserve = 0
+    names = [manager.user_container(u) for u in bench.users]
+    for name in names:
+        bench.lxd.set_memory(name, 200 * 1024 * 1024)
+
+    with UnixServerProxy(bench.config.bind_socket) as proxy:
+        proxy.boot_and_ip(bench.users[0])
+        proxy.boot_and_ip(bench.users[1])
+        # Traffic makes the first container the most recently used
+        proxy.record_traffic({'{}{}'.format(bench.users[0], bench.config.domain_suffix): {'requests': 1}})
+        assert manager.running_containers == [names[1], names[0]]
+
+        proxy.boot_and_ip(bench.users[2])
+    assert manager.running_containers == [names[0], names[2]]
+    assert bench.lxd.containers[names[1]]['status'] == 'Stopped'
+
+def test_exec_batch_output_truncated(make_bench):
+    bench = make_bench()
+    user = bench.users[0]
+    bench.config.exec.max_output = 5
+
+    with Client(bench.config.bind_socket, user=user) as client:
+        def run(command):
+            op = client.exec_batch(command, {}, 0)
+            info = client.operation_wait(op, 10)
+            assert info['state'] == 'success'
+            return info['result'][user]
+
+        assert run(['echo', 'hi']) == {'status': 0, 'truncated': False, 'stdout': 'hi\n', 'stderr': ''}
+        result = run(['echo', 'hello', 'world'])
+    assert result['stdout'] == 'hello'
+    assert result['truncated']
+    # The logs are deleted either way
+    assert bench.lxd.containers[bench.manager.user_container(user)]['_logs'] == {}
+
+def test_boot_waits_for_stop(make_bench):
+    bench = make_bench(stop_delay=0.5)
+    manager, user = bench.manager, bench.users[0]
+    name = manager.user_container(user)
+    with UnixServerProxy(bench.config.bind_socket) as proxy:
+        ip = proxy.boot_and_ip(user)
+
+        # Shut down by an operation, with a request arriving while it's stopping
+        stopping = threading.Thread(target=manager.stop_container, args=(manager.client.containers.get(name),))
+        stopping.start()
+        wait_for(lambda: name in manager.stopping)
+        assert proxy.boot_and_ip(user) == ip
+        stopping.join()
+
+    assert bench.lxd.containers[name]['status'] == 'Running'
+    assert manager.running_containers == [name]
+    assert manager.ip_cache[name] == ip
+    assert manager.stopping == {}
+
+def test_failed_create_releases_address(make_bench):
+    bench = make_bench(bridge='lxdbr0')
+    manager, user = bench.manager, bench.users[0]
+    assert manager.addresses.get(user) is not None
+
+    def wait(client, op):
+        while True:
+            info = client.operation_wait(op, 10)
+            if info['state'] in ('success', 'failure'):
+                return info['state']
+
+    with Client(bench.config.bind_socket, user=user) as client:
+        assert wait(client, client.delete()) == 'success'
+        assert manager.addresses.get(user) is None
+
+        def create(config, op=None):
+            raise KeyError('out of disk space')
+        bench.lxd.create = create
+        assert wait(client, client.init(bench.fingerprint)) == 'failure'
+    assert manager.addresses.get(user) is None
+    assert user not in manager.addresses.users
+    assert user not in manager.store.all_addresses()
@@ -0,0 +1,66 @@
+import logging
+import threading
+import time
+
+_local = threading.local()
+
+class Trace:
+    def __init__(self, trace_id, name, start=None):
+        self.id = trace_id
+        self.name = name
+        self.start = start if start is not None else time.perf_counter()
+        self.path = [name]
+        # (path, duration)
+        self.spans = []
+
+    def record(self, name, duration):
+        self.spans.append(('/'.join(self.path + [name]), duration))
+    def format(self, total):
+        return 'trace {}: {}={:.2f}ms {}'.format(self.id, self.name, total * 1000,
+            ' '.join('{}={:.2f}ms'.format(path, duration * 1000) for path, duration in self.spans))
+
+class _Span:
+    __slots__ = ('trace', 'name', 'start')
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+    def __enter__(self):
+        if self.trace is not None:
+            self.trace.path.append(self.name)
+            self.start = time.perf_counter()
+        return self
+    def __exit__(self, _ex_type, _ex, _trace):
+        if self.trace is not None:
+            duration = time.perf_counter() - self.start
+            self.trace.path.pop()
+            self.trace.record(self.name, duration)
+
+def current():
+    return getattr(_local, 'trace', None)
+def span(name):
+    """Time a block of code as part of the current trace (does nothing if no trace is active)."""
+    return _Span(current(), name)
+def record(name, duration):
+    """Record an already timed operation in the current trace."""
+    t = current()
+    if t is not None:
+        t.record(name, duration)
+
+class start:
+    """
+    Start a trace for the current thread, logging all of its spans once finished. Traces which take
+    longer than `slow_threshold` seconds are logged at the INFO level, otherwise at DEBUG.
+    """
+    def __init__(self, trace_id, name, slow_threshold, start=None):
+        self.trace = Trace(trace_id, name, start=start)
+        self.slow_threshold = slow_threshold
+
+    def __enter__(self):
+        _local.trace = self.trace
+        return self.trace
+    def __exit__(self, _ex_type, _ex, _trace):
+        _local.trace = None
+        total = time.perf_counter() - self.trace.start
+        level = logging.INFO if total >= self.slow_threshold else logging.DEBUG
+        if logging.getLogger().isEnabledFor(level):
+            logging.log(level, '%s', self.trace.format(total))
@@ -0,0 +1,127 @@
+from concurrent.futures import Future
+from collections import namedtuple
+import asyncio
+import logging
+import threading
+import time
+
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
+
+# `values` is the set of TXT strings (`None` if the lookup failed), `definitive` is `False`
+# if the lookup failed for reasons which might be temporary (e.g. a timeout)
+TxtRecords = namedtuple('TxtRecords', ('values', 'definitive', 'error'))
+Verification = namedtuple('Verification', ('verified', 'definitive', 'message'))
+
+class DomainVerifier:
+    """
+    Verifies custom domains (by the `webspace:<user>` TXT record) with an asynchronous
+    resolver running on its own event loop thread, so slow or broken nameservers never
+    tie up RPC threads. Lookups time out after `timeout` seconds, concurrent lookups of
+    the same domain are shared and results are cached (for the record's TTL, at most
+    `ttl` seconds, or `negative_ttl` seconds for failures).
+    """
+    def __init__(self, nameservers=(), port=53, timeout=5, ttl=3600, negative_ttl=30):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.resolver = dns.asyncresolver.Resolver(configure=not nameservers)
+        if nameservers:
+            self.resolver.nameservers = list(nameservers)
+        self.resolver.port = port
+        self.resolver.lifetime = timeout
+
+        # domain -> (TxtRecords, expiry)
+        self.cache = {}
+        # domain -> asyncio.Task, only accessed from the event loop
+        self.inflight = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    async def _resolve(self, domain):
+        try:
+            answer = await self.resolver.resolve(domain, 'TXT')
+        except dns.resolver.NXDOMAIN:
+            return TxtRecords(None, True, "'{}' does not exist".format(domain)), self.negative_ttl
+        except dns.resolver.NoAnswer:
+            return TxtRecords(frozenset(), True, None), self.negative_ttl
+        except dns.exception.DNSException as ex:
+            return TxtRecords(None, False, 'DNS lookup failed: {}'.format(ex)), self.negative_ttl
+
+        values = frozenset(s.decode('utf8', errors='replace') for rdata in answer for s in rdata.strings)
+        return TxtRecords(values, True, None), min(answer.rrset.ttl, self.ttl)
+    async def _lookup(self, domain):
+        task = self.inflight.get(domain)
+        if task is None:
+            task = self.inflight[domain] = self.loop.create_task(self._resolve(domain))
+            task.add_done_callback(lambda _: self.inflight.pop(domain, None))
+
+        records, ttl = await asyncio.shield(task)
+        self.cache[domain] = (records, time.monotonic() + ttl)
+        return records
+
+    @staticmethod
+    def _check(domain, user, records):
+        if records.values is None:
+            return Verification(False, records.definitive, records.error)
+        if 'webspace:{}'.format(user) in records.values:
+            return Verification(True, True, "'{}' has been verified".format(domain))
+        return Verification(False, True, "no TXT record 'webspace:{}' found for '{}'".format(user, domain))
+    async def _verify(self, domain, user):
+        return self._check(domain, user, await self._lookup(domain))
+
+    def verify(self, domain, user, fresh=False):
+        """
+        Check that `domain` belongs to `user`, returns a `concurrent.futures.Future` for a
+        `Verification` (which will already be done if the result was cached and `fresh`
+        is `False`).
+        """
+        cached = self.cache.get(domain)
+        if not fresh and cached is not None and cached[1] > time.monotonic():
+            future = Future()
+            future.set_result(self._check(domain, user, cached[0]))
+            return future
+        return asyncio.run_coroutine_threadsafe(self._verify(domain, user), self.loop)
+
+    async def _reverify_all(self, get_domains, on_result, batch_size, batch_interval):
+        domains = list(get_domains().items())
+        logging.info('re-verifying %d custom domains', len(domains))
+        for i in range(0, len(domains), batch_size):
+            batch = domains[i:i + batch_size]
+            results = await asyncio.gather(*(self._verify(domain, user) for domain, user in batch))
+            for (domain, user), result in zip(batch, results):
+                try:
+                    on_result(domain, user, result)
+                except Exception:
+                    logging.exception('failed to handle re-verification of %s for %s', domain, user)
+            await asyncio.sleep(batch_interval)
+    async def _reverify(self, get_domains, on_result, interval, batch_size, batch_interval):
+        while True:
+            await asyncio.sleep(interval)
+            # Keep going if a pass fails, it's the only thing checking domains are still owned
+            try:
+                await self._reverify_all(get_domains, on_result, batch_size, batch_interval)
+            except Exception:
+                logging.exception('failed to re-verify custom domains')
+    def start_reverify(self, get_domains, on_result, interval, batch_size=16, batch_interval=1):
+        """
+        Every `interval` seconds, re-verify all domains (`get_domains()` returns a dict of
+        domain -> user), `batch_size` at a time with `batch_interval` seconds between
+        batches. `on_result(domain, user, verification)` is called (on the event loop
+        thread) for each domain.
+        """
+        asyncio.run_coroutine_threadsafe(
+            self._reverify(get_domains, on_result, interval, batch_size, batch_interval), self.loop)
+
+    async def _cancel_all(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._cancel_all(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+import uuid
+
+from .. import WebspaceError
+from . import metrics
+
+class WarmPool:
+    """
+    Keeps stopped, pre-created containers for popular images (`images` is a dict of
+    alias -> number of containers) so `init` can claim one by renaming it instead of
+    waiting for the image to be unpacked. The pool is refilled in the background one
+    container at a time, backing off whenever `busy()` (e.g. users' own operations are
+    running).
+    """
+    def __init__(self, client, catalog, images, prefix, profile, busy=lambda: False, interval=30):
+        self.client = client
+        self.catalog = catalog
+        self.images = dict(images)
+        self.prefix = prefix
+        self.profile = profile
+        self.busy = busy
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        # name -> (alias, fingerprint)
+        self.containers = {}
+        metrics.Gauge('webspaced_warm_pool_containers', 'Pre-created containers ready to be claimed',
+                      self._counts, label='image')
+
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _counts(self):
+        counts = dict.fromkeys(self.images, 0)
+        with self.lock:
+            for alias, _ in self.containers.values():
+                counts[alias] = counts.get(alias, 0) + 1
+        return counts
+    def _load(self):
+        with metrics.lxd('containers.all'):
+            containers = self.client.api.containers.get(params={'recursion': 1}).json()['metadata']
+        with self.lock:
+            for c in containers:
+                if c['name'].startswith(self.prefix):
+                    self.containers[c['name']] = (c['config'].get('user._warm_alias', ''),
+                                                  c['config'].get('volatile.base_image', ''))
+        logging.info('%d pre-created containers in the warm pool', len(self.containers))
+
+    def claim(self, fingerprint):
+        """Take a pre-created container for the image `fingerprint`, returns its name (or `None`)."""
+        with self.lock:
+            name = next((n for n, (_, fp) in self.containers.items() if fp == fingerprint), None)
+            if name is not None:
+                del self.containers[name]
+        metrics.warm_pool_claims.inc('miss' if name is None else 'hit')
+        self.wakeup.set()
+        return name
+
+    def _delete(self, name):
+        logging.info('removing outdated pre-created container %s', name)
+        with metrics.lxd('containers.get'):
+            container = self.client.containers.get(name)
+        with metrics.lxd('delete'):
+            container.delete(wait=True)
+    def _create(self, alias, fingerprint):
+        name = '{}{}'.format(self.prefix, uuid.uuid4().hex[:12])
+        start = time.perf_counter()
+        with metrics.warm_pool_refill.time(alias), metrics.lxd('create'):
+            self.client.containers.create({
+                'name': name,
+                'ephemeral': False,
+                'profiles': [self.profile],
+                'source': {
+                    'type': 'image',
+                    'fingerprint': fingerprint
+                },
+                'config': {
+                    'user._warm_alias': alias,
+                }
+            }, wait=True)
+        logging.info('pre-created container %s (%s) in %.1fs', name, alias, time.perf_counter() - start)
+        with self.lock:
+            self.containers[name] = (alias, fingerprint)
+    def _refill_one(self):
+        """Create or remove (at most) one container, returns `False` if there was nothing to do."""
+        current = {}
+        for alias in self.images:
+            try:
+                current[alias] = self.catalog.resolve(alias)['fingerprint']
+            except WebspaceError as ex:
+                logging.warning('not pre-creating containers for %s: %s', alias, ex)
+
+        with self.lock:
+            containers = dict(self.containers)
+        for name, (alias, fingerprint) in containers.items():
+            # The alias now points to a newer image (or isn't pooled any more)
+            if alias not in self.images or (alias in current and current[alias] != fingerprint):
+                with self.lock:
+                    if self.containers.pop(name, None) is None:
+                        continue
+                self._delete(name)
+                return True
+
+        counts = self._counts()
+        for alias, fingerprint in current.items():
+            if counts.get(alias, 0) < self.images[alias]:
+                self._create(alias, fingerprint)
+                return True
+        return False
+    def _run(self):
+        try:
+            self._load()
+        except Exception:
+            logging.exception('failed to find pre-created containers')
+
+        while not self.stopped.is_set():
+            if self.busy():
+                self.stopped.wait(1)
+                continue
+
+            try:
+                refilled = self._refill_one()
+            except Exception:
+                logging.exception('failed to refill the warm pool')
+                refilled = False
+            if not refilled:
+                self.wakeup.wait(self.interval)
+                self.wakeup.clear()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
@@ -1,22 +1,39 @@
 from urllib import parse
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 import ipaddress
 import logging
-import random
 import uuid
-import pwd
-import grp
 import time
 import signal
 import threading
+import queue
 
+from munch import Munch
+import requests
 from pylxd import Client
+from pylxd.exceptions import NotFound
 from pylxd.models import Operation
-import dns.resolver
 
-from .. import ADMIN_GROUP, WebspaceError
+from .. import ADMIN_GROUP, WebspaceError, nss
+from . import metrics, trace
+from .profiler import Profiler
 from .console import ConsoleSession
+from .sessions import SessionRegistry
+from .files import FileTransfer
 from .tcp_proxy import TcpProxy
+from .nft import NftForwarding
+from .store import Store, Mirror, TRAFFIC_FIELDS
+from .ports import PortAllocator
+from .domains import DomainIndex, split_domain
+from .verify import DomainVerifier
+from .images import ImageCatalog
+from .operations import Operations
+from .warm_pool import WarmPool
+from .admission import AdmissionController, NotEnoughMemory
+from .sampler import ResourceSampler, FIELDS
+from .lxd import LXDAdapter, CircuitBreaker, LXDUnavailable
+from .addresses import AddressAllocator
 
 def str2bool(s):
     ls = s.lower()
@@ -31,21 +48,13 @@ def port(s):
         raise ValueError('Port must be in the range 1-65535')
     return port
 
-def image_info(image):
-    return {
-        'fingerprint': image.fingerprint,
-        'aliases': image.aliases,
-        'properties': image.properties,
-        'size': image.size,
-    }
-
 def check_user(f):
     @wraps(f)
     def wrapper(self, *args):
         req = self.server.current_request
         if req.client_user in self.admins:
             try:
-                pwd.getpwnam(args[0])
+                nss.cache.getpwnam(args[0])
             except KeyError:
                 raise WebspaceError('User {} does not exist'.format(args[0]))
             return f(self, *args)
@@ -59,14 +68,20 @@ def check_admin(f):
             raise WebspaceError('You must be an admin to call this function')
         return f(self, *args)
     return wrapper
-def check_init(f):
+def check_exists(f):
     @wraps(f)
     @check_user
     def wrapper(self, user, *args):
-        container_name = self.user_container(user)
-        if not self.client.containers.exists(container_name):
+        if not self.store.has_container(user):
             raise WebspaceError('Your container has not been initialized')
-        container = self.client.containers.get(container_name)
+        return f(self, user, *args)
+    return wrapper
+def check_init(f):
+    @wraps(f)
+    @check_exists
+    def wrapper(self, user, *args):
+        with metrics.lxd('containers.get'):
+            container = self.client.containers.get(self.user_container(user))
         return f(self, user, container, *args)
     return wrapper
 def check_running(f):
@@ -81,18 +96,18 @@ def check_exec(f):
     @wraps(f)
     @check_running
     def wrapper(self, user, container, session_id, *args):
-        if not user in self.exec_sessions:
-            raise WebspaceError("Your container doesn't have any active exec sessions")
-        session = self.exec_sessions[user][session_id]
+        session = self.sessions.get(user, 'exec', session_id)
+        if session is None:
+            raise WebspaceError("Exec session {} doesn't exist (or has finished)".format(session_id))
         return f(self, user, container, session_id, session, *args)
     return wrapper
 def check_console(f):
     @wraps(f)
     @check_running
     def wrapper(self, user, container, *args):
-        if not user in self.console_sessions:
+        session = self.sessions.get(user, 'console')
+        if session is None:
             raise WebspaceError("Your container doesn't have an active console session")
-        session = self.console_sessions[user]
         return f(self, user, container, session, *args)
     return wrapper
 
@@ -102,18 +117,53 @@ class Manager:
                'boot_and_ip', 'get_config', 'set_option', 'unset_option',
                'get_domains', 'add_domain', 'remove_domain', 'get_ports',
                'add_port', 'remove_port', 'exec', 'exec_close', 'exec_resize',
-               'exec_signal'}
+               'exec_signal', 'profile', 'verify_domain', 'refresh_users',
+               'resolve_image', 'operation_status', 'operation_wait', 'status_history',
+               'exec_batch', 'fleet_exec', 'push', 'pull', 'record_traffic', 'stats'}
     private_options = {'_domains', '_ports', '_domain_suffix'}
 
     def __init__(self, config, server):
         self.config = config
 
         endpoint = 'http+unix://{}'.format(parse.quote(config.lxd.socket, safe=''))
+        self.lxd = LXDAdapter(config.lxd.pool_size, config.lxd.pool_timeout, config.lxd.connect_timeout,
+                              config.lxd.timeout, config.lxd.retries,
+                              breaker=CircuitBreaker(config.lxd.breaker_threshold, config.lxd.breaker_reset))
         self.client = Client(endpoint=endpoint)
+        # Replace pylxd's adapter (which keeps a pool of one connection per URL), pylxd >= 2.3.2 shares this session
+        # with every API node
+        self.client.api.session.mount('http+unix://', self.lxd)
         self.server = server
-        self.admins = set(grp.getgrnam(ADMIN_GROUP).gr_mem)
-        self.exec_sessions = {}
-        self.console_sessions = {}
+        self.profiler = Profiler()
+        self.image_catalog = ImageCatalog(self.client, config.lxd.image_ttl)
+        self.operations = Operations(config.operations.workers, config.operations.keep)
+        self.warm_pool = None
+        if config.warm_pool.images:
+            self.warm_pool = WarmPool(self.client, self.image_catalog, config.warm_pool.images,
+                                      config.warm_pool.prefix, config.lxd.profile,
+                                      busy=lambda: bool(self.operations.active))
+        self.admission = None
+        if config.admission.enabled:
+            mib = 1024 * 1024
+            self.admission = AdmissionController(
+                self.container_memory, config.admission.budget * mib, config.admission.reserve * mib,
+                config.admission.default_usage * mib, config.admission.psi_threshold,
+                # Usually kept up to date by the sampler, rather than asking LXD while holding the container lock
+                max(config.admission.max_age, 2 * config.sampler.interval))
+        self.sampler = None
+        if config.sampler.interval:
+            self.sampler = ResourceSampler(self.client, config.lxd.suffix, config.sampler.interval,
+                                           config.sampler.history, on_sample=self._on_sample,
+                                           on_stopped=self._on_stopped, max_wait=config.sampler.max_wait)
+        self.addresses = None
+        if config.lxd.net.bridge:
+            self.addresses = AddressAllocator(config.lxd.net.cidr, [self.bridge_address()])
+        # Containers which were already running when they were given a fixed address, they keep the address they
+        # got before until they're next stopped
+        self.renumbering = set()
+        nss.cache.ttl = config.nss.ttl
+        nss.cache.negative_ttl = config.nss.negative_ttl
+        self.sessions = SessionRegistry(config.sessions.max_per_user, config.sessions.max)
         self.reserved_options = {
             'terminate_ssl': str2bool,
             'startup_delay': self.startup_delay,
@@ -121,40 +171,213 @@ class Manager:
             'https_port': port,
         }
 
-        self.running_containers = list(map(lambda c: c.name, filter(
-            lambda c: c.name.endswith(self.config.lxd.suffix) and c.status_code == 103,
-            self.client.containers.all())))
-        self.container_lock = threading.RLock()
-        logging.debug('containers running at startup: %s', self.running_containers)
+        self.running_containers = []
+        self.container_lock = metrics.TimedLock(threading.RLock(), metrics.lock_wait)
+        # name -> Event set once the container has stopped, for containers being stopped (without
+        # the lock held) so they aren't routed to or booted in the meantime
+        self.stopping = {}
+        metrics.Gauge('webspaced_sessions', 'Active console / exec sessions', self.sessions.counts, label='type')
 
         self.ip_cache = {}
 
-        self.custom_domains = {}
-        self.tcp_proxy = TcpProxy(config.ports.proxy_bin, config.bind_socket)
-        self.forwarded_ports = set()
-        for container in filter(lambda c: c.name.endswith(self.config.lxd.suffix), self.client.containers.all()):
-            user = self.container_user(container)
-            for domain in self.get_container_domains(container):
-                self.custom_domains[domain] = user
-            for iport, eport in self.get_container_ports(container).items():
-                logging.info('existing port forward %d -> %s:%d', eport, user, iport)
-                self.forwarded_ports.add(eport)
-                self.tcp_proxy.add_forwarding(eport, user, iport)
+        self.custom_domains = DomainIndex(config.domain_suffix)
+        self.verifier = DomainVerifier(config.dns.nameservers, config.dns.port, config.dns.timeout,
+                                       config.dns.cache_ttl, config.dns.negative_ttl)
+        # (domain, user) -> future for verifications started by add_domain / verify_domain (until they finish)
+        self.domain_checks = {}
+        # domain -> number of consecutive failed re-verifications
+        self.domain_failures = {}
+        if config.dns.reverify_interval:
+            self.verifier.start_reverify(lambda: dict(self.custom_domains.domains), self._domain_reverified,
+                                         config.dns.reverify_interval, config.dns.reverify_batch,
+                                         config.dns.reverify_delay)
+        self.tcp_proxy = TcpProxy(config.ports.proxy_bin, config.bind_socket, config.ports.proxy_control)
+        self.tcp_proxy.set_limits(config.ports.max_conns, config.ports.max_user_conns,
+                                  config.ports.idle_timeout, config.ports.max_lifetime)
+        if config.ports.mode == 'nftables':
+            self.tcp_proxy = NftForwarding(self.tcp_proxy, config.ports.nft_table)
+        self.ports = PortAllocator(config.ports.start, config.ports.end, config.ports.max, config.ports.reserved)
 
-        logging.info('existing custom domain configuration: %s', self.custom_domains)
+        self.store = Store(config.store_file)
+        self.mirror = Mirror(self.sync_container)
+        # Containers left running by the last daemon (`shutdown.persist`), adopted by `reconcile()`
+        self.adopted = {self.user_container(user): (ip, started) for user, ip, started in self.store.running()}
+        self.running_containers.extend(self.adopted)
+        if self.store.containers():
+            # Serve from the store straight away and check it against LXD in the background
+            self.custom_domains.load(self.store.all_domains())
+            if self.addresses is not None:
+                self.addresses.load(self.store.all_addresses())
+            self.add_forwardings([(eport, user, iport) for eport, (user, iport) in self.store.all_ports().items()])
+            threading.Thread(target=self.reconcile, daemon=True).start()
+        else:
+            self.reconcile()
+        if config.ports.proxy_control:
+            # Drop anything a re-attached proxy is still forwarding that we no longer know about
+            with self.container_lock:
+                self.tcp_proxy.retain_forwardings(list(self.ports.forwards))
 
-    def _stop(self):
-        for execs in self.exec_sessions.values():
-            for session in execs.values():
-                session.stop(join=True)
-        for session in self.console_sessions.values():
-            session.stop(join=True)
+        logging.debug('containers running at startup: %s', self.running_containers)
+        logging.info('existing custom domain configuration: %s', self.custom_domains.domains)
 
+    def list_containers(self):
+        """Fetch every webspace container (including its config and status) in a single request."""
+        with metrics.lxd('containers.all'):
+            containers = self.client.api.containers.get(params={'recursion': 1}).json()['metadata']
+        return [Munch(c) for c in containers if c['name'].endswith(self.config.lxd.suffix)]
+    def add_forwardings(self, forwardings):
+        for eport, user, iport in forwardings:
+            logging.info('port forward %d -> %s:%d', eport, user, iport)
+            self.ports.add(user, iport, eport)
+        try:
+            self.tcp_proxy.add_forwardings(forwardings)
+        except WebspaceError as ex:
+            logging.error('%s', ex)
+    def reconcile(self):
+        """Bring the store, running containers, custom domains and port forwards in line with LXD."""
         with self.container_lock:
-            for c in self.running_containers:
-                container = self.client.containers.get(c)
+            running = []
+            started = {}
+            containers = {}
+            for container in self.list_containers():
                 if container.status_code == 103:
-                    container.stop(wait=True)
+                    running.append(container.name)
+                    started[container.name] = container.get('last_used_at')
+                options = {k[len('user.'):]: v for k, v in container.config.items()
+                           if k.startswith('user.') and k not in ('user._domains', 'user._ports')}
+                containers[self.container_user(container)] = \
+                    (options, self.get_container_domains(container), self.get_container_ports(container),
+                     self.get_container_address(container))
+            for user in self.store.reconcile(containers):
+                logging.info('configuration for %s has not been written to LXD yet', user)
+                self.mirror.schedule(user)
+            domains = self.store.all_domains()
+            ports = self.store.all_ports()
+
+            # Keep the boot order of containers we already know about
+            self.running_containers[:] = [c for c in self.running_containers if c in running] + \
+                [c for c in running if c not in self.running_containers]
+            for name in list(self.ip_cache):
+                if name not in running:
+                    del self.ip_cache[name]
+                    self.tcp_proxy.container_stopped(name[:-len(self.config.lxd.suffix)])
+            self.renumbering &= set(running)
+            if self.addresses is not None:
+                self.assign_addresses(running)
+            if self.adopted:
+                for name, (ip, last_started) in self.adopted.items():
+                    # Only trust the saved IP if the container hasn't been restarted since
+                    if ip and name in running and started[name] == last_started and name not in self.ip_cache:
+                        self.ip_cache[name] = ip
+                        self.tcp_proxy.container_started(name[:-len(self.config.lxd.suffix)], ip)
+                logging.info('adopted %d running containers', len(self.adopted))
+                self.adopted = {}
+                self.store.save_running([])
+
+            if domains != self.custom_domains.domains:
+                logging.debug('updating custom domains from LXD')
+                self.custom_domains.load(domains)
+
+            for eport, forwarding in list(self.ports.forwards.items()):
+                if ports.get(eport) != forwarding:
+                    logging.info('removing stale port forward %d -> %s:%d', eport, *forwarding)
+                    self.ports.release(eport)
+                    try:
+                        self.tcp_proxy.remove_forwarding(eport)
+                    except WebspaceError as ex:
+                        logging.error('%s', ex)
+            self.add_forwardings([(eport, user, iport) for eport, (user, iport) in ports.items()
+                                  if eport not in self.ports.forwards])
+
+    def assign_addresses(self, running):
+        """Load fixed addresses from the store, giving one to every container without one."""
+        addresses = {user: ip for user, ip in self.store.all_addresses().items()
+                     if ipaddress.IPv4Address(ip) in self.config.lxd.net.cidr}
+        self.addresses.load(addresses)
+        for user in self.store.containers():
+            name = self.user_container(user)
+            if user not in addresses:
+                ip = self.addresses.allocate(user)
+                logging.info('giving %s the fixed address %s', name, ip)
+                self.store.set_address(user, ip)
+                self.mirror.schedule(user)
+                if name in running:
+                    self.renumbering.add(name)
+
+            ip = self.fixed_address(name)
+            if ip is not None and name in running and name not in self.ip_cache:
+                self.ip_cache[name] = ip
+                self.tcp_proxy.container_started(user, ip)
+
+    def _stop_containers(self, names, deadline):
+        """Stop containers with `shutdown.workers` threads, giving up at `deadline`."""
+        pending = queue.Queue()
+        for name in names:
+            pending.put(name)
+        def worker():
+            while True:
+                try:
+                    name = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    with metrics.lxd('containers.get'):
+                        container = self.client.containers.get(name)
+                    if container.status_code == 103:
+                        with metrics.lxd('stop'):
+                            container.stop(wait=True)
+                except Exception:
+                    logging.exception('failed to stop container %s', name)
+
+        # Daemon threads so a hung stop can't hold up exit past the deadline
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(min(self.config.shutdown.workers, len(names)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(max(deadline - time.monotonic(), 0))
+        if any(t.is_alive() for t in threads):
+            logging.warning('shutdown timed out, some containers may still be running')
+    def _stop(self):
+        deadline = time.monotonic() + self.config.shutdown.timeout
+
+        sessions = self.sessions.all()
+        for session in sessions:
+            session.stop()
+        for session in sessions:
+            session.join(max(deadline - time.monotonic(), 0))
+
+        self.operations.stop(max(deadline - time.monotonic(), 0))
+        with self.container_lock:
+            if self.config.shutdown.persist:
+                try:
+                    started = {c.name: c.get('last_used_at') for c in self.list_containers()}
+                except Exception:
+                    logging.exception('failed to list containers, saved IPs will not be used')
+                    started = {}
+                users = set(self.store.containers())
+                suffix = len(self.config.lxd.suffix)
+                self.store.save_running([(c[:-suffix], self.ip_cache.get(c), started.get(c))
+                                         for c in self.running_containers if c[:-suffix] in users])
+                logging.info('leaving %d containers running', len(self.running_containers))
+            else:
+                logging.info('stopping %d containers', len(self.running_containers))
+                self._stop_containers(list(self.running_containers), deadline)
+                self.store.save_running([])
+        self.tcp_proxy.stop()
+
+        self.verifier.stop()
+        self.image_catalog.stop()
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.warm_pool is not None:
+            self.warm_pool.stop()
+        self.mirror.stop(timeout=max(deadline - time.monotonic(), 1))
+        self.store.close()
+
+    @property
+    def admins(self):
+        return nss.cache.group_members(ADMIN_GROUP)
 
     def user_container(self, user):
         return '{}{}'.format(user, self.config.lxd.suffix)
@@ -189,70 +412,268 @@ class Manager:
         if i < 0:
             raise ValueError('Startup delay must be positive')
         return i
-    def get_user_option(self, container, key):
-        value = container.config['user.{}'.format(key)]
+    def get_user_option(self, user, key):
+        value = self.store.option(user, key)
         if key in self.reserved_options:
             return self.reserved_options[key](value)
         return value
-    def check_valid_port(self, port):
-        if type(port) != int or (port != 0 and port < self.config.ports.start or port > self.config.ports.end):
-            raise WebspaceError("{} is not a valid port: must be in the range {} - {} (or zero for random)".format(port, self.config.ports.start, self.config.ports.end))
     def get_container_domains(self, container):
         return list(filter(lambda d: len(d) > 0, container.config.get('user._domains', '').split(',')))
-    def set_container_domains(self, container, domains):
-        container.config['user._domains'] = ','.join(domains)
-        container.save()
-    def next_random_port(self):
-        to_exclude = sorted(self.forwarded_ports)
-        if len(to_exclude) + self.config.ports.start == self.config.ports.end:
-            raise WebspaceError('all ports have been allocated')
-        port = random.randrange(self.config.ports.start, self.config.ports.end - len(to_exclude) + 1)
-        for p in to_exclude:
-            if port < p:
-                break
-            port += 1
-        return port
     def get_container_ports(self, container):
         return {iport: eport for iport, eport in map(lambda p: map(int, p.split(':')), filter(lambda p: len(p) > 0, container.config.get('user._ports', '').split(',')))}
-    def set_container_ports(self, container, ports):
-        container.config['user._ports'] = ','.join(map(lambda p: f'{p[0]}:{p[1]}', ports.items()))
-        container.save()
+    def get_container_address(self, container):
+        return (container.get('devices') or {}).get(self.config.lxd.net.container_iface, {}).get('ipv4.address')
+    def nic_device(self, ip):
+        return {
+            'type': 'nic',
+            'nictype': 'bridged',
+            'parent': self.config.lxd.net.bridge,
+            'name': self.config.lxd.net.container_iface,
+            'ipv4.address': ip,
+        }
+    def bridge_address(self):
+        """The bridge's own address (assumed to be the first in `lxd.net.cidr` if LXD can't be asked)."""
+        try:
+            with metrics.lxd('networks.get'):
+                network = self.client.api.networks[self.config.lxd.net.bridge].get().json()['metadata']
+            return ipaddress.IPv4Interface(network['config']['ipv4.address']).ip
+        except Exception as ex:
+            logging.warning('failed to get the address of %s: %s', self.config.lxd.net.bridge, ex)
+            return next(self.config.lxd.net.cidr.hosts())
+    def fixed_address(self, name):
+        """A container's fixed address, `None` if it doesn't have one (or isn't using it yet)."""
+        if self.addresses is None or name in self.renumbering:
+            return None
+        return self.addresses.get(name[:-len(self.config.lxd.suffix)])
+    def known_ip(self, name):
+        """
+        The address of a running container with a fixed address, unless the sampler has
+        seen it stop since (`None` if LXD needs to be asked).
+        """
+        if self.fixed_address(name) is None:
+            return None
+        if self.sampler is not None:
+            state = self.sampler.state(name)
+            if state is not None and state['status_code'] != 103:
+                return None
+        return self.ip_cache.get(name)
+    def sync_container(self, user):
+        """Write a container's options, domains, ports and fixed address from the store to its LXD config."""
+        state = self.store.get(user)
+        if state is None:
+            return
+        version, options, domains, ports, address = state
+
+        try:
+            with metrics.lxd('containers.get'):
+                container = self.client.containers.get(self.user_container(user))
+        except NotFound:
+            return
+        config = {k: v for k, v in container.config.items() if not k.startswith('user.')}
+        config.update({'user.{}'.format(k): v for k, v in options.items()})
+        config['user._domains'] = ','.join(domains)
+        config['user._ports'] = ','.join(map(lambda p: f'{p[0]}:{p[1]}', ports.items()))
+        container.config = config
+        if address is not None and self.addresses is not None:
+            devices = dict(container.devices)
+            devices[self.config.lxd.net.container_iface] = self.nic_device(address)
+            container.devices = devices
+        with metrics.lxd('save'):
+            container.save(wait=True)
+        self.store.mark_synced(user, version)
+    def _wait_stopping(self, container):
+        """If the container is being stopped, wait for that to finish and refresh its status."""
+        stopping = self.stopping.get(container.name)
+        if stopping is not None:
+            stopping.wait()
+            with metrics.lxd('containers.get'):
+                container.sync()
     def start_container(self, container):
-        with self.container_lock:
-            if len(self.running_containers) == self.config.run_limit:
-                c = self.running_containers.pop(0)
-                to_shutdown = self.client.containers.get(c)
+        while True:
+            self._wait_stopping(container)
+            with self.container_lock:
+                # Might have started being stopped while we were waiting for the lock
+                if container.name not in self.stopping:
+                    return self._start_container(container)
+    def _start_container(self, container):
+        with metrics.boot_duration.time():
+            if container.name in self.running_containers:
+                # Booted by another request while we were waiting for the lock
+                return
+            evict = []
+            if self.admission is not None:
+                evict = self.admission.plan(container.name, self.running_containers)
+                if evict:
+                    metrics.evictions.inc('memory', len(evict))
+            # `run_limit` is still a hard cap on the number of running containers
+            over = len(self.running_containers) - len(evict) - self.config.run_limit + 1
+            if self.config.run_limit and over > 0:
+                evict.extend(self.running_containers[len(evict):len(evict) + over])
+                metrics.evictions.inc('run_limit', over)
+
+            for c in evict:
+                self.running_containers.remove(c)
+                with metrics.lxd('containers.get'):
+                    to_shutdown = self.client.containers.get(c)
                 if to_shutdown.status_code == 103:
-                    logging.debug('at run limit, shutting down container %s', to_shutdown.name)
+                    logging.debug('making room, shutting down container %s', to_shutdown.name)
                     self.stop_container(to_shutdown)
 
             logging.info('booting container %s', container.name)
-            container.start(wait=True)
+            with metrics.lxd('start'):
+                container.start(wait=True)
             self.running_containers.append(container.name)
+            ip = self.fixed_address(container.name)
+            if ip is not None:
+                # Routable before the container has finished booting
+                self.ip_cache[container.name] = ip
+                self.tcp_proxy.container_started(self.container_user(container), ip)
             # Wait for the container to get an IP
-            time.sleep(self.get_user_option(container, 'startup_delay'))
+            time.sleep(self.get_user_option(self.container_user(container), 'startup_delay'))
+    def _on_sample(self, name, sample):
+        if self.admission is not None:
+            self.admission.record(name, sample[FIELDS.index('memory')])
+    def container_memory(self, name):
+        try:
+            with open(self.config.admission.cgroup.format(name)) as cgroup:
+                return int(cgroup.read())
+        except (OSError, ValueError):
+            pass
+        with metrics.lxd('state'):
+            return self.client.api.containers[name].state.get().json()['metadata']['memory']['usage']
+    def _on_stopped(self, names):
+        """Catch containers which stopped without us stopping them (e.g. shut down from inside)."""
+        for name in names:
+            if name not in self.running_containers and name not in self.ip_cache:
+                continue
+            with self.container_lock:
+                # Might have been booted since it was sampled
+                with metrics.lxd('containers.get'):
+                    container = self.client.containers.get(name)
+                if container.status_code != 103:
+                    logging.info('container %s has stopped', name)
+                    self._forget_running(container)
+    def _forget_running(self, container):
+        """Drop everything we keep about a running container (with the container lock held)."""
+        if container.name in self.ip_cache:
+            del self.ip_cache[container.name]
+        self.renumbering.discard(container.name)
+        self.tcp_proxy.container_stopped(self.container_user(container))
+        # Already removed if it's being shut down by `start_container()`
+        if container.name in self.running_containers:
+            self.running_containers.remove(container.name)
+        if self.admission is not None:
+            self.admission.forget(container.name)
     def stop_container(self, container):
         with self.container_lock:
-            if container.name in self.ip_cache:
-                del self.ip_cache[container.name]
-            self.running_containers.remove(container.name)
-            container.stop(wait=True)
+            self._forget_running(container)
+            stopped = self.stopping.setdefault(container.name, threading.Event())
+        try:
+            # Only holds the lock if the caller does (i.e. `start_container()` making room)
+            with metrics.lxd('stop'):
+                container.stop(wait=True)
+        finally:
+            with self.container_lock:
+                if self.stopping.get(container.name) is stopped:
+                    del self.stopping[container.name]
+            stopped.set()
+    def _wait_lxd(self, op, response, timeout=None):
+        """
+        Wait (at most `timeout` seconds) for the LXD operation started by `response`,
+        reporting its progress on `op` (if given). Returns the operation's metadata.
+        """
+        lxd_op = response.json()['operation'].split('/')[-1]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with metrics.lxd('operations.wait'):
+                status = self.client.api.operations[lxd_op].wait.get(params={'timeout': 1}).json()['metadata']
+            for key, value in (status.get('metadata') or {}).items():
+                if op is not None and key.endswith('_progress'):
+                    op.progress = value
+            if status['status_code'] == 200:
+                return status.get('metadata') or {}
+            if status['status_code'] >= 400:
+                raise WebspaceError('LXD operation failed: {}'.format(status['err'] or status['status']))
+            if deadline is not None and time.monotonic() >= deadline:
+                raise WebspaceError('Timed out after {} seconds'.format(timeout))
+
+    @check_user
+    def operation_status(self, user, op_id):
+        return self.operations.get(user, op_id).info()
+    @check_user
+    def operation_wait(self, user, op_id, timeout):
+        return self.operations.wait(user, op_id, timeout)
 
     @check_user
     def images(self, _):
-        return list(map(image_info, self.client.images.all()))
+        return self.image_catalog.all()
+    @check_user
+    def resolve_image(self, _, image):
+        return self.image_catalog.resolve(image)
 
     @check_user
-    def init(self, user, image_fingerprint):
+    def init(self, user, image):
         container_name = self.user_container(user)
         if self.client.containers.exists(container_name):
             raise WebspaceError('Your container has already been initialized!')
 
-        self.client.containers.create(self.get_new_config(user, image_fingerprint), wait=True)
+        # Accepts an alias or fingerprint prefix
+        new_config = self.get_new_config(user, self.image_catalog.resolve(image)['fingerprint'])
+        return self.operations.submit(user, 'create', self._init, new_config).id
+    def _claim_warm(self, op, name, new_config):
+        """Turn the pre-created container `name` into the user's container."""
+        op.progress = 'Claiming a pre-created container'
+        with metrics.lxd('rename'):
+            self._wait_lxd(op, self.client.api.containers[name].post(json={'name': new_config['name']}))
+        with metrics.lxd('containers.get'):
+            container = self.client.containers.get(new_config['name'])
+        config = {k: v for k, v in container.config.items() if not k.startswith('user.')}
+        config.update(new_config['config'])
+        container.config = config
+        container.profiles = new_config['profiles']
+        if 'devices' in new_config:
+            container.devices = dict(container.devices, **new_config['devices'])
+        with metrics.lxd('save'):
+            container.save(wait=True)
+    def _init(self, op, new_config):
+        address = None
+        if self.addresses is not None:
+            address = self.addresses.allocate(op.user)
+            new_config['devices'] = {self.config.lxd.net.container_iface: self.nic_device(address)}
+        try:
+            name = None
+            if self.warm_pool is not None:
+                name = self.warm_pool.claim(new_config['source']['fingerprint'])
+            if name is not None:
+                logging.info('claiming pre-created container %s for %s', name, op.user)
+                self._claim_warm(op, name, new_config)
+            else:
+                with metrics.lxd('create'):
+                    self._wait_lxd(op, self.client.api.containers.post(json=new_config))
+        except Exception:
+            if address is not None:
+                self.addresses.release(op.user)
+            raise
+        self.store.add_container(op.user, {k[len('user.'):]: v for k, v in new_config['config'].items()
+                                           if k not in ('user._domains', 'user._ports')}, address)
 
     @check_init
     def status(self, _, container):
-        return container.state()
+        if self.sampler is not None:
+            state = self.sampler.state(container.name, 2 * self.config.sampler.interval)
+            # The container might have been started / stopped since it was sampled
+            if state is not None and state['status_code'] == container.status_code:
+                return state
+        with metrics.lxd('state'):
+            return container.state()
+    @check_user
+    def status_history(self, user, since=0, timeout=0):
+        if self.sampler is None:
+            raise WebspaceError('Resource usage history is disabled')
+        return {
+            'interval': self.config.sampler.interval,
+            'samples': self.sampler.rates(self.user_container(user), since, timeout),
+        }
 
     @check_running
     def log(self, _user, container):
@@ -261,6 +682,7 @@ class Manager:
 
     @check_init
     def exec(self, user, container, command, t_width, t_height, environment):
+        self.sessions.check(user)
         if container.status_code != 103:
             self.start_container(container)
 
@@ -286,14 +708,91 @@ class Manager:
         control_path = '{}?secret={}'.format(ws_path, fds['control'])
 
         session_id = str(uuid.uuid4())
-        session = ConsoleSession(user, self.client.websocket_url, console_path, control_path, socket_suffix='exec-{}'.format(session_id))
-        session.start()
-
-        if user not in self.exec_sessions:
-            self.exec_sessions[user] = {}
-        self.exec_sessions[user][session_id] = session
+        session = ConsoleSession(user, self.client.websocket_url, console_path, control_path,
+                                 socket_suffix='exec-{}'.format(session_id),
+                                 connect_timeout=self.config.sessions.connect_timeout)
+        self.sessions.start(user, 'exec', session_id, session)
 
         return session_id, session.socket_path
+    def _exec_batch(self, container, command, environment, timeout):
+        """
+        Run a command non-interactively (no pty or websockets, stdin is empty), returning its
+        exit status and output. LXD keeps running the command if it takes longer than `timeout`.
+        """
+        with metrics.lxd('exec'):
+            response = container.api['exec'].post(json={
+                'command': command,
+                'environment': environment,
+                'wait-for-websocket': False,
+                'interactive': False,
+                'record-output': True
+            })
+        result = self._wait_lxd(None, response, min(timeout, self.config.exec.timeout) if timeout else
+                                self.config.exec.timeout)
+
+        max_output = self.config.exec.max_output
+        output = {'status': result['return'], 'truncated': False}
+        for fd, stream in (('1', 'stdout'), ('2', 'stderr')):
+            log = container.api['logs'][result['output'][fd].split('/')[-1]]
+            with metrics.lxd('logs'):
+                # Only read as much as we keep (and a byte to tell if there was more), the
+                # log could be huge
+                with log.get(stream=True, is_api=False) as response:
+                    data = response.raw.read(max_output + 1, decode_content=True)
+                log.delete()
+            if len(data) > max_output:
+                data = data[:max_output]
+                output['truncated'] = True
+            output[stream] = data.decode('utf-8', errors='replace')
+        return output
+    @check_init
+    def exec_batch(self, user, container, command, environment, timeout=0):
+        """
+        Run a command in the user's container in the background (so it doesn't hold an RPC
+        thread), the operation's result is `{user: output}` like `fleet_exec`'s.
+        """
+        return self.operations.submit(user, 'exec', self._exec_batch_op, user, container, command,
+                                      environment, timeout).id
+    def _exec_batch_op(self, op, user, container, command, environment, timeout):
+        if container.status_code != 103:
+            op.progress = 'starting container'
+            self.start_container(container)
+        op.progress = 'running'
+        return {user: self._exec_batch(container, command, environment, timeout)}
+
+    @check_admin
+    def fleet_exec(self, users, command, environment, parallelism=0, timeout=0, boot=False):
+        """Run a command in many users' containers (all of them if `users` is empty) in the background."""
+        if not users:
+            users = sorted(self.store.containers())
+        for user in users:
+            if not self.store.has_container(user):
+                raise WebspaceError("{}'s container has not been initialized".format(user))
+        workers = self.config.exec.fleet_workers
+        if parallelism:
+            workers = min(parallelism, workers)
+        return self.operations.submit(self.server.current_request.client_user, 'exec', self._fleet_exec,
+                                      users, command, environment, workers, timeout, boot).id
+    def _fleet_exec(self, op, users, command, environment, workers, timeout, boot):
+        results = {}
+        op.progress = '0/{} containers'.format(len(users))
+        def run_one(user):
+            try:
+                with metrics.lxd('containers.get'):
+                    container = self.client.containers.get(self.user_container(user))
+                if container.status_code != 103:
+                    if not boot:
+                        return {'error': 'not running'}
+                    self.start_container(container)
+                return self._exec_batch(container, command, environment, timeout)
+            except Exception as ex:
+                return {'error': str(ex)}
+        with ThreadPoolExecutor(workers, thread_name_prefix='fleet-exec') as pool:
+            for user, result in zip(users, pool.map(run_one, users)):
+                results[user] = result
+                op.progress = '{}/{} containers'.format(len(results), len(users))
+        return results
+
     @check_exec
     def exec_resize(self, _user, _container, _sid, session, t_width, t_height):
         session.control.resize(t_width, t_height)
@@ -304,10 +803,30 @@ class Manager:
     def exec_close(self, user, _, sid, session):
         session.control.signal(signal.SIGTERM)
         session.stop(join=True)
-        del self.console_sessions[user][sid]
+
+    def _transfer(self, user, container, direction, path, name=''):
+        if not path.startswith('/'):
+            raise WebspaceError('Paths in your container must be absolute')
+        self.sessions.check(user)
+        session_id = str(uuid.uuid4())
+        # LXD can access files in stopped containers, so there's no need to boot
+        transfer = FileTransfer(user, container.api, direction, path, name,
+                                socket_suffix='{}-{}'.format(direction, session_id),
+                                connect_timeout=self.config.sessions.connect_timeout)
+        self.sessions.start(user, 'transfer', session_id, transfer)
+        return transfer.socket_path
+    @check_init
+    def push(self, user, container, path, name):
+        return self._transfer(user, container, 'push', path, name)
+    @check_init
+    def pull(self, user, container, path):
+        return self._transfer(user, container, 'pull', path)
 
     @check_init
     def console(self, user, container, t_width, t_height):
+        existing = self.sessions.get(user, 'console')
+        if existing is None:
+            self.sessions.check(user)
         if container.status_code != 103:
             self.start_container(container)
 
@@ -328,203 +847,346 @@ class Manager:
         console_path = '{}?secret={}'.format(ws_path, fds['0'])
         control_path = '{}?secret={}'.format(ws_path, fds['control'])
 
-        if user in self.console_sessions:
+        if existing is not None:
             logging.info('closing existing console session for %s', user)
-            self.console_sessions[user].stop(join=True)
-        session = ConsoleSession(user, self.client.websocket_url, console_path, control_path)
-        session.start()
-        self.console_sessions[user] = session
+            existing.stop(join=True)
+        session = ConsoleSession(user, self.client.websocket_url, console_path, control_path,
+                                 connect_timeout=self.config.sessions.connect_timeout)
+        self.sessions.start(user, 'console', None, session)
 
         return session.socket_path
     @check_console
     def console_resize(self, _user, _container, session, t_width, t_height):
         session.control.resize(t_width, t_height)
     @check_console
-    def console_close(self, user, _, session):
+    def console_close(self, _user, _, session):
         session.stop(join=True)
-        del self.console_sessions[user]
 
     @check_running
-    def shutdown(self, _user, container):
+    def shutdown(self, user, container):
+        return self.operations.submit(user, 'shutdown', self._shutdown, container).id
+    def _shutdown(self, _op, container):
         self.stop_container(container)
 
     @check_running
-    def reboot(self, _user, container):
+    def reboot(self, user, container):
+        return self.operations.submit(user, 'reboot', self._reboot, container).id
+    def _reboot(self, _op, container):
         with self.container_lock:
             if container.name in self.ip_cache:
                 del self.ip_cache[container.name]
+            self.renumbering.discard(container.name)
+            self.tcp_proxy.container_stopped(self.container_user(container))
+        with metrics.lxd('restart'):
             container.restart(wait=True)
+        ip = self.fixed_address(container.name)
+        if ip is not None:
+            with self.container_lock:
+                self.ip_cache[container.name] = ip
+                self.tcp_proxy.container_started(self.container_user(container), ip)
 
     @check_init
-    def delete(self, _user, container):
+    def delete(self, user, container):
+        return self.operations.submit(user, 'delete', self._delete, container).id
+    def _delete(self, op, container):
         if container.status_code == 103:
+            op.progress = 'Stopping'
             self.stop_container(container)
 
-        for eport in self.get_container_ports(container).values():
-            self.tcp_proxy.remove_forwarding(eport)
-            self.forwarded_ports.remove(eport)
-        container.delete(wait=True)
+        with self.container_lock:
+            for eport in self.ports.user_ports(op.user).values():
+                self.tcp_proxy.remove_forwarding(eport)
+                self.ports.release(eport)
+            for domain in self.store.domains(op.user):
+                if self.custom_domains.get(domain) == op.user:
+                    self.custom_domains.remove(domain)
+                    self.domain_failures.pop(domain, None)
+            self.store.remove_container(op.user)
+            if self.addresses is not None:
+                self.addresses.release(op.user)
+        op.progress = 'Deleting'
+        with metrics.lxd('delete'):
+            container.delete(wait=True)
 
-    @check_init
-    def get_config(self, _user, container):
-        return {k[len('user.'):]: v for k, v in container.config.items() if k.startswith('user.') and not k[len('user.'):] in Manager.private_options}
+    @check_exists
+    def get_config(self, user):
+        return {k: v for k, v in self.store.options(user).items() if not k in Manager.private_options}
 
-    @check_init
-    def set_option(self, _user, container, key, value):
+    @check_exists
+    def set_option(self, user, key, value):
         if key in Manager.private_options:
             raise WebspaceError('{} is a private option and may not be set'.format(key))
         if key in self.reserved_options:
             # Validate the input before setting
             self.reserved_options[key](value)
 
-        container.config['user.{}'.format(key)] = value
-        container.save()
+        self.store.set_option(user, key, value)
+        self.mirror.schedule(user)
 
-    @check_init
-    def unset_option(self, _user, container, key):
+    @check_exists
+    def unset_option(self, user, key):
         if key in Manager.private_options or key in self.reserved_options:
             raise WebspaceError('{} is a reserved/private option and may not be unset'.format(key))
 
-        del container.config['user.{}'.format(key)]
-        container.save()
+        self.store.unset_option(user, key)
+        self.mirror.schedule(user)
 
+    def _lxd_ip(self, container):
+        """A running container's address, from LXD."""
+        with metrics.lxd('state'):
+            info = container.state()
+        iface = self.config.lxd.net.container_iface
+        # No network at all if the container was shut down (e.g. to make room) in the meantime
+        if not info.network or iface not in info.network:
+            raise WebspaceError('iface')
+        for address in info.network[iface]['addresses']:
+            if address['family'] == 'inet' and ipaddress.IPv4Address(address['address']) in self.config.lxd.net.cidr:
+                return address['address']
+        raise WebspaceError('iface')
     def get_container_ip(self, container):
-        if container.status_code != 103:
-            self.start_container(container)
+        while True:
+            # A container which is being stopped is booted again once it has stopped
+            self._wait_stopping(container)
+            if container.status_code != 103:
+                with trace.span('start_container'):
+                    self.start_container(container)
 
-        if container.name in self.ip_cache:
-            ip = self.ip_cache[container.name]
-            logging.debug('using cached ip %s for container %s', ip, container.name)
-        else:
-            info = container.state()
-            if self.config.lxd.net.container_iface not in info.network:
-                raise WebspaceError('iface')
-            for ip in map(
-                          lambda i: ipaddress.IPv4Address(i['address']),
-                          filter(
-                                 lambda i: i['family'] == 'inet',
-                                 info.network[self.config.lxd.net.container_iface]['addresses'])):
-                if ip in self.config.lxd.net.cidr:
-                    ip = str(ip)
+            if container.name in self.ip_cache:
+                ip = self.ip_cache[container.name]
+                logging.debug('using cached ip %s for container %s', ip, container.name)
+                return ip
+            ip = self.fixed_address(container.name) or self._lxd_ip(container)
+            with self.container_lock:
+                # Don't route to it if it started being stopped in the meantime
+                if container.name not in self.stopping:
                     self.ip_cache[container.name] = ip
-        return ip
+                    self.tcp_proxy.container_started(self.container_user(container), ip)
+                    return ip
+    def _trace(self, name, trace_id):
+        req = self.server.current_request
+        if not trace_id:
+            trace_id = uuid.uuid4().hex[:16]
+        t = trace.start(trace_id, name, self.config.slow_request_threshold, start=req.started)
+        # Time spent reading / parsing the request before it was dispatched
+        t.trace.record('request', time.perf_counter() - req.started)
+        return t
     @check_admin
-    def boot_and_host(self, host, https_hint):
-        wildcard_host = '*'+host[host.find('.'):]
-        if host in self.custom_domains:
-            user = self.custom_domains[host]
-        elif wildcard_host in self.custom_domains:
-            # Wildcard domain
-            user = self.custom_domains[wildcard_host]
-        elif host.endswith(self.config.domain_suffix):
-            user = host[:-len(self.config.domain_suffix)]
-            try:
-                pwd.getpwnam(user)
-            except KeyError:
-                return None, 'user'
-        else:
-            return None, 'not_webspace'
+    def boot_and_host(self, host, https_hint, trace_id=None):
+        with self._trace('boot_and_host', trace_id):
+            return self._boot_and_host(host, https_hint)
+    def _boot_and_host(self, host, https_hint):
+        with trace.span('lookup'):
+            user, kind = self.custom_domains.lookup(host)
+            if user is None:
+                return None, 'not_webspace'
+            if kind == 'suffix':
+                try:
+                    nss.cache.getpwnam(user)
+                except KeyError:
+                    return None, 'user'
 
-        container_name = self.user_container(user)
-        if not self.client.containers.exists(container_name):
+        if not self.store.has_container(user):
             return None, 'init'
 
-        container = self.client.containers.get(container_name)
+        name = self.user_container(user)
         try:
-            ip = self.get_container_ip(container)
+            # Running containers with a fixed address don't need LXD at all. Otherwise keep serving containers
+            # we know are running while LXD is having trouble (anything else fails straight away, unless it's
+            # checking whether LXD has recovered)
+            ip = self.known_ip(name)
+            if ip is None and not self.lxd.breaker.healthy:
+                ip = self.ip_cache.get(name)
+            if ip is None:
+                with metrics.lxd('containers.get'):
+                    container = self.client.containers.get(name)
+                with trace.span('get_container_ip'):
+                    ip = self.get_container_ip(container)
+        except (LXDUnavailable, NotEnoughMemory, requests.RequestException):
+            return None, 'unavailable'
         except WebspaceError as ex:
             return None, str(ex)
-        scheme = 'https' if https_hint and not self.get_user_option(container, 'terminate_ssl') else 'http'
-        port = self.get_user_option(container, '{}_port'.format(scheme))
+        scheme = 'https' if https_hint and not self.get_user_option(user, 'terminate_ssl') else 'http'
+        port = self.get_user_option(user, '{}_port'.format(scheme))
         return scheme, str(ip), port
     @check_admin
-    def boot_and_ip(self, user):
-        container_name = self.user_container(user)
-        if not self.client.containers.exists(container_name):
+    def boot_and_ip(self, user, trace_id=None):
+        with self._trace('boot_and_ip', trace_id):
+            return self._boot_and_ip(user)
+    def _boot_and_ip(self, user):
+        if not self.store.has_container(user):
             raise WebspaceError('container not initialized')
+        ip = self.known_ip(self.user_container(user))
+        if ip is not None:
+            return ip
 
-        container = self.client.containers.get(container_name)
-        return self.get_container_ip(container)
+        with metrics.lxd('containers.get'):
+            container = self.client.containers.get(self.user_container(user))
+        with trace.span('get_container_ip'):
+            return self.get_container_ip(container)
 
-    @check_init
-    def get_domains(self, user, container):
-        return [self.user_domain(user)] + self.get_container_domains(container)
-    @check_init
-    def add_domain(self, user, container, domain):
-        if domain in self.custom_domains:
-            raise WebspaceError("'{}' has already been configured as a custom domain".format(domain))
+    @check_admin
+    def record_traffic(self, traffic):
+        """
+        Add a batch of per-host request totals from nginx (host -> dict of `TRAFFIC_FIELDS`)
+        to each container's totals. Containers which received requests move to the back of
+        the eviction order. Returns the number of containers updated.
+        """
+        totals = {}
+        for host, counts in traffic.items():
+            user, _ = self.custom_domains.lookup(host)
+            if user is None or not self.store.has_container(user):
+                continue
+            user_totals = totals.setdefault(user, dict.fromkeys(TRAFFIC_FIELDS, 0))
+            for field in TRAFFIC_FIELDS:
+                user_totals[field] += int(counts.get(field, 0))
+        if not totals:
+            return 0
+        self.store.add_traffic(totals, time.time())
 
-        answer = dns.resolver.query(domain, 'TXT')
-        verified = False
-        for rdata in answer:
-            for txt in map(lambda s: s.decode('utf8'), rdata.strings):
-                if txt == 'webspace:{}'.format(user):
-                    verified = True
-                    break
+        busy = [self.user_container(u) for u, t in totals.items() if t['requests']]
+        with self.container_lock:
+            for name in busy:
+                if name in self.running_containers:
+                    self.running_containers.remove(name)
+                    self.running_containers.append(name)
+        return len(totals)
+    @check_user
+    def stats(self, user):
+        return self.store.traffic(user)
 
-        if not verified:
-            raise WebspaceError("'{}' has not been verified".format(domain))
+    @check_admin
+    def profile(self, mode, seconds):
+        return self.profiler.run(mode, seconds)
+    @check_admin
+    def refresh_users(self):
+        nss.cache.clear()
+        logging.info('cleared user / group cache, admins are now %s', ', '.join(sorted(self.admins)))
+        return sorted(self.admins)
 
+    @check_exists
+    def get_domains(self, user):
+        return [self.user_domain(user)] + self.store.domains(user)
+    def _domain_status(self, domain, future):
+        if not future.done():
+            return {'state': 'pending', 'message': "verification of '{}' is in progress".format(domain)}
+        verification = future.result()
+        return {'state': 'verified' if verification.verified else 'failed', 'message': verification.message}
+    def _finish_add_domain(self, user, domain, future):
+        if not future.result().verified:
+            return
         with self.container_lock:
-            self.custom_domains[domain] = user
-            self.set_container_domains(container, self.get_container_domains(container) + [domain])
-    @check_init
-    def remove_domain(self, user, container, domain):
-        if not domain in self.custom_domains:
-            raise WebspaceError("'{}' has not been configured as a custom domain".format(domain))
+            if domain in self.custom_domains or not self.store.has_container(user):
+                return
+            self.store.add_domain(user, domain)
+            self.custom_domains.add(domain, user)
+        logging.info('added custom domain %s for %s', domain, user)
+        self.mirror.schedule(user)
+    @check_exists
+    def add_domain(self, user, domain):
+        domain = domain.lower()
+        split_domain(domain)
+        if domain in self.custom_domains:
+            raise WebspaceError("'{}' has already been configured as a custom domain".format(domain))
+
+        # Verification happens in the background, the domain is added once it succeeds
+        future = self._check_domain(domain, user, fresh=True)
+        if future.done():
+            self._finish_add_domain(user, domain, future)
+        else:
+            future.add_done_callback(lambda f: threading.Thread(
+                target=self._finish_add_domain, args=(user, domain, f), daemon=True).start())
+        return self._domain_status(domain, future)
+    @check_exists
+    def verify_domain(self, user, domain):
+        """
+        Returns the state of the last verification of a domain (started by `add_domain`
+        or a previous call), or starts a new one.
+        """
+        domain = domain.lower()
+        future = self.domain_checks.get((domain, user))
+        if future is None:
+            future = self._check_domain(domain, user)
+        return self._domain_status(domain, future)
+    def _check_domain(self, domain, user, fresh=False):
+        """Start verifying a domain, which `verify_domain` reports on until it's finished."""
+        future = self.domain_checks[domain, user] = self.verifier.verify(domain, user, fresh)
+        def finished(f):
+            # The next call verifies again (using the cached result)
+            if self.domain_checks.get((domain, user)) is f:
+                self.domain_checks.pop((domain, user), None)
+        future.add_done_callback(finished)
+        return future
+    def _domain_reverified(self, domain, user, verification):
+        if verification.verified or not verification.definitive:
+            if not verification.verified:
+                logging.warning('failed to re-verify %s for %s: %s', domain, user, verification.message)
+            self.domain_failures.pop(domain, None)
+            return
 
+        failures = self.domain_failures[domain] = self.domain_failures.get(domain, 0) + 1
+        logging.warning('custom domain %s for %s is no longer verified (%d times): %s',
+                        domain, user, failures, verification.message)
+        if self.config.dns.reverify_failures and failures >= self.config.dns.reverify_failures:
+            threading.Thread(target=self._remove_unverified_domain, args=(domain, user), daemon=True).start()
+    def _remove_unverified_domain(self, domain, user):
+        with self.container_lock:
+            if self.custom_domains.get(domain) != user:
+                return
+            logging.warning('removing unverified custom domain %s for %s', domain, user)
+            self.store.remove_domain(user, domain)
+            self.custom_domains.remove(domain)
+            self.domain_failures.pop(domain, None)
+        self.mirror.schedule(user)
+    @check_exists
+    def remove_domain(self, user, domain):
+        domain = domain.lower()
         with self.container_lock:
-            del self.custom_domains[domain]
-            domains = self.get_container_domains(container)
-            domains.remove(domain)
-            self.set_container_domains(container, domains)
+            if self.custom_domains.get(domain) != user:
+                raise WebspaceError("'{}' has not been configured as a custom domain".format(domain))
+            self.store.remove_domain(user, domain)
+            self.custom_domains.remove(domain)
+            # Not held against it if it's added again
+            self.domain_failures.pop(domain, None)
+        self.mirror.schedule(user)
 
-    @check_init
-    def get_ports(self, user, container):
-        return {str(eport): str(iport) for eport, iport in self.get_container_ports(container).items()}
-    @check_init
-    def add_port(self, user, container, iport, eport):
+    @check_exists
+    def get_ports(self, user):
+        return {str(eport): str(iport) for eport, iport in self.store.ports(user).items()}
+    @check_exists
+    def add_port(self, user, iport, eport):
         with self.container_lock:
-            existing = self.get_container_ports(container)
-            if port(iport) in existing:
-                raise WebspaceError('external port {} is already forwarded to port {}'.format(existing[iport], iport))
-            if len(existing) == self.config.ports.max:
-                raise WebspaceError('you cannot forward any more ports')
-
-            self.check_valid_port(eport)
-            if eport in self.forwarded_ports:
-                raise WebspaceError('external port {} has already been forwarded'.format(eport))
-            if eport == 0:
-                eport = self.next_random_port()
+            eport = self.ports.allocate(user, port(iport), eport)
 
             logging.debug('adding port forward: %d -> %s:%d', eport, user, iport)
-            self.forwarded_ports.add(eport)
-            self.tcp_proxy.add_forwarding(eport, user, iport)
-
-            existing[iport] = eport
-            self.set_container_ports(container, existing)
+            try:
+                self.tcp_proxy.add_forwarding(eport, user, iport)
+            except:
+                self.ports.release(eport)
+                raise
+            self.store.add_port(user, iport, eport)
+        self.mirror.schedule(user)
         return eport
-    @check_init
-    def remove_port(self, user, container, iport):
+    @check_exists
+    def remove_port(self, user, iport):
         with self.container_lock:
             port(iport)
-            ports = self.get_container_ports(container)
+            ports = self.ports.user_ports(user)
             if not iport in ports:
                 raise WebspaceError('no port has been forwarded to {}'.format(iport))
 
             eport = ports[iport]
             self.tcp_proxy.remove_forwarding(eport)
-            self.forwarded_ports.remove(eport)
-
-            del ports[iport]
-            self.set_container_ports(container, ports)
+            self.ports.release(eport)
+            self.store.remove_port(user, iport)
+        self.mirror.schedule(user)
 
     def _dispatch(self, method, params):
         if not method in Manager.allowed:
             raise Exception('method "{}" is not supported'.format(method))
 
         try:
-            return getattr(self, method)(*params)
+            with metrics.rpc_duration.time(method, metrics.rpc_errors):
+                return self.profiler.call(getattr(self, method), *params)
         except:
             import traceback
             traceback.print_exc()
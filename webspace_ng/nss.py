@@ -0,0 +1,91 @@
+import grp
+import os
+import pwd
+import threading
+import time
+
+class NssCache:
+    """
+    Caches `pwd` / `grp` lookups (which may go over the network with LDAP / SSSD) for
+    `ttl` seconds, or `negative_ttl` seconds for users / groups which don't exist.
+
+    Everything is dropped when `/etc/passwd` or `/etc/group` change (checked at most
+    every `check_interval` seconds), or on `clear()`. The methods raise `KeyError` like
+    their `pwd` / `grp` counterparts.
+    """
+    def __init__(self, ttl=300, negative_ttl=30, check_interval=1, max_entries=10000,
+                 files=('/etc/passwd', '/etc/group')):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.check_interval = check_interval
+        self.max_entries = max_entries
+        self.files = files
+
+        self.lock = threading.Lock()
+        # (kind, key) -> (value or None, expiry)
+        self.entries = {}
+        self.file_state = self._file_state()
+        self.next_check = time.monotonic() + check_interval
+
+    def _file_state(self):
+        state = []
+        for f in self.files:
+            try:
+                st = os.stat(f)
+                state.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                state.append(None)
+        return state
+    def _check_files(self, now):
+        if now < self.next_check:
+            return
+        self.next_check = now + self.check_interval
+
+        state = self._file_state()
+        if state != self.file_state:
+            self.file_state = state
+            self.clear()
+
+    def _get(self, kind, key, lookup):
+        now = time.monotonic()
+        self._check_files(now)
+
+        entry = self.entries.get((kind, key))
+        if entry is not None and entry[1] > now:
+            value = entry[0]
+        else:
+            try:
+                value = lookup(key)
+                ttl = self.ttl
+            except KeyError:
+                value = None
+                ttl = self.negative_ttl
+            with self.lock:
+                if len(self.entries) >= self.max_entries:
+                    self.entries.clear()
+                self.entries[kind, key] = (value, now + ttl)
+
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def getpwnam(self, name):
+        return self._get('pwnam', name, pwd.getpwnam)
+    def getpwuid(self, uid):
+        return self._get('pwuid', uid, pwd.getpwuid)
+    def getgrnam(self, name):
+        return self._get('grnam', name, grp.getgrnam)
+    def getgrgid(self, gid):
+        return self._get('grgid', gid, grp.getgrgid)
+    def group_members(self, name):
+        """Returns the (frozen) set of a group's members, empty if the group doesn't exist."""
+        try:
+            return self._get('members', name, lambda n: frozenset(grp.getgrnam(n).gr_mem))
+        except KeyError:
+            return frozenset()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+cache = NssCache()
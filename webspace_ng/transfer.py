@@ -0,0 +1,72 @@
+"""
+Framing for file transfers between `webspace push` / `webspace pull` and the daemon.
+
+Every frame is a 1 byte type and 4 byte (big-endian) length followed by the payload:
+`J` is a JSON message, `D` a chunk of file data and `E` marks the end of a file's data.
+
+A transfer is a series of entries (`{"path": ..., "type": "file" | "directory" |
+"symlink", "mode": ...}`) with paths relative to the root being transferred (`""` for
+the root itself). Symlinks carry a `target`. Before a file's data is sent, the receiver
+replies `{"offset": n}` with how many bytes it already has, so interrupted transfers can
+be resumed. Push entries also carry the file's `size` and whether to `resume`. Any
+message can be `{"error": ...}` instead. A push ends with `{"type": "end"}`, a pull with
+the same message from the daemon.
+"""
+import json
+import struct
+
+from . import WebspaceError
+
+HEADER = struct.Struct('>cI')
+CHUNK_SIZE = 64 * 1024
+
+def recv_exact(sock, n):
+    data = bytearray(n)
+    view = memoryview(data)
+    read = 0
+    while read < n:
+        count = sock.recv_into(view[read:])
+        if not count:
+            raise WebspaceError('Connection closed during transfer')
+        read += count
+    return data
+
+def send_frame(sock, kind, payload=b''):
+    sock.sendall(HEADER.pack(kind, len(payload)))
+    if payload:
+        sock.sendall(payload)
+def recv_frame(sock):
+    kind, length = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return kind, recv_exact(sock, length) if length else b''
+
+def send_json(sock, message):
+    send_frame(sock, b'J', json.dumps(message).encode('utf-8'))
+def recv_json(sock):
+    kind, payload = recv_frame(sock)
+    if kind != b'J':
+        raise WebspaceError('Unexpected {} frame during transfer'.format(kind.decode('ascii', 'replace')))
+    message = json.loads(payload)
+    if 'error' in message:
+        raise WebspaceError(message['error'])
+    return message
+
+def send_data(sock, f):
+    """Send the rest of the file `f` as data frames, returns the number of bytes sent."""
+    sent = 0
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        send_frame(sock, b'D', chunk)
+        sent += len(chunk)
+    send_frame(sock, b'E')
+    return sent
+def recv_data(sock):
+    """Yield the chunks of a file's data frames."""
+    while True:
+        kind, payload = recv_frame(sock)
+        if kind == b'E':
+            return
+        if kind != b'D':
+            raise WebspaceError('Unexpected {} frame during transfer'.format(kind.decode('ascii', 'replace')))
+        yield payload
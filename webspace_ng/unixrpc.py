@@ -1,9 +1,8 @@
 import struct
 import stat
 import os
-import pwd
-import grp
 import threading
+import time
 import socket
 import socketserver
 from http.server import BaseHTTPRequestHandler
@@ -12,6 +11,8 @@ from xmlrpc.server import SimpleXMLRPCDispatcher, SimpleXMLRPCRequestHandler
 import http.client
 import xmlrpc.client
 
+from . import nss
+
 SO_PEERCRED = 17
 
 # We have to monkey patch the int marshalling code since
@@ -45,8 +46,8 @@ class UnixStreamRequestHandler(StreamRequestHandler):
         self.client_uid = creds[1]
         self.client_gid = creds[2]
 
-        self.client_user = pwd.getpwuid(self.client_uid).pw_name
-        self.client_group = grp.getgrgid(self.client_gid).gr_name
+        self.client_user = nss.cache.getpwuid(self.client_uid).pw_name
+        self.client_group = nss.cache.getgrgid(self.client_gid).gr_name
 
 class UnixHTTPRequestHandler(UnixStreamRequestHandler, BaseHTTPRequestHandler):
     # We're using Unix sockets so this is irrelevant
@@ -65,15 +66,37 @@ class UnixRPCRequestHandler(UnixHTTPRequestHandler, SimpleXMLRPCRequestHandler):
     # Hacky way of passing the request through to the RPC functions
     # Shove the request into thread-local storage (yuck...)
     def setup(self):
+        self.started = time.perf_counter()
         super(UnixRPCRequestHandler, self).setup()
         _hacky_local.current_req = self
 
+SD_LISTEN_FDS_START = 3
+def systemd_sockets():
+    """Returns the file descriptors passed to us by systemd socket activation (if any)."""
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return []
+    count = int(os.environ.get('LISTEN_FDS', 0))
+    # Not meant for any child processes
+    for var in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(var, None)
+    return list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count))
+
 class UnixRPCServer(UnixStreamServer, SimpleXMLRPCDispatcher):
     def __init__(self, addr, requestHandler=UnixRPCRequestHandler,
                  logRequests=True, allow_none=True, encoding=None,
                  bind_and_activate=True, use_builtin_types=False,
-                 socket_mode=stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO):
+                 socket_mode=stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO, fd=None):
         self.logRequests = logRequests
+        SimpleXMLRPCDispatcher.__init__(self, allow_none, encoding, use_builtin_types)
+
+        if fd is not None:
+            # Inherited listening socket (e.g. from systemd), which stays open (queueing
+            # connections) while the daemon restarts
+            UnixStreamServer.__init__(self, addr, requestHandler, bind_and_activate=False)
+            self.socket.close()
+            self.socket = socket.socket(fileno=fd)
+            self.server_address = self.socket.getsockname()
+            return
 
         try:
             os.unlink(addr)
@@ -81,7 +104,6 @@ class UnixRPCServer(UnixStreamServer, SimpleXMLRPCDispatcher):
             if os.path.exists(addr):
                 raise
 
-        SimpleXMLRPCDispatcher.__init__(self, allow_none, encoding, use_builtin_types)
         UnixStreamServer.__init__(self, addr, requestHandler, bind_and_activate)
 
         os.chmod(addr, socket_mode)